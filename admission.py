@@ -0,0 +1,391 @@
+"""
+Control de admisión de las peticiones que llegan al modelo
+
+Antes de recuperar documentos o llamar a Azure OpenAI, cada turno pide plaza:
+
+- Límite global de turnos en curso (ADMISSION_MAX_IN_FLIGHT).
+- Por usuario: como mucho ADMISSION_USER_CONCURRENCY en curso,
+  ADMISSION_USER_MAX_QUEUE esperando y ADMISSION_USER_RPM por minuto.
+- Reparto justo entre usuarios: con el límite global lleno, las esperas
+  pasan por etiquetas de tiempo virtual (como rate_governor.FairQueue, pero
+  con varias plazas), así que quien manda muchas peticiones no adelanta a quien
+  manda una. ADMISSION_USER_WEIGHTS da más peso a usuarios concretos.
+- Descarte temprano: con la media móvil de lo que dura un turno se estima la
+  espera de quien llega; si no cabe en ADMISSION_MAX_WAIT se rechaza en el
+  acto, sin hacer cola ni gastar cuota. Si la espera real vence, también.
+
+Los rechazos son Shed (un RateLimited con retry_after): los chats responden 503
+con Retry-After y el bot un mensaje de "mucha demanda", igual que cuando falta
+cuota en Azure. En la web la plaza se libera cuando termina la respuesta,
+streaming incluido (AdmissionMiddleware).
+"""
+import asyncio
+import heapq
+import logging
+import time
+from collections import OrderedDict, deque
+from typing import Deque, Dict, List, Mapping, Optional, Tuple
+
+import deadline
+import metrics
+from rate_governor import RateLimited, TokenBucket
+from config import (
+    ADMISSION_ENABLED,
+    ADMISSION_MAX_IN_FLIGHT,
+    ADMISSION_MAX_QUEUE,
+    ADMISSION_MAX_WAIT,
+    ADMISSION_USER_CONCURRENCY,
+    ADMISSION_USER_MAX_QUEUE,
+    ADMISSION_USER_RPM,
+    ADMISSION_USER_WEIGHTS
+)
+
+logger = logging.getLogger(__name__)
+
+ADMISSION_DECISIONS = metrics.counter(
+    "admission_decisions_total",
+    "Turnos por superficie y resultado (admitted, queued, shed_*)",
+    ("surface", "result")
+)
+ADMISSION_WAIT = metrics.histogram(
+    "admission_wait_seconds",
+    "Espera en la cola de admisión de los turnos que acabaron admitidos",
+    ("surface",)
+)
+
+# Usuarios de los que se recuerda el ritmo (los más antiguos se olvidan)
+MAX_TRACKED_USERS = 10000
+
+
+class Shed(RateLimited):
+    """Turno rechazado por la admisión; reason: overload, deadline, user_rate o user_queue"""
+
+    def __init__(self, reason: str, retry_after: float):
+        super().__init__(f"Turno descartado ({reason})", retry_after=retry_after)
+        self.reason = reason
+
+
+class Ticket:
+    """Plaza concedida; se devuelve con release()"""
+    __slots__ = ("user", "surface", "admitted_at", "released")
+
+    def __init__(self, user: str, surface: str):
+        self.user = user
+        self.surface = surface
+        self.admitted_at = time.monotonic()
+        self.released = False
+
+
+class _User:
+    __slots__ = ("name", "weight", "in_flight", "waiting", "waiters", "finish")
+
+    def __init__(self, name: str, weight: float):
+        self.name = name
+        self.weight = weight
+        self.in_flight = 0
+        self.waiting = 0
+        # (etiqueta virtual, secuencia, future) en orden de llegada
+        self.waiters: Deque[Tuple[float, int, asyncio.Future]] = deque()
+        self.finish = 0.0
+
+    def head(self) -> Optional[Tuple[float, int, asyncio.Future]]:
+        """Primera espera viva (las vencidas se quitan aquí)"""
+        while self.waiters and self.waiters[0][2].done():
+            self.waiters.popleft()
+        return self.waiters[0] if self.waiters else None
+
+
+class AdmissionController:
+    """Plazas globales repartidas por orden de etiqueta virtual entre usuarios"""
+
+    def __init__(
+        self,
+        max_in_flight: int,
+        max_queue: int,
+        max_wait: float,
+        user_concurrency: int,
+        user_max_queue: int,
+        user_rpm: float,
+        weights: Optional[Mapping[str, float]] = None
+    ):
+        self.max_in_flight = max_in_flight
+        self.max_queue = max_queue
+        self.max_wait = max_wait
+        self.user_concurrency = user_concurrency
+        self.user_max_queue = user_max_queue
+        self.user_rpm = user_rpm
+        self.weights = dict(weights or {})
+        self._users: Dict[str, _User] = {}
+        # Usuarios con alguna espera (para estimar la cola sin recorrer todos)
+        self._queued: Dict[str, _User] = {}
+        self._buckets: "OrderedDict[str, TokenBucket]" = OrderedDict()
+        # Cabezas de cola de usuarios por debajo de su límite: (etiqueta, secuencia, usuario)
+        self._ready: List[Tuple[float, int, str]] = []
+        self._virtual = 0.0
+        self._seq = 0
+        self.in_flight = 0
+        self.waiting = 0
+        # Media móvil de lo que dura un turno admitido (None hasta el primero)
+        self.service_time: Optional[float] = None
+        self.counts: Dict[str, int] = {}
+
+    async def acquire(self, user: str, surface: str) -> Ticket:
+        """Espera plaza; lanza Shed si no la habrá a tiempo"""
+        state = self._users.get(user)
+        if state is None:
+            state = self._users[user] = _User(user, self.weights.get(user, 1.0))
+        bucket = self._bucket(user) if self.user_rpm > 0 else None
+        if bucket is not None:
+            wait = bucket.wait_time(1)
+            if wait > 0:
+                self._shed(state, surface, "user_rate", wait)
+
+        tag = max(self._virtual, state.finish)
+        if self.in_flight < self.max_in_flight and state.in_flight < self.user_concurrency and not self._ready:
+            # Hay plaza y nadie que pueda usarla está esperando
+            self._charge(state, bucket, tag)
+            self._virtual = tag
+            self.in_flight += 1
+            state.in_flight += 1
+            return self._ticket(state, surface, "admitted", 0.0)
+
+        if state.waiting >= self.user_max_queue:
+            self._shed(state, surface, "user_queue", self._expected_wait(tag))
+        expected = self._expected_wait(tag)
+        # La espera tampoco puede pasar del plazo de la petición
+        max_wait = deadline.budget(self.max_wait)
+        if self.waiting >= self.max_queue or expected > max_wait:
+            # No llegaría a tiempo: se rechaza antes de hacer cola
+            self._shed(state, surface, "overload", expected)
+
+        self._charge(state, bucket, tag)
+        future = asyncio.get_running_loop().create_future()
+        self._seq += 1
+        state.waiters.append((tag, self._seq, future))
+        if state.head()[2] is future and state.in_flight < self.user_concurrency:
+            heapq.heappush(self._ready, (tag, self._seq, user))
+        state.waiting += 1
+        self.waiting += 1
+        self._queued[user] = state
+        self._dispatch()
+
+        started = time.monotonic()
+        try:
+            await asyncio.wait_for(asyncio.shield(future), timeout=max_wait)
+        except asyncio.TimeoutError:
+            # Si la plaza llegó justo al vencer, se aprovecha
+            if not future.done():
+                self._abandon(state, future)
+                self._shed(state, surface, "deadline", self._expected_wait(tag))
+        except BaseException:
+            if future.done() and not future.cancelled():
+                # Cancelada después de recibir plaza: se devuelve
+                self._release_slot(state)
+            else:
+                self._abandon(state, future)
+            raise
+        finally:
+            state.waiting -= 1
+            self.waiting -= 1
+            if not state.waiting:
+                self._queued.pop(user, None)
+        return self._ticket(state, surface, "queued", time.monotonic() - started)
+
+    def release(self, ticket: Optional[Ticket]):
+        """Devuelve la plaza (idempotente; None se ignora)"""
+        if ticket is None or ticket.released:
+            return
+        ticket.released = True
+        elapsed = time.monotonic() - ticket.admitted_at
+        self.service_time = elapsed if self.service_time is None else self.service_time * 0.9 + elapsed * 0.1
+        self._release_slot(self._users[ticket.user])
+
+    def stats(self) -> dict:
+        return {
+            "in_flight": self.in_flight,
+            "waiting": self.waiting,
+            "users": len(self._users),
+            "service_time_s": round(self.service_time, 3) if self.service_time is not None else None,
+            **self.counts,
+        }
+
+    def _charge(self, state: _User, bucket: Optional[TokenBucket], tag: float):
+        """Cuenta el turno en el ritmo del usuario y en su etiqueta virtual"""
+        if bucket is not None:
+            bucket.take(1)
+        state.finish = tag + 1.0 / state.weight
+
+    def _ticket(self, state: _User, surface: str, result: str, waited: float) -> Ticket:
+        self.counts[result] = self.counts.get(result, 0) + 1
+        ADMISSION_DECISIONS.inc(surface, result)
+        ADMISSION_WAIT.observe(waited, surface)
+        return Ticket(state.name, surface)
+
+    def _shed(self, state: _User, surface: str, reason: str, retry_after: float):
+        result = f"shed_{reason}"
+        self.counts[result] = self.counts.get(result, 0) + 1
+        ADMISSION_DECISIONS.inc(surface, result)
+        logger.warning(f"🚧 Turno de {surface} descartado ({reason}), reintento en {retry_after:.1f}s")
+        self._forget(state)
+        raise Shed(reason, max(retry_after, 1.0))
+
+    def _release_slot(self, state: _User):
+        self.in_flight -= 1
+        state.in_flight -= 1
+        if state.in_flight == self.user_concurrency - 1:
+            # Vuelve a estar por debajo de su límite: su cabeza de cola entra en el reparto
+            head = state.head()
+            if head is not None:
+                heapq.heappush(self._ready, (head[0], head[1], state.name))
+        self._dispatch()
+        self._forget(state)
+
+    def _abandon(self, state: _User, future: asyncio.Future):
+        """Quita una espera vencida; si era la cabeza, la siguiente entra en el reparto"""
+        was_head = state.head()[2] is future
+        future.cancel()
+        if was_head and state.in_flight < self.user_concurrency:
+            head = state.head()
+            if head is not None:
+                heapq.heappush(self._ready, (head[0], head[1], state.name))
+
+    def _dispatch(self):
+        """Da las plazas libres a las esperas de menor etiqueta"""
+        while self._ready and self.in_flight < self.max_in_flight:
+            tag, seq, user = heapq.heappop(self._ready)
+            state = self._users.get(user)
+            if state is None or state.in_flight >= self.user_concurrency:
+                continue
+            head = state.head()
+            if head is None or head[1] != seq:
+                # Entrada obsoleta: su espera venció (_abandon ya metió la siguiente)
+                continue
+            state.waiters.popleft()
+            self._virtual = tag
+            self.in_flight += 1
+            state.in_flight += 1
+            head[2].set_result(None)
+            head = state.head()
+            if head is not None and state.in_flight < self.user_concurrency:
+                heapq.heappush(self._ready, (head[0], head[1], user))
+
+    def _expected_wait(self, tag: float) -> float:
+        """Segundos estimados hasta que pase una espera con esta etiqueta"""
+        if self.service_time is None:
+            return 0.0
+        ahead = sum(
+            1 for state in self._queued.values() for waiter in state.waiters
+            if waiter[0] <= tag and not waiter[2].done()
+        )
+        return (ahead + 1) * self.service_time / self.max_in_flight
+
+    def _bucket(self, user: str) -> TokenBucket:
+        bucket = self._buckets.get(user)
+        if bucket is None:
+            bucket = self._buckets[user] = TokenBucket(self.user_rpm)
+            if len(self._buckets) > MAX_TRACKED_USERS:
+                self._buckets.popitem(last=False)
+        else:
+            self._buckets.move_to_end(user)
+        return bucket
+
+    def _forget(self, state: _User):
+        """Un usuario sin turnos ni esperas solo importa si va por delante del tiempo virtual"""
+        if not state.in_flight and not state.waiting and (
+            state.finish <= self._virtual or len(self._users) > MAX_TRACKED_USERS
+        ):
+            self._users.pop(state.name, None)
+
+
+_controller: Optional[AdmissionController] = None
+
+
+def get_controller() -> Optional[AdmissionController]:
+    """Control de admisión del proceso (None si ADMISSION_ENABLED es false)"""
+    global _controller
+    if ADMISSION_ENABLED and _controller is None:
+        _controller = AdmissionController(
+            ADMISSION_MAX_IN_FLIGHT,
+            ADMISSION_MAX_QUEUE,
+            ADMISSION_MAX_WAIT,
+            ADMISSION_USER_CONCURRENCY,
+            ADMISSION_USER_MAX_QUEUE,
+            ADMISSION_USER_RPM,
+            ADMISSION_USER_WEIGHTS
+        )
+    return _controller
+
+
+async def acquire(user: str, surface: str) -> Optional[Ticket]:
+    """Plaza para un turno (None con la admisión desactivada); lanza Shed"""
+    controller = get_controller()
+    return await controller.acquire(user, surface) if controller else None
+
+
+def release(ticket: Optional[Ticket]):
+    if ticket is not None and _controller is not None:
+        _controller.release(ticket)
+
+
+def client_key(headers: Mapping[str, str], client_host: Optional[str]) -> str:
+    """Usuario de un chat web a efectos de admisión
+
+    El de App Service Authentication si lo hay; si no, la IP de origen (la
+    última de X-Forwarded-For, que añade el frontal y no el cliente), más
+    difícil de rotar que un id de sesión.
+    """
+    principal = headers.get("x-ms-client-principal-name")
+    if principal:
+        return principal
+    forwarded = headers.get("x-forwarded-for")
+    if forwarded:
+        address = forwarded.split(",")[-1].strip()
+        # App Service añade el puerto a las IPv4 (1.2.3.4:5678)
+        if address.count(":") == 1:
+            address = address.split(":")[0]
+        return f"ip:{address}"
+    return f"ip:{client_host or 'desconocida'}"
+
+
+async def admit(request, surface: str, user: Optional[str] = None):
+    """Plaza para una petición web; se libera al terminar la respuesta (AdmissionMiddleware)"""
+    ticket = await acquire(user or client_key(request.headers, request.client.host if request.client else None), surface)
+    if ticket is not None:
+        request.scope.setdefault("admission_tickets", []).append(ticket)
+
+
+def shed_response(error: Shed):
+    """503 con Retry-After para los endpoints que no pasan por su except general"""
+    from fastapi.responses import ORJSONResponse
+    import llm
+    retry_after = max(int(error.retry_after + 0.5), 1)
+    return ORJSONResponse(
+        {"error": llm.BUSY_MESSAGE, "retry_after": retry_after},
+        status_code=503,
+        headers={"Retry-After": str(retry_after)}
+    )
+
+
+class AdmissionMiddleware:
+    """Middleware ASGI puro: devuelve las plazas de la petición cuando termina la respuesta"""
+
+    def __init__(self, app):
+        self.app = app
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http":
+            await self.app(scope, receive, send)
+            return
+        try:
+            await self.app(scope, receive, send)
+        finally:
+            for ticket in scope.get("admission_tickets", ()):
+                release(ticket)
+
+
+def instrument(app):
+    """Añade la liberación de plazas a una app FastAPI"""
+    app.add_middleware(AdmissionMiddleware)
+
+
+metrics.register_stats("admission", lambda: _controller.stats() if _controller else None)
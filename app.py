@@ -2,36 +2,171 @@
 FastAPI App para el Bot de Teams con Azure OpenAI
 """
 import logging
-from fastapi import FastAPI, Request, HTTPException
-from fastapi.responses import JSONResponse
-from botbuilder.core import BotFrameworkAdapter, BotFrameworkAdapterSettings
-from botbuilder.schema import Activity
-from bot import TeamsOpenAIBot
-from config import BOT_APP_ID, BOT_APP_PASSWORD
+from contextlib import asynccontextmanager
+from typing import TYPE_CHECKING, Optional
+from fastapi import APIRouter, FastAPI, Request, HTTPException
+from fastapi.responses import ORJSONResponse
+import admission
+import config
+import conversation_store
+import deadline
+import ingress
+import llm
+import logging_setup
+import metrics
+import openai_client
+import response_cache
+import router
+import usage_ledger
+from idempotency import IdempotencyGuard, activity_key
+from turn_queue import TurnQueue
+from config import (
+    BOT_APP_ID,
+    BOT_APP_PASSWORD,
+    BOT_ASYNC_MODE,
+    BOT_WORKERS,
+    BOT_QUEUE_MAX,
+    BOT_QUEUE_DRAIN_TIMEOUT,
+    BOT_DEDUP_ENABLED,
+    BOT_DEDUP_TTL,
+    BOT_DEDUP_MAX_ENTRIES,
+    BOT_DEDUP_DB
+)
+
+if TYPE_CHECKING:
+    from botbuilder.schema import Activity
+    from bot import TeamsOpenAIBot
+    from connector import PooledBotFrameworkAdapter
 
 # Configurar logging
-logging.basicConfig(level=logging.INFO)
+logging_setup.setup()
 logger = logging.getLogger(__name__)
 
+async def startup():
+    """Arranque del bot: SDK, deduplicación, claves de firma, memoria y cola de turnos"""
+    global dedup
+    # Ya cargado si gunicorn hizo --preload; si no, aquí y no en el primer request
+    preload()
+    import bot_auth
+    # SQLite se abre en cada worker, nunca en el proceso que hace fork
+    dedup = IdempotencyGuard(BOT_DEDUP_TTL, BOT_DEDUP_MAX_ENTRIES, BOT_DEDUP_DB)
+    if BOT_APP_ID:
+        # Claves de firma listas antes del primer request
+        await bot_auth.start()
+    memory = conversation_store.get_store()
+    if memory:
+        await memory.start()
+    if BOT_ASYNC_MODE:
+        await turns.start()
+
+async def shutdown():
+    """Cierra en orden: cola de turnos, memoria, claves de firma y conector"""
+    import bot_auth
+    import connector
+    if BOT_ASYNC_MODE:
+        await turns.stop()
+    memory = conversation_store.get_store()
+    if memory:
+        # Después de la cola: los últimos turnos también se guardan
+        await memory.stop()
+    await bot_auth.stop()
+    await connector.shutdown()
+
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+    """Abre el pool de Azure OpenAI al arrancar y lo cierra al apagar"""
+    config.validate()
+    await openai_client.startup()
+    await usage_ledger.start()
+    await startup()
+    yield
+    deadline.begin_drain()
+    await shutdown()
+    # Después de la cola de turnos: sus últimos consumos también se guardan
+    await usage_ledger.stop()
+    await openai_client.shutdown()
+
 # Crear app FastAPI
 app = FastAPI(
+    lifespan=lifespan,
     title="Teams OpenAI Bot",
     description="Bot interno para Teams con Azure OpenAI",
-    version="2.0.0"
+    version="2.0.0",
+    default_response_class=ORJSONResponse
 )
+metrics.instrument(app)
+logging_setup.instrument(app)
+admission.instrument(app)
+deadline.instrument(app)
 
-# Configurar Bot Framework Adapter (sin app_type)
-bot_settings = BotFrameworkAdapterSettings(
-    app_id=BOT_APP_ID,
-    app_password=BOT_APP_PASSWORD
-)
+# Rutas del bot; service.py las monta junto a los chats web
+routes = APIRouter()
+
+# Bot Framework: el SDK (~0,5 s de import) se carga en preload(), no al importar
+adapter: Optional["PooledBotFrameworkAdapter"] = None
+bot: Optional["TeamsOpenAIBot"] = None
+
+def preload():
+    """Importa el SDK de Bot Framework y crea el adapter y el bot (una vez)
 
-adapter = BotFrameworkAdapter(bot_settings)
+    No abre sockets ni hilos (el índice de recuperación solo se mapea en
+    lectura): gunicorn --preload lo llama en el master y los workers heredan
+    los módulos ya cargados.
+    """
+    global adapter, bot
+    if bot is not None:
+        return
+    from botbuilder.core import BotFrameworkAdapterSettings
+    import connector
+    import retrieval
+    from bot import TeamsOpenAIBot
+    retrieval.preload()
+    
+    # Configurar Bot Framework Adapter (sin app_type)
+    bot_settings = BotFrameworkAdapterSettings(
+        app_id=BOT_APP_ID,
+        app_password=BOT_APP_PASSWORD
+    )
+    
+    # Adapter con caché de tokens ya validados y envíos por un pool persistente
+    adapter = connector.PooledBotFrameworkAdapter(bot_settings)
+    
+    # Crear instancia del bot
+    bot = TeamsOpenAIBot()
 
-# Crear instancia del bot
-bot = TeamsOpenAIBot()
+metrics.register_stats("bot_auth_cache", lambda: adapter.auth_cache.stats() if adapter else None)
 
-@app.get("/")
+# Turnos procesados en segundo plano (BOT_ASYNC_MODE)
+turns = TurnQueue(BOT_WORKERS, BOT_QUEUE_MAX, BOT_QUEUE_DRAIN_TIMEOUT)
+metrics.register_stats("bot_turn_queue", turns.stats)
+
+# Reenvíos del canal (misma actividad) no generan otra respuesta; se crea en el lifespan
+dedup: Optional[IdempotencyGuard] = None
+metrics.register_stats("bot_dedup", lambda: dedup.stats() if dedup else None)
+
+def _enqueue_turn(activity: "Activity", identity, key) -> bool:
+    """Encola el turno; la respuesta sale por la referencia de la conversación"""
+    from botbuilder.core import TurnContext
+    reference = TurnContext.get_conversation_reference(activity)
+    
+    async def callback(turn_context: TurnContext):
+        # El contexto proactivo trae una actividad de continuación: se restaura la original
+        turn_context.activity = activity
+        await bot.on_turn(turn_context)
+    
+    async def run():
+        try:
+            await adapter.continue_conversation(reference, callback, claims_identity=identity)
+        except BaseException as e:
+            if key:
+                await dedup.release(key, e)
+            raise
+        if key:
+            await dedup.finish(key)
+    
+    return turns.submit(activity.conversation.id, run)
+
+@routes.get("/")
 async def root():
     """Endpoint principal"""
     return {
@@ -40,48 +175,90 @@ async def root():
         "bot_ready": bot.is_ready()
     }
 
-@app.get("/health")
+@routes.get("/health")
 async def health():
     """Health check"""
+    import connector
+    cache = response_cache.get_cache()
+    memory = conversation_store.get_store()
     return {
         "status": "healthy",
-        "bot_ready": bot.is_ready()
+        "bot_ready": bot.is_ready(),
+        "pool": openai_client.pool_stats(),
+        "cache": cache.stats() if cache else None,
+        "singleflight": llm.flight.stats(),
+        "router": router.get_router().stats(),
+        "turn_queue": turns.stats() if BOT_ASYNC_MODE else None,
+        "dedup": dedup.stats() if BOT_DEDUP_ENABLED else None,
+        "auth_cache": adapter.auth_cache.stats(),
+        "connector": connector.stats(),
+        "memory": memory.stats() if memory else None
     }
 
-@app.post("/api/messages")
+@routes.post("/api/messages")
 async def messages(request: Request):
     """Endpoint para mensajes del Bot Framework"""
     try:
-        # Obtener el body del request
-        body = await request.json()
+        # Clasificar desde los bytes: typing, reacciones, etc. no llegan al modelo msrest
+        incoming = ingress.parse(await request.body())
+        if incoming.ignorable:
+            # El bot no haría nada con ella: se confirma sin autenticar ni deserializar
+            return ORJSONResponse(content={}, status_code=200)
         
         # Deserializar la actividad
-        activity = Activity().deserialize(body)
+        activity = incoming.to_activity()
         
         # Obtener header de autorización
         auth_header = request.headers.get("Authorization", "")
         
-        # Procesar la actividad
-        response = await adapter.process_activity(activity, auth_header, bot.on_turn)
+        # Autenticar antes de marcar la actividad como vista
+        identity = await adapter._authenticate_request(activity, auth_header)
+        key = activity_key(activity) if BOT_DEDUP_ENABLED else None
+        
+        # Modo asíncrono: validar, encolar y responder sin esperar al modelo
+        # (los invoke necesitan su respuesta en el mismo request)
+        if BOT_ASYNC_MODE and activity.type == "message" and activity.conversation:
+            if key and await dedup.begin(key) is not None:
+                logger.info("🔁 Actividad duplicada, ya encolada o respondida")
+                return ORJSONResponse(content={}, status_code=200)
+            if not _enqueue_turn(activity, identity, key):
+                logger.warning("⚠️ Cola de turnos llena, se rechaza la actividad")
+                if key:
+                    await dedup.release(key, RuntimeError("Cola de turnos llena"))
+                return ORJSONResponse(content={"error": "Bot ocupado"}, status_code=503, headers={"Retry-After": "5"})
+            return ORJSONResponse(content={}, status_code=200)
+        
+        # Procesar la actividad (un duplicado en curso recibe la misma respuesta)
+        response, _ = await dedup.run(
+            key,
+            lambda: adapter.process_activity_with_identity(activity, identity, bot.on_turn)
+        )
         
         # Retornar respuesta
         if response:
-            return JSONResponse(
+            return ORJSONResponse(
                 content=response.body,
                 status_code=response.status
             )
         
-        return JSONResponse(content={}, status_code=200)
+        return ORJSONResponse(content={}, status_code=200)
         
+    except PermissionError as e:
+        logger.warning(f"🔒 Actividad rechazada: {e}")
+        return ORJSONResponse(content={"error": "Unauthorized"}, status_code=401)
     except Exception as e:
         logger.error(f"❌ Error en /api/messages: {e}")
+        metrics.record_error("api_messages", e)
         raise HTTPException(status_code=500, detail=str(e))
 
+app.include_router(routes)
+
 @app.exception_handler(Exception)
 async def global_exception_handler(request: Request, exc: Exception):
     """Manejador global de excepciones"""
     logger.error(f"❌ Error global: {exc}")
-    return JSONResponse(
+    metrics.record_error("global", exc)
+    return ORJSONResponse(
         status_code=500,
         content={"error": "Error interno del servidor"}
     )
\ No newline at end of file
@@ -0,0 +1,3 @@
+"""
+Benchmarks offline: servidor Azure OpenAI simulado y driver de carga
+"""
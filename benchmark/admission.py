@@ -0,0 +1,158 @@
+"""
+Benchmark de la admisión con un usuario abusivo
+
+Contra chat.py y el Azure simulado, con una cuota RPM finita: un usuario manda
+peticiones sin pausa con mucha concurrencia y el resto pregunta de vez en
+cuando (cada uno con su IP en X-Forwarded-For). Se mide la latencia y los
+códigos de los usuarios normales, lo que consigue el abusivo y cuántas
+llamadas llegan a Azure, sin admisión y con ella.
+
+Uso:
+    python -m benchmark.admission --duration 30 --rpm 300 --output admission.json
+"""
+import argparse
+import asyncio
+import json
+import os
+import random
+import sys
+import time
+from collections import Counter
+from datetime import datetime, timezone
+
+import httpx
+
+from benchmark.run import (
+    QUESTIONS,
+    configure_environment,
+    free_port,
+    git_commit,
+    mock_stats,
+    start_mock,
+    summarize
+)
+
+SPAMMER = "10.0.0.1"
+
+
+def upstream_calls(counters: dict) -> int:
+    return counters["completions"] + counters["streams"] + counters["rate_limited"]
+
+
+async def scenario(args, app, mock_url: str) -> dict:
+    rng = random.Random(args.seed)
+    transport = httpx.ASGITransport(app=app)
+    normal_latencies = []
+    normal_status = Counter()
+    spammer_status = Counter()
+    stop_at = time.monotonic() + args.duration
+    upstream_before = upstream_calls(await mock_stats(mock_url))
+
+    async with httpx.AsyncClient(transport=transport, base_url="http://bench", timeout=120) as client:
+        async def post(ip: str):
+            body = {"message": f"{rng.choice(QUESTIONS)} ({rng.random():.6f})"}
+            return await client.post("/chat", json=body, headers={"X-Forwarded-For": ip})
+
+        async def spammer():
+            while time.monotonic() < stop_at:
+                response = await post(SPAMMER)
+                spammer_status[str(response.status_code)] += 1
+                if response.status_code == 503:
+                    # Ni siquiera respeta Retry-After: reintenta casi al momento
+                    await asyncio.sleep(0.05)
+
+        async def user(n: int):
+            await asyncio.sleep(rng.uniform(0, args.think_time))
+            while time.monotonic() < stop_at:
+                started = time.perf_counter()
+                response = await post(f"10.1.{n // 250}.{n % 250}")
+                normal_latencies.append(time.perf_counter() - started)
+                normal_status[str(response.status_code)] += 1
+                await asyncio.sleep(rng.expovariate(1 / args.think_time))
+
+        await asyncio.gather(
+            *(spammer() for _ in range(args.spammer_concurrency)),
+            *(user(n) for n in range(args.users))
+        )
+
+    return {
+        "normal_latency_ms": summarize(normal_latencies),
+        "normal_status": dict(normal_status),
+        "spammer_status": dict(spammer_status),
+        "upstream_calls": upstream_calls(await mock_stats(mock_url)) - upstream_before,
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark de la admisión con un usuario abusivo")
+    parser.add_argument("--duration", type=float, default=30.0, help="Segundos por escenario")
+    parser.add_argument("--users", type=int, default=30, help="Usuarios normales")
+    parser.add_argument("--think-time", type=float, default=2.0, help="Pausa media entre preguntas de un usuario")
+    parser.add_argument("--spammer-concurrency", type=int, default=40)
+    # El cubo empieza con un minuto de cuota: la duración tiene que agotarlo
+    parser.add_argument("--rpm", type=int, default=300, help="Cuota RPM del deployment simulado")
+    parser.add_argument("--latency-mean", type=float, default=0.5, help="Latencia del Azure simulado")
+    parser.add_argument("--seed", type=int, default=1)
+    parser.add_argument("--output", help="Fichero JSON de resultados")
+    args = parser.parse_args()
+
+    mock_args = argparse.Namespace(
+        latency="fixed", latency_mean=args.latency_mean, latency_sigma=0.5, tokens_per_second=0.0,
+        completion_tokens=50, rate_limit_prob=0.0, retry_after_ms=500, seed=args.seed,
+        bot_streaming=False, bot_async=False
+    )
+    port = free_port()
+    mock_url = f"http://127.0.0.1:{port}"
+    mock = start_mock(mock_args, port)
+    try:
+        os.environ["AZURE_OPENAI_RPM"] = str(args.rpm)
+        configure_environment(mock_url, mock_args)
+        import admission
+        import chat
+        import router
+
+        async def run_all() -> dict:
+            results = {}
+            async with chat.app.router.lifespan_context(chat.app):
+                for mode in ("off", "on"):
+                    print(f"▶️ Admisión {mode}...", file=sys.stderr)
+                    # Cuota y admisión desde cero en cada escenario
+                    router._router = None
+                    admission._controller = None
+                    if mode == "on":
+                        admission._controller = admission.AdmissionController(
+                            admission.ADMISSION_MAX_IN_FLIGHT,
+                            admission.ADMISSION_MAX_QUEUE,
+                            admission.ADMISSION_MAX_WAIT,
+                            admission.ADMISSION_USER_CONCURRENCY,
+                            admission.ADMISSION_USER_MAX_QUEUE,
+                            admission.ADMISSION_USER_RPM,
+                            admission.ADMISSION_USER_WEIGHTS
+                        )
+                    results[mode] = await scenario(args, chat.app, mock_url)
+                    if admission._controller is not None:
+                        results[mode]["admission"] = admission._controller.stats()
+            return results
+
+        results = asyncio.run(run_all())
+    finally:
+        mock.terminate()
+        mock.wait()
+
+    report = {
+        "meta": {
+            "timestamp": datetime.now(timezone.utc).isoformat(),
+            "git_commit": git_commit(),
+            "args": vars(args),
+        },
+        "results": results,
+    }
+    output = json.dumps(report, indent=2)
+    if args.output:
+        with open(args.output, "w") as f:
+            f.write(output + "\n")
+    print(output)
+
+
+if __name__ == "__main__":
+    main()
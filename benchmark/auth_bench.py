@@ -0,0 +1,198 @@
+"""
+Benchmark y comprobaciones de la autenticación de /api/messages
+
+Genera un par de claves RSA local, sirve sus metadatos OpenID desde
+benchmark.mock_azure y firma tokens como lo haría Bot Framework. Compara el
+CPU por validación del adapter del SDK con CachingBotFrameworkAdapter y
+verifica que los tokens inválidos se siguen rechazando.
+
+Uso:
+    python -m benchmark.auth_bench --iterations 500 --output auth.json
+"""
+import argparse
+import asyncio
+import json
+import os
+import sys
+import tempfile
+import time
+import uuid
+from datetime import datetime, timezone
+
+import httpx
+import jwt
+from cryptography.hazmat.primitives.asymmetric import rsa
+from jwt.algorithms import RSAAlgorithm
+
+from benchmark.run import configure_environment, free_port, git_commit, start_mock
+
+APP_ID = "bench-app-id"
+ISSUER = "https://api.botframework.com"
+
+
+def generate_key(kid: str):
+    """Clave privada y su JWK público con endorsement de Teams"""
+    private_key = rsa.generate_private_key(public_exponent=65537, key_size=2048)
+    jwk = json.loads(RSAAlgorithm.to_jwk(private_key.public_key()))
+    jwk.update({"kid": kid, "use": "sig", "endorsements": ["msteams"]})
+    return private_key, jwk
+
+
+def write_jwks(path: str, jwks: list):
+    with open(path, "w") as f:
+        json.dump({"keys": jwks}, f)
+
+
+def mint(private_key, kid: str, service_url: str, audience: str = APP_ID, expires_in: int = 3600) -> str:
+    now = int(time.time())
+    claims = {
+        "iss": ISSUER,
+        "aud": audience,
+        "serviceurl": service_url,
+        "nbf": now - 5,
+        "exp": now + expires_in,
+        "jti": uuid.uuid4().hex,
+    }
+    return "Bearer " + jwt.encode(claims, private_key, algorithm="RS256", headers={"kid": kid})
+
+
+def make_activity(service_url: str):
+    from botbuilder.schema import Activity
+    return Activity().deserialize({
+        "type": "message",
+        "id": uuid.uuid4().hex,
+        "serviceUrl": service_url,
+        "channelId": "msteams",
+        "from": {"id": "user"},
+        "recipient": {"id": "bot"},
+        "conversation": {"id": "conv"},
+        "text": "hola",
+    })
+
+
+async def time_validations(adapter, activity, headers) -> dict:
+    cpu_start = time.process_time()
+    started = time.perf_counter()
+    for header in headers:
+        await adapter._authenticate_request(activity, header)
+    wall = time.perf_counter() - started
+    cpu = time.process_time() - cpu_start
+    return {
+        "validations": len(headers),
+        "cpu_us_per_request": round(cpu / len(headers) * 1e6, 1),
+        "wall_us_per_request": round(wall / len(headers) * 1e6, 1),
+    }
+
+
+async def rejected(adapter, activity, header) -> bool:
+    try:
+        await adapter._authenticate_request(activity, header)
+    except Exception:
+        return True
+    return False
+
+
+async def main_async(args, mock_url: str, jwks_path: str, keys) -> dict:
+    # Imports después de configurar el entorno
+    from botbuilder.core import BotFrameworkAdapter, BotFrameworkAdapterSettings
+    import bot_auth
+
+    (private_key, kid, jwk) = keys
+    service_url = mock_url
+    activity = make_activity(service_url)
+    settings = BotFrameworkAdapterSettings(app_id=APP_ID, app_password="unused")
+    token = mint(private_key, kid, service_url)
+
+    # SDK sin cambios (metadatos con requests, clave pública rehecha en cada validación)
+    sdk = BotFrameworkAdapter(settings)
+    await sdk._authenticate_request(activity, token)
+    results = {"sdk_same_token": await time_validations(sdk, activity, [token] * args.iterations)}
+
+    await bot_auth.start()
+    cached = bot_auth.CachingBotFrameworkAdapter(settings)
+    await cached._authenticate_request(activity, token)
+    results["cached_same_token"] = await time_validations(cached, activity, [token] * args.iterations)
+    # Tokens distintos: siempre miss, pero con claves precargadas
+    fresh = [mint(private_key, kid, service_url) for _ in range(args.iterations)]
+    results["cached_unique_tokens"] = await time_validations(cached, activity, fresh)
+    results["auth_cache"] = cached.auth_cache.stats()
+
+    # La validación no se debilita
+    other_key, _ = generate_key("otro")
+    other_service = make_activity("https://otro.example.com")
+    results["checks"] = {
+        "wrong_signature_rejected": await rejected(cached, activity, mint(other_key, kid, service_url)),
+        "wrong_audience_rejected": await rejected(cached, activity, mint(private_key, kid, service_url, audience="otra-app")),
+        "expired_rejected": await rejected(cached, activity, mint(private_key, kid, service_url, expires_in=-600)),
+        "service_url_mismatch_rejected": await rejected(cached, other_service, token),
+        "tampered_rejected": await rejected(cached, activity, token[:-4] + "AAAA"),
+    }
+
+    # Rotación: la clave nueva se publica y el refresco en segundo plano la recoge
+    new_key, new_jwk = generate_key("kid-2")
+    write_jwks(jwks_path, [jwk, new_jwk])
+    for metadata in bot_auth._metadata:
+        await metadata.refresh()
+    started = time.perf_counter()
+    rotated_ok = not await rejected(cached, activity, mint(new_key, "kid-2", service_url))
+    results["checks"]["rotated_key_accepted"] = rotated_ok
+    results["rotated_first_validation_ms"] = round((time.perf_counter() - started) * 1000, 2)
+
+    await bot_auth.stop()
+    async with httpx.AsyncClient(base_url=mock_url) as client:
+        results["metadata_fetches"] = (await client.get("/mock/stats")).json()["openid"]
+    return results
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark de autenticación de Bot Framework")
+    parser.add_argument("--iterations", type=int, default=300)
+    parser.add_argument("--output", help="Fichero JSON de resultados")
+    args = parser.parse_args()
+
+    kid = "kid-1"
+    private_key, jwk = generate_key(kid)
+    jwks_path = os.path.join(tempfile.mkdtemp(prefix="bench-auth-"), "jwks.json")
+    write_jwks(jwks_path, [jwk])
+
+    port = free_port()
+    mock_url = f"http://127.0.0.1:{port}"
+    mock_args = argparse.Namespace(
+        latency="fixed", latency_mean=0.0, latency_sigma=0.5, tokens_per_second=0.0,
+        completion_tokens=10, rate_limit_prob=0.0, retry_after_ms=500, seed=1,
+        bot_streaming=False, bot_async=False
+    )
+    mock = start_mock(mock_args, port, ["--jwks-file", jwks_path])
+    try:
+        configure_environment(mock_url, mock_args)
+        os.environ["MicrosoftAppId"] = APP_ID
+        os.environ["MicrosoftAppPassword"] = "unused"
+        os.environ["BOT_OPENID_METADATA_URL"] = f"{mock_url}/openid/.well-known/openidconfiguration"
+        # El SDK sin parchear también debe ir al stand-in
+        from botframework.connector.auth import ChannelValidation
+        ChannelValidation.open_id_metadata_endpoint = os.environ["BOT_OPENID_METADATA_URL"]
+        results = asyncio.run(main_async(args, mock_url, jwks_path, (private_key, kid, jwk)))
+    finally:
+        mock.terminate()
+        mock.wait()
+
+    report = {
+        "meta": {
+            "timestamp": datetime.now(timezone.utc).isoformat(),
+            "git_commit": git_commit(),
+            "args": vars(args),
+        },
+        "results": results,
+    }
+    output = json.dumps(report, indent=2)
+    if args.output:
+        with open(args.output, "w") as f:
+            f.write(output + "\n")
+    print(output)
+    if not all(results["checks"].values()):
+        print("❌ Alguna comprobación de seguridad falló", file=sys.stderr)
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,170 @@
+"""
+Benchmark de la cancelación por desconexión (deadline.py)
+
+Levanta chat.py con uvicorn de verdad (las desconexiones tienen que ser cierres
+de TCP, no cancelaciones dentro de ASGITransport) contra el Azure simulado, que
+genera los tokens a ritmo fijo y deja de generar si se le cierra la conexión.
+Una parte de los clientes se cansa y cierra antes de recibir la respuesta,
+mitad con /chat y mitad con /chat/stream. Compara los tokens de respuesta que
+llega a generar Azure sin DeadlineMiddleware y con él.
+
+Uso:
+    python -m benchmark.deadline --requests 200 --abandon 0.3 --output deadline.json
+"""
+import argparse
+import asyncio
+import json
+import os
+import random
+import sys
+import time
+from datetime import datetime, timezone
+
+import httpx
+
+from benchmark.run import (
+    QUESTIONS,
+    configure_environment,
+    free_port,
+    git_commit,
+    mock_stats,
+    start_mock,
+    summarize
+)
+
+
+async def serve(app, port: int):
+    """Arranca uvicorn en este loop; devuelve el servidor y su tarea"""
+    import uvicorn
+    server = uvicorn.Server(uvicorn.Config(app, host="127.0.0.1", port=port, log_config=None, lifespan="on"))
+    task = asyncio.create_task(server.serve())
+    while not server.started:
+        await asyncio.sleep(0.05)
+    return server, task
+
+
+async def scenario(args, mode: str, base_url: str, mock_url: str) -> dict:
+    rng = random.Random(args.seed)
+    before = await mock_stats(mock_url)
+    latencies = []
+    outcomes = {"ok": 0, "abandoned": 0, "error": 0}
+    semaphore = asyncio.Semaphore(args.concurrency)
+    limits = httpx.Limits(max_connections=args.concurrency, max_keepalive_connections=args.concurrency)
+
+    async with httpx.AsyncClient(base_url=base_url, timeout=120, limits=limits) as client:
+        async def ask(n: int, stream: bool):
+            # Distintas en cada escenario: ninguna sale de la caché de respuestas
+            body = {"message": f"{rng.choice(QUESTIONS)} ({mode} #{n})"}
+            if not stream:
+                response = await client.post("/chat", json=body)
+                return response.status_code == 200
+            async with client.stream("POST", "/chat/stream", json=body) as response:
+                async for line in response.aiter_lines():
+                    if line.startswith("data: ") and '"done"' in line:
+                        return True
+            return False
+
+        async def one(n: int):
+            stream = n % 2 == 1
+            patience = rng.uniform(0.5, args.patience) if rng.random() < args.abandon else None
+            async with semaphore:
+                started = time.perf_counter()
+                try:
+                    # wait_for cancela la petición y httpx cierra la conexión: el cliente se va
+                    ok = await asyncio.wait_for(ask(n, stream), patience)
+                except asyncio.TimeoutError:
+                    outcomes["abandoned"] += 1
+                    return
+                if ok:
+                    outcomes["ok"] += 1
+                    latencies.append(time.perf_counter() - started)
+                else:
+                    outcomes["error"] += 1
+
+        started = time.perf_counter()
+        await asyncio.gather(*(one(n) for n in range(args.requests)))
+        elapsed = time.perf_counter() - started
+
+    # Lo que siguiera generándose para clientes que ya no están
+    await asyncio.sleep(args.settle)
+    after = await mock_stats(mock_url)
+    return {
+        "wall_s": round(elapsed, 2),
+        "outcomes": outcomes,
+        "latency_ms": summarize(latencies),
+        "upstream_completion_tokens": after["completion_tokens"] - before["completion_tokens"],
+        "upstream_abandoned": after["abandoned"] - before["abandoned"],
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark de la cancelación por desconexión")
+    parser.add_argument("--requests", type=int, default=200)
+    parser.add_argument("--concurrency", type=int, default=20)
+    parser.add_argument("--abandon", type=float, default=0.3, help="Fracción de clientes que se van antes de tiempo")
+    parser.add_argument("--patience", type=float, default=2.0, help="Máximo de segundos que aguanta quien se va")
+    parser.add_argument("--completion-tokens", type=int, default=300)
+    parser.add_argument("--tokens-per-second", type=float, default=60.0)
+    parser.add_argument("--settle", type=float, default=6.0, help="Espera al final para contar lo que siguió generándose")
+    parser.add_argument("--seed", type=int, default=1)
+    parser.add_argument("--output", help="Fichero JSON de resultados")
+    args = parser.parse_args()
+
+    mock_args = argparse.Namespace(
+        latency="fixed", latency_mean=0.3, latency_sigma=0.5, tokens_per_second=args.tokens_per_second,
+        completion_tokens=args.completion_tokens, rate_limit_prob=0.0, retry_after_ms=500, seed=args.seed,
+        bot_streaming=False, bot_async=False
+    )
+    mock_port = free_port()
+    mock_url = f"http://127.0.0.1:{mock_port}"
+    mock = start_mock(mock_args, mock_port)
+    try:
+        configure_environment(mock_url, mock_args)
+        os.environ.setdefault("LOG_LEVEL", "WARNING")
+        import chat
+        import deadline
+
+        async def run_all() -> dict:
+            results = {}
+            original = list(chat.app.user_middleware)
+            for mode in ("off", "on"):
+                print(f"▶️ Cancelación {mode}...", file=sys.stderr)
+                if mode == "off":
+                    chat.app.user_middleware = [m for m in original if m.cls is not deadline.DeadlineMiddleware]
+                else:
+                    chat.app.user_middleware = original
+                # Starlette monta la pila de middlewares en la primera petición
+                chat.app.middleware_stack = None
+                deadline._stats.update(cancelled=0, billed_tokens=0, saved_tokens=0)
+                port = free_port()
+                server, task = await serve(chat.app, port)
+                results[mode] = await scenario(args, mode, f"http://127.0.0.1:{port}", mock_url)
+                results[mode]["deadline"] = deadline.stats()
+                server.should_exit = True
+                await task
+                # El lifespan abrió el drenaje al apagar: el siguiente escenario empieza de cero
+                deadline._drain_until = None
+            return results
+
+        results = asyncio.run(run_all())
+    finally:
+        mock.terminate()
+        mock.wait()
+
+    report = {
+        "meta": {
+            "timestamp": datetime.now(timezone.utc).isoformat(),
+            "git_commit": git_commit(),
+            "args": vars(args),
+        },
+        "results": results,
+    }
+    output = json.dumps(report, indent=2)
+    if args.output:
+        with open(args.output, "w") as f:
+            f.write(output + "\n")
+    print(output)
+
+
+if __name__ == "__main__":
+    main()
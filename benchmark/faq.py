@@ -0,0 +1,98 @@
+"""
+Benchmark del atajo de preguntas frecuentes sobre faq.example.json
+
+Comprueba qué consultas responde la tabla y cuáles siguen al modelo (incluidas
+las que se parecen a una entrada pero preguntan otra cosa: negaciones,
+interrogativos distintos, palabras de más) y mide la latencia de cada consulta.
+Termina con código 1 si algún caso no da lo esperado.
+
+Uso:
+    python -m benchmark.faq --output faq.json
+"""
+import argparse
+import json
+import os
+import sys
+import time
+from datetime import datetime, timezone
+
+from benchmark.run import git_commit, summarize
+import faq
+
+EXAMPLE = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), "faq.example.json")
+
+# (consulta, id de la entrada esperada o None si debe ir al modelo)
+CASES = [
+    ("¿Cuándo se paga la nómina?", "nomina"),
+    ("donde veo mi nomina", "nomina"),
+    ("descargar nominas", "nomina"),
+    ("¿Como pido vacasiones?", "vacaciones"),
+    ("hola, ¿cómo pido vacaciones?", "vacaciones"),
+    ("cómo solicito vacaciones", "vacaciones"),
+    ("he olvidado la contraseña", "password"),
+    ("restablecer contrasena", "password"),
+    ("la VPN no funciona", "vpn"),
+    ("no me funciona la vpn", "vpn"),
+    ("configurar la vpn por favor", "vpn"),
+    # Parecidas a una entrada, pero es otra pregunta
+    ("¿Cuándo NO se paga la nómina?", None),
+    ("¿Por qué no me han pagado la nómina?", None),
+    ("cambio contraseña wifi", None),
+    ("¿Quién aprueba las vacaciones?", None),
+    ("¿Cuál es la capital de Francia?", None),
+]
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark del atajo de preguntas frecuentes")
+    parser.add_argument("--file", default=EXAMPLE, help="Tabla de respuestas (JSON)")
+    parser.add_argument("--repeat", type=int, default=200, help="Consultas por caso para medir la latencia")
+    parser.add_argument("--output", help="Fichero JSON de resultados")
+    args = parser.parse_args()
+
+    router = faq.FaqRouter(args.file)
+    router.load()
+    cases = []
+    latencies = []
+    for query, expected in CASES:
+        answer, score, runner_up = router.index.match(query)
+        got = router.lookup(query, "benchmark")
+        got_id = got.id if got else None
+        cases.append({
+            "query": query,
+            "expected": expected,
+            "got": got_id,
+            "ok": got_id == expected,
+            "score": round(score, 3),
+            "runner_up": round(runner_up, 3),
+        })
+        for _ in range(args.repeat):
+            started = time.perf_counter()
+            router.index.match(query)
+            latencies.append(time.perf_counter() - started)
+
+    failed = [case for case in cases if not case["ok"]]
+    report = {
+        "meta": {
+            "timestamp": datetime.now(timezone.utc).isoformat(),
+            "git_commit": git_commit(),
+            "args": vars(args),
+        },
+        "results": {
+            "cases": cases,
+            "failed": len(failed),
+            "latency_ms": summarize(latencies),
+        },
+    }
+    output = json.dumps(report, indent=2, ensure_ascii=False)
+    if args.output:
+        with open(args.output, "w") as f:
+            f.write(output + "\n")
+    print(output)
+    for case in failed:
+        print(f"❌ {case['query']!r}: se esperaba {case['expected']}, salió {case['got']}", file=sys.stderr)
+    sys.exit(1 if failed else 0)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,94 @@
+"""
+Coste de ingesta por tipo de actividad en /api/messages
+
+Compara, sin red ni autenticación, el camino anterior (json + Activity().deserialize
+para todo) con ingress.parse (orjson y deserialización solo de lo que el bot
+atiende), y la serialización de respuestas con JSONResponse frente a ORJSONResponse.
+
+Uso:
+    python -m benchmark.ingress_bench --iterations 5000 --output ingress.json
+"""
+import argparse
+import json
+import time
+from datetime import datetime, timezone
+
+from benchmark.run import QUESTIONS, activity_body, configure_environment, git_commit
+
+KINDS = ["message", "typing", "messageReaction", "conversationUpdate"]
+
+
+def cpu_us(fn, payloads) -> float:
+    """CPU total de aplicar fn a todos los payloads"""
+    started = time.process_time()
+    for payload in payloads:
+        fn(payload)
+    return time.process_time() - started
+
+
+def compare_cpu(before, after, payloads, rounds: int = 5) -> tuple:
+    """CPU por llamada (µs) de dos caminos, en rondas alternas y con la mejor de cada uno"""
+    best_before = best_after = float("inf")
+    for _ in range(rounds):
+        best_before = min(best_before, cpu_us(before, payloads))
+        best_after = min(best_after, cpu_us(after, payloads))
+    return (round(best_before / len(payloads) * 1e6, 2), round(best_after / len(payloads) * 1e6, 2))
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark de ingesta de actividades")
+    parser.add_argument("--iterations", type=int, default=3000)
+    parser.add_argument("--output", help="Fichero JSON de resultados")
+    args = parser.parse_args()
+
+    # No se llama al modelo: basta con que la config se pueda importar
+    configure_environment("http://127.0.0.1:9", argparse.Namespace(bot_streaming=False, bot_async=False))
+    from botbuilder.schema import Activity
+    from fastapi.responses import JSONResponse, ORJSONResponse
+
+    import ingress
+
+    def legacy(raw: bytes):
+        return Activity().deserialize(json.loads(raw))
+
+    def fast(raw: bytes):
+        incoming = ingress.parse(raw)
+        return None if incoming.ignorable else incoming.to_activity()
+
+    results = {}
+    for kind in KINDS:
+        payloads = [
+            json.dumps(activity_body(kind, n, "https://smba.trafficmanager.net/emea/", QUESTIONS[n % len(QUESTIONS)])).encode()
+            for n in range(args.iterations)
+        ]
+        before, after = compare_cpu(legacy, fast, payloads)
+        results[kind] = {
+            "legacy_cpu_us": before,
+            "ingress_cpu_us": after,
+            "speedup": round(before / after, 1) if after else None,
+            "ignored": ingress.parse(payloads[0]).ignorable,
+        }
+
+    # Respuesta típica de /chat y de /health
+    body = {"response": " ".join(QUESTIONS) * 4, "session_id": "a" * 32, "pool": {"in_flight": 3, "max": 100}}
+    bodies = [body] * args.iterations
+    before, after = compare_cpu(JSONResponse, ORJSONResponse, bodies)
+    results["response_encode"] = {"json_cpu_us": before, "orjson_cpu_us": after}
+
+    report = {
+        "meta": {
+            "timestamp": datetime.now(timezone.utc).isoformat(),
+            "git_commit": git_commit(),
+            "args": vars(args),
+        },
+        "results": results,
+    }
+    output = json.dumps(report, indent=2)
+    if args.output:
+        with open(args.output, "w") as f:
+            f.write(output + "\n")
+    print(output)
+
+
+if __name__ == "__main__":
+    main()
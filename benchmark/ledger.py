@@ -0,0 +1,148 @@
+"""
+Benchmark del libro de consumo (usage_ledger.py)
+
+Mide lo que cuesta anotar un consumo en el camino de la petición, el ritmo de
+volcado por lotes a SQLite y el tiempo de un informe por usuario y día sobre
+el acumulado diario frente a agrupar los eventos sueltos.
+
+Uso:
+    python -m benchmark.ledger --rows 1000000 --users 1000 --days 60 --output ledger.json
+"""
+import argparse
+import asyncio
+import json
+import os
+import random
+import sqlite3
+import sys
+import tempfile
+import time
+from datetime import datetime, timezone
+
+from benchmark.run import git_commit, summarize
+import usage_ledger
+
+OUTCOMES = ("ok",) * 90 + ("cache",) * 6 + ("rate_limited", "error", "cancelled", "coalesced")
+
+
+def events(rows: int, users: int, teams: int, days: int, seed: int):
+    """Eventos sintéticos repartidos en los últimos days días
+
+    Cada usuario entra casi siempre por la misma superficie y el router le
+    manda al mismo deployment salvo en failover.
+    """
+    rng = random.Random(seed)
+    now = time.time()
+    clients = ("Teams-Bot/1.0", "WebChat/1.0", "EvidenzeChat/1.0")
+    deployments = ("gpt-4o-sweden", "gpt-4o-eastus")
+    for _ in range(rows):
+        user = rng.randrange(users)
+        prompt = rng.randint(300, 3000)
+        yield (
+            now - rng.random() * days * 86400,
+            f"user{user}",
+            f"team{user % teams}",
+            clients[user % len(clients)],
+            deployments[rng.random() < 0.05],
+            prompt,
+            rng.randint(20, 500),
+            prompt // 1024 * 1024 if rng.random() < 0.8 else 0,
+            round(rng.uniform(300, 4000), 1),
+            rng.choice(OUTCOMES),
+        )
+
+
+def measure_record(ledger: usage_ledger.UsageLedger, calls: int) -> float:
+    """µs por record() (lo único que paga la petición)"""
+    started = time.perf_counter()
+    for _ in range(calls):
+        ledger.record("WebChat/1.0", "gpt-4o-sweden", 1200, 150, 1024, 0.8, "ok")
+    elapsed = time.perf_counter() - started
+    ledger._buffer.clear()
+    return round(elapsed / calls * 1e6, 2)
+
+
+def timed(fn, repeat: int = 5) -> list:
+    latencies = []
+    for _ in range(repeat):
+        started = time.perf_counter()
+        fn()
+        latencies.append(time.perf_counter() - started)
+    return latencies
+
+
+def raw_report(db_path: str, since: str):
+    """El mismo informe agrupando los eventos sueltos (sin acumulado)"""
+    db = sqlite3.connect(db_path)
+    try:
+        return db.execute(
+            "SELECT user_id, day, COUNT(*), SUM(prompt_tokens), SUM(completion_tokens), SUM(cached_tokens) "
+            "FROM usage_events WHERE day >= ? GROUP BY user_id, day",
+            (since,)
+        ).fetchall()
+    finally:
+        db.close()
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark del libro de consumo")
+    parser.add_argument("--rows", type=int, default=1_000_000)
+    parser.add_argument("--users", type=int, default=1000)
+    parser.add_argument("--teams", type=int, default=50)
+    parser.add_argument("--days", type=int, default=60)
+    parser.add_argument("--batch", type=int, default=2000, help="Eventos por volcado")
+    parser.add_argument("--seed", type=int, default=1)
+    parser.add_argument("--output", help="Fichero JSON de resultados")
+    args = parser.parse_args()
+
+    with tempfile.TemporaryDirectory() as root:
+        db_path = os.path.join(root, "usage.db")
+        ledger = usage_ledger.UsageLedger(db_path, buffer_size=100_000)
+        record_us = measure_record(ledger, 100_000)
+
+        print(f"▶️ Volcando {args.rows} eventos en lotes de {args.batch}...", file=sys.stderr)
+        started = time.perf_counter()
+        for event in events(args.rows, args.users, args.teams, args.days, args.seed):
+            ledger._buffer.append(event)
+            if len(ledger._buffer) == args.batch:
+                asyncio.run(ledger.flush())
+        asyncio.run(ledger.flush())
+        flush_s = time.perf_counter() - started
+
+        since = time.strftime("%Y-%m-%d", time.gmtime(time.time() - 30 * 86400))
+        rollup_rows = len(usage_ledger.aggregate(db_path, ("user", "day"), since=since))
+        with sqlite3.connect(db_path) as db:
+            daily_rows = db.execute("SELECT COUNT(*) FROM usage_daily").fetchone()[0]
+        results = {
+            "record_us": record_us,
+            "flush_rows_per_s": round(args.rows / flush_s),
+            "db_mb": round(os.path.getsize(db_path) / 2 ** 20, 1),
+            "daily_rows": daily_rows,
+            "report_rows": rollup_rows,
+            "report_user_day_ms": summarize(timed(
+                lambda: usage_ledger.aggregate(db_path, ("user", "day"), since=since)
+            )),
+            "report_user_ms": summarize(timed(
+                lambda: usage_ledger.aggregate(db_path, ("user",), since=since, limit=20)
+            )),
+            "raw_group_by_ms": summarize(timed(lambda: raw_report(db_path, since))),
+            "ledger": ledger.stats(),
+        }
+
+    report = {
+        "meta": {
+            "timestamp": datetime.now(timezone.utc).isoformat(),
+            "git_commit": git_commit(),
+            "args": vars(args),
+        },
+        "results": results,
+    }
+    output = json.dumps(report, indent=2)
+    if args.output:
+        with open(args.output, "w") as f:
+            f.write(output + "\n")
+    print(output)
+
+
+if __name__ == "__main__":
+    main()
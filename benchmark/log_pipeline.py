@@ -0,0 +1,164 @@
+"""
+Benchmark del coste de los logs para el event loop
+
+Simula peticiones concurrentes que escriben líneas de log como las de las
+apps hacia una tubería que se vacía a ritmo limitado (un recolector de logs
+lento o stdout de un contenedor con backpressure). Compara el handler
+síncrono de logging.basicConfig con la cola de logging_setup y mide:
+
+- tiempo total y p99 dentro de las llamadas al logger en el hilo del loop
+- retraso máximo del loop (una tarea que duerme 1 ms y mide cuánto tarda)
+- líneas escritas, descartadas y omitidas por muestreo
+
+Uso:
+    python -m benchmark.log_pipeline --requests 5000 --sink-kbps 256 --output logs.json
+"""
+import argparse
+import asyncio
+import json
+import logging
+import os
+import random
+import sys
+import threading
+import time
+import uuid
+from datetime import datetime, timezone
+
+from benchmark.run import QUESTIONS, git_commit, summarize
+
+
+class SlowSink:
+    """Tubería cuyo extremo de lectura se vacía a sink_kbps KB/s desde un hilo"""
+
+    def __init__(self, kbps: float):
+        read_fd, write_fd = os.pipe()
+        self.stream = os.fdopen(write_fd, "w", encoding="utf-8")
+        self._read = os.fdopen(read_fd, "rb", buffering=0)
+        self._kbps = kbps
+        self.bytes = 0
+        self._thread = threading.Thread(target=self._drain, daemon=True)
+        self._thread.start()
+
+    def _drain(self):
+        while True:
+            data = self._read.read(4096)
+            if not data:
+                return
+            self.bytes += len(data)
+            time.sleep(len(data) / (self._kbps * 1024))
+
+    def close(self):
+        self.stream.close()
+        self._thread.join()
+
+
+async def run_requests(args, log: logging.Logger, bind) -> dict:
+    """Peticiones concurrentes que registran como las apps; devuelve tiempos del loop"""
+    rng = random.Random(args.seed)
+    in_logging = []
+    lag = []
+    done = asyncio.Event()
+
+    async def ticker():
+        while not done.is_set():
+            started = time.perf_counter()
+            await asyncio.sleep(0.001)
+            lag.append(time.perf_counter() - started - 0.001)
+
+    async def request(n: int):
+        bind()
+        message = f"{rng.choice(QUESTIONS)} (consulta {n})"
+        lines = (
+            ("👤 Mensaje de Teams", {"user_name": f"Usuario {n % 50}", "user_message": message}),
+            ("⚡ Primer token en 180 ms", None),
+            ("Chat", {"user_message": message, "tokens": 850, "cached_prompt_tokens": 768, "cache": False}),
+            ("Petición atendida", {"method": "POST", "path": "/chat", "status": 200}),
+        )
+        for text, extra in lines:
+            started = time.perf_counter()
+            log.info(text, extra=extra)
+            in_logging.append(time.perf_counter() - started)
+            await asyncio.sleep(rng.uniform(0.0005, 0.002))
+
+    probe = asyncio.create_task(ticker())
+    semaphore = asyncio.Semaphore(args.concurrency)
+
+    async def limited(n: int):
+        async with semaphore:
+            await request(n)
+
+    started = time.perf_counter()
+    await asyncio.gather(*(limited(n) for n in range(args.requests)))
+    elapsed = time.perf_counter() - started
+    done.set()
+    await probe
+    return {
+        "wall_s": round(elapsed, 2),
+        "in_logging_total_ms": round(sum(in_logging) * 1000, 1),
+        "log_call_ms": summarize(in_logging),
+        "loop_lag_ms": summarize(lag),
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark del coste de los logs en el event loop")
+    parser.add_argument("--requests", type=int, default=5000)
+    parser.add_argument("--concurrency", type=int, default=50)
+    parser.add_argument("--sink-kbps", type=float, default=256, help="Ritmo al que se vacía la salida de logs")
+    parser.add_argument("--sample-rate", type=float, default=1.0, help="LOG_SAMPLE_RATE del modo cola")
+    parser.add_argument("--seed", type=int, default=1)
+    parser.add_argument("--output", help="Fichero JSON de resultados")
+    args = parser.parse_args()
+
+    log = logging.getLogger("bench")
+    root = logging.getLogger()
+    root.setLevel(logging.INFO)
+    results = {}
+
+    # Como antes: basicConfig, formato y escritura en el hilo del loop
+    print("▶️ Handler síncrono...", file=sys.stderr)
+    sink = SlowSink(args.sink_kbps)
+    handler = logging.StreamHandler(sink.stream)
+    handler.setFormatter(logging.Formatter("%(levelname)s:%(name)s:%(message)s"))
+    root.addHandler(handler)
+    results["sync"] = asyncio.run(run_requests(args, log, lambda: None))
+    root.removeHandler(handler)
+    sink.close()
+    results["sync"]["written_kb"] = round(sink.bytes / 1024, 1)
+
+    # Con la cola: la config se lee al importar logging_setup
+    print("▶️ Cola de logging_setup...", file=sys.stderr)
+    os.environ["LOG_SAMPLE_RATE"] = str(args.sample_rate)
+    import logging_setup
+    sink = SlowSink(args.sink_kbps)
+    logging_setup.setup(stream=sink.stream)
+
+    def bind():
+        # Lo que hace RequestLogMiddleware al entrar una petición
+        sampled = random.random() < logging_setup.LOG_SAMPLE_RATE
+        logging_setup._request.set((uuid.uuid4().hex[:16], time.perf_counter(), sampled))
+
+    results["queue"] = asyncio.run(run_requests(args, log, bind))
+    results["queue"]["handler"] = logging_setup._handler.stats()
+    logging_setup._stop()
+    sink.close()
+    results["queue"]["written_kb"] = round(sink.bytes / 1024, 1)
+
+    report = {
+        "meta": {
+            "timestamp": datetime.now(timezone.utc).isoformat(),
+            "git_commit": git_commit(),
+            "args": vars(args),
+        },
+        "results": results,
+    }
+    output = json.dumps(report, indent=2)
+    if args.output:
+        with open(args.output, "w") as f:
+            f.write(output + "\n")
+    print(output)
+
+
+if __name__ == "__main__":
+    main()
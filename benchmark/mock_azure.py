@@ -0,0 +1,307 @@
+"""
+Servidor local que imita Azure OpenAI chat/completions, el conector de Bot Framework
+y (con --jwks-file) los metadatos OpenID con las claves de firma de los tokens
+
+La caché de prefijos se imita como la del proveedor: el prefijo idéntico a uno
+ya visto, desde 1024 tokens y en tramos de 128, se informa en
+usage.prompt_tokens_details.cached_tokens y no paga --prefill-tokens-per-second.
+
+Uso:
+    python -m benchmark.mock_azure --port 9900 --latency lognormal --latency-mean 0.4 \\
+        --tokens-per-second 80 --completion-tokens 60 --rate-limit-prob 0.02
+"""
+import argparse
+import asyncio
+import hashlib
+import json
+import math
+import random
+import time
+import uuid
+
+from fastapi import FastAPI, Request
+from fastapi.responses import JSONResponse, Response, StreamingResponse
+
+WORDS = (
+    "el protocolo del estudio clínico define los criterios de inclusión y la monitorización "
+    "de los centros según las guías de buena práctica clínica y los procedimientos internos"
+).split()
+
+
+# ~4 caracteres por token, como la estimación de prompt_tokens
+CHARS_PER_TOKEN = 4
+PREFIX_BLOCK_TOKENS = 128
+PREFIX_MIN_TOKENS = 1024
+
+
+class PrefixCache:
+    """Hashes de los prefijos ya procesados, por tramos de PREFIX_BLOCK_TOKENS"""
+
+    def __init__(self, max_entries: int = 100000):
+        self.max_entries = max_entries
+        self._seen = {}
+
+    def lookup_and_store(self, messages: list) -> int:
+        """Tokens del prompt cubiertos por un prefijo ya visto"""
+        text = "".join(f"{m.get('role')}\x1f{m.get('content') or ''}\x1e" for m in messages)
+        block = PREFIX_BLOCK_TOKENS * CHARS_PER_TOKEN
+        digest = hashlib.sha256()
+        cached = 0
+        for end in range(block, len(text) + 1, block):
+            digest.update(text[end - block:end].encode())
+            key = digest.copy().digest()
+            if key in self._seen:
+                cached = end // CHARS_PER_TOKEN
+            else:
+                if len(self._seen) >= self.max_entries:
+                    self._seen.pop(next(iter(self._seen)))
+                self._seen[key] = True
+        return cached if cached >= PREFIX_MIN_TOKENS else 0
+
+
+class MockSettings:
+    """Comportamiento simulado (latencias, ritmo de tokens, 429)"""
+
+    def __init__(
+        self,
+        latency: str = "fixed",
+        latency_mean: float = 0.3,
+        latency_sigma: float = 0.5,
+        tokens_per_second: float = 0.0,
+        completion_tokens: int = 50,
+        rate_limit_prob: float = 0.0,
+        rate_limit_every: int = 0,
+        retry_after_ms: int = 500,
+        seed: int = 0,
+        jwks_file: str = "",
+        prefill_tokens_per_second: float = 0.0
+    ):
+        self.latency = latency
+        self.latency_mean = latency_mean
+        self.latency_sigma = latency_sigma
+        self.tokens_per_second = tokens_per_second
+        self.completion_tokens = completion_tokens
+        self.rate_limit_prob = rate_limit_prob
+        self.rate_limit_every = rate_limit_every
+        self.retry_after_ms = retry_after_ms
+        self.jwks_file = jwks_file
+        self.prefill_tokens_per_second = prefill_tokens_per_second
+        self.random = random.Random(seed)
+
+    def sample_latency(self) -> float:
+        """Latencia hasta el primer byte según la distribución configurada"""
+        mean = self.latency_mean
+        if mean <= 0:
+            return 0.0
+        if self.latency == "uniform":
+            return self.random.uniform(0, 2 * mean)
+        if self.latency == "exponential":
+            return self.random.expovariate(1 / mean)
+        if self.latency == "lognormal":
+            # mu ajustada para que la media sea latency_mean
+            sigma = self.latency_sigma
+            return self.random.lognormvariate(math.log(mean) - sigma ** 2 / 2, sigma)
+        return mean
+
+
+def create_app(settings: MockSettings) -> FastAPI:
+    app = FastAPI(title="Mock Azure OpenAI")
+    counters = {
+        "completions": 0,
+        "streams": 0,
+        "rate_limited": 0,
+        "connector": 0,
+        "openid": 0,
+        "prompt_tokens": 0,
+        "cached_tokens": 0,
+        # Tokens de respuesta generados de verdad (como Azure, se deja de generar si el cliente se va)
+        "completion_tokens": 0,
+        "abandoned": 0,
+    }
+    prefixes = PrefixCache()
+
+    def rate_limited() -> bool:
+        n = counters["completions"] + counters["streams"] + counters["rate_limited"]
+        if settings.rate_limit_every and (n + 1) % settings.rate_limit_every == 0:
+            return True
+        return settings.rate_limit_prob > 0 and settings.random.random() < settings.rate_limit_prob
+
+    def words(count: int) -> list:
+        return [WORDS[i % len(WORDS)] for i in range(count)]
+
+    @app.post("/openai/deployments/{deployment}/chat/completions")
+    async def chat_completions(deployment: str, request: Request):
+        body = await request.json()
+        if rate_limited():
+            counters["rate_limited"] += 1
+            return JSONResponse(
+                {"error": {"code": "429", "message": "Rate limit is exceeded (mock)"}},
+                status_code=429,
+                headers={
+                    "retry-after-ms": str(settings.retry_after_ms),
+                    "retry-after": str(max(settings.retry_after_ms // 1000, 1))
+                }
+            )
+
+        # Estimación burda: ~4 caracteres por token
+        prompt_tokens = sum(len(m.get("content") or "") for m in body["messages"]) // 4 + 4 * len(body["messages"])
+        completion_tokens = min(settings.completion_tokens, body.get("max_tokens") or settings.completion_tokens)
+        cached_tokens = min(prefixes.lookup_and_store(body["messages"]), prompt_tokens)
+        counters["prompt_tokens"] += prompt_tokens
+        counters["cached_tokens"] += cached_tokens
+        usage = {
+            "prompt_tokens": prompt_tokens,
+            "completion_tokens": completion_tokens,
+            "total_tokens": prompt_tokens + completion_tokens,
+            "prompt_tokens_details": {"cached_tokens": cached_tokens},
+        }
+        headers = {"x-ratelimit-remaining-requests": "1000", "x-ratelimit-remaining-tokens": "1000000"}
+        prefill = 0.0
+        if settings.prefill_tokens_per_second > 0:
+            prefill = (prompt_tokens - cached_tokens) / settings.prefill_tokens_per_second
+        await asyncio.sleep(settings.sample_latency() + prefill)
+        completion_id = f"chatcmpl-{uuid.uuid4().hex[:12]}"
+
+        if not body.get("stream"):
+            counters["completions"] += 1
+            if settings.tokens_per_second > 0:
+                # Generación por tramos de 0,1 s, comprobando si el cliente sigue ahí
+                generated = 0
+                step = max(int(settings.tokens_per_second / 10), 1)
+                while generated < completion_tokens:
+                    if await request.is_disconnected():
+                        counters["abandoned"] += 1
+                        return Response(status_code=499)
+                    batch = min(step, completion_tokens - generated)
+                    await asyncio.sleep(batch / settings.tokens_per_second)
+                    generated += batch
+                    counters["completion_tokens"] += batch
+            else:
+                counters["completion_tokens"] += completion_tokens
+            return JSONResponse({
+                "id": completion_id,
+                "object": "chat.completion",
+                "created": int(time.time()),
+                "model": deployment,
+                "choices": [{
+                    "index": 0,
+                    "message": {"role": "assistant", "content": " ".join(words(completion_tokens))},
+                    "finish_reason": "stop"
+                }],
+                "usage": usage
+            }, headers=headers)
+
+        counters["streams"] += 1
+        include_usage = (body.get("stream_options") or {}).get("include_usage", False)
+
+        def chunk(delta: dict, finish_reason=None, **extra) -> str:
+            data = {
+                "id": completion_id,
+                "object": "chat.completion.chunk",
+                "created": int(time.time()),
+                "model": deployment,
+                "choices": [{"index": 0, "delta": delta, "finish_reason": finish_reason}],
+                **extra
+            }
+            return f"data: {json.dumps(data)}\n\n"
+
+        async def events():
+            interval = 1 / settings.tokens_per_second if settings.tokens_per_second > 0 else 0
+            yield chunk({"role": "assistant", "content": ""})
+            try:
+                for word in words(completion_tokens):
+                    counters["completion_tokens"] += 1
+                    yield chunk({"content": word + " "})
+                    if interval:
+                        await asyncio.sleep(interval)
+            except asyncio.CancelledError:
+                # Starlette corta el stream cuando el cliente cierra la conexión
+                counters["abandoned"] += 1
+                raise
+            yield chunk({}, "stop")
+            if include_usage:
+                yield f"data: {json.dumps({'id': completion_id, 'object': 'chat.completion.chunk', 'choices': [], 'usage': usage})}\n\n"
+            yield "data: [DONE]\n\n"
+
+        return StreamingResponse(events(), media_type="text/event-stream", headers=headers)
+
+    # === Conector de Bot Framework (respuestas del bot) ===
+    @app.post("/v3/conversations/{conversation_id}/activities/{activity_id}")
+    async def reply_to_activity(conversation_id: str, activity_id: str):
+        counters["connector"] += 1
+        return {"id": uuid.uuid4().hex}
+
+    @app.put("/v3/conversations/{conversation_id}/activities/{activity_id}")
+    async def update_activity(conversation_id: str, activity_id: str):
+        counters["connector"] += 1
+        return {"id": activity_id}
+
+    @app.post("/v3/conversations/{conversation_id}/activities")
+    async def send_to_conversation(conversation_id: str):
+        counters["connector"] += 1
+        return {"id": uuid.uuid4().hex}
+
+    # === Metadatos OpenID de Bot Framework (claves generadas localmente) ===
+    @app.get("/openid/.well-known/openidconfiguration")
+    async def openid_configuration(request: Request):
+        counters["openid"] += 1
+        base = str(request.base_url).rstrip("/")
+        return {
+            "issuer": "https://api.botframework.com",
+            "jwks_uri": f"{base}/openid/keys",
+            "id_token_signing_alg_values_supported": ["RS256"],
+        }
+
+    @app.get("/openid/keys")
+    async def openid_keys():
+        # Se relee en cada petición: reescribir el fichero simula una rotación
+        with open(settings.jwks_file) as f:
+            return json.load(f)
+
+    @app.get("/mock/stats")
+    async def stats():
+        return counters
+
+    return app
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Azure OpenAI simulado para benchmarks")
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=9900)
+    parser.add_argument("--latency", choices=["fixed", "uniform", "exponential", "lognormal"], default="fixed")
+    parser.add_argument("--latency-mean", type=float, default=0.3, help="Segundos hasta el primer byte (media)")
+    parser.add_argument("--latency-sigma", type=float, default=0.5, help="Dispersión de la lognormal")
+    parser.add_argument("--tokens-per-second", type=float, default=0.0, help="Ritmo de generación (0 = instantáneo)")
+    parser.add_argument("--completion-tokens", type=int, default=50)
+    parser.add_argument("--rate-limit-prob", type=float, default=0.0, help="Probabilidad de responder 429")
+    parser.add_argument("--rate-limit-every", type=int, default=0, help="Responder 429 cada N peticiones")
+    parser.add_argument("--retry-after-ms", type=int, default=500)
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--jwks-file", default="", help="JWKS servido en /openid/keys")
+    parser.add_argument(
+        "--prefill-tokens-per-second", type=float, default=0.0,
+        help="Ritmo de proceso del prompt no cacheado (0 = instantáneo)"
+    )
+    args = parser.parse_args()
+
+    import uvicorn
+
+    settings = MockSettings(
+        latency=args.latency,
+        latency_mean=args.latency_mean,
+        latency_sigma=args.latency_sigma,
+        tokens_per_second=args.tokens_per_second,
+        completion_tokens=args.completion_tokens,
+        rate_limit_prob=args.rate_limit_prob,
+        rate_limit_every=args.rate_limit_every,
+        retry_after_ms=args.retry_after_ms,
+        seed=args.seed,
+        jwks_file=args.jwks_file,
+        prefill_tokens_per_second=args.prefill_tokens_per_second
+    )
+    uvicorn.run(create_app(settings), host=args.host, port=args.port, log_level="warning")
+
+
+if __name__ == "__main__":
+    main()
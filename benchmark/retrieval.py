@@ -0,0 +1,165 @@
+"""
+Benchmark del índice de recuperación con un corpus sintético
+
+Genera N ficheros de párrafos con vocabulario de tipo Zipf, indexa con el
+embedder de hash (sin red), reindexa tras cambiar un fichero y mide la
+latencia de consulta en búsqueda plana y con IVF, junto con el recall@k de IVF
+respecto a la búsqueda exacta.
+
+Uso:
+    python -m benchmark.retrieval --files 400 --paragraphs 120 --output retrieval.json
+"""
+import argparse
+import asyncio
+import json
+import os
+import random
+import sys
+import tempfile
+import time
+from datetime import datetime, timezone
+
+from benchmark.run import git_commit, summarize
+import retrieval
+
+# nprobe que recorre todas las listas (búsqueda exacta)
+FULL_SCAN = 10 ** 9
+
+
+def make_corpus(docs_dir: str, files: int, paragraphs: int, topics: int, seed: int) -> list:
+    """Escribe el corpus y devuelve (consulta, fichero de origen) tomadas de él
+
+    Cada fichero trata de un tema: la mayoría de sus palabras salen del
+    vocabulario propio del tema y el resto del vocabulario común (Zipf).
+    """
+    rng = random.Random(seed)
+    common = [f"comun{i}" for i in range(5000)]
+    common_weights = [1 / (i + 1) for i in range(len(common))]
+    queries = []
+    for n in range(files):
+        topic = [f"tema{n % topics}x{i}" for i in range(300)]
+        blocks = []
+        for _ in range(paragraphs):
+            size = rng.randint(40, 90)
+            words = rng.choices(topic, k=size * 7 // 10) + rng.choices(common, common_weights, k=size - size * 7 // 10)
+            rng.shuffle(words)
+            blocks.append(" ".join(words))
+            if rng.random() < 0.01:
+                queries.append((" ".join(rng.sample(words, 8)), f"doc{n:05d}.md"))
+        with open(os.path.join(docs_dir, f"doc{n:05d}.md"), "w", encoding="utf-8") as f:
+            f.write(f"# Documento {n}\n\n" + "\n\n".join(blocks))
+    return queries
+
+
+def measure_queries(index, embedder, queries, k: int, nprobe: int) -> list:
+    latencies = []
+    for query, _ in queries:
+        vector = embedder.embed_sync([query])[0]
+        started = time.perf_counter()
+        index.search(vector, k, nprobe)
+        latencies.append(time.perf_counter() - started)
+    return latencies
+
+
+def quality(index, embedder, queries, k: int, nprobe: int, topics: int) -> dict:
+    """Recall@k frente a la búsqueda exacta y aciertos del tema de origen en el top 1"""
+    found = on_topic = 0
+    for query, source in queries:
+        vector = embedder.embed_sync([query])[0]
+        exact = {row for row, _ in index.search(vector, k, FULL_SCAN)}
+        approx = index.search(vector, k, nprobe)
+        found += len(exact & {row for row, _ in approx})
+        if approx:
+            found_doc = int(index.chunks[approx[0][0]]["source"][3:8])
+            on_topic += found_doc % topics == int(source[3:8]) % topics
+    return {
+        "recall_at_k": round(found / (len(queries) * k), 3),
+        "top1_on_topic": round(on_topic / len(queries), 3),
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark del índice de recuperación")
+    parser.add_argument("--files", type=int, default=400)
+    parser.add_argument("--paragraphs", type=int, default=120, help="Párrafos por fichero")
+    parser.add_argument("--topics", type=int, default=100, help="Temas distintos del corpus")
+    parser.add_argument("--dim", type=int, default=512)
+    parser.add_argument("--chunk-tokens", type=int, default=300)
+    parser.add_argument("--k", type=int, default=4)
+    parser.add_argument("--nprobe", default="4,8,16")
+    parser.add_argument("--seed", type=int, default=1)
+    parser.add_argument("--output", help="Fichero JSON de resultados")
+    args = parser.parse_args()
+
+    embedder = retrieval.HashEmbedder(args.dim)
+    results = {}
+    with tempfile.TemporaryDirectory() as root:
+        docs_dir = os.path.join(root, "docs")
+        index_dir = os.path.join(root, "index")
+        os.makedirs(docs_dir)
+        print("▶️ Generando corpus...", file=sys.stderr)
+        queries = make_corpus(docs_dir, args.files, args.paragraphs, args.topics, args.seed)[:200]
+
+        for mode, ivf_min in (("flat", 10 ** 12), ("ivf", 1)):
+            print(f"▶️ Índice {mode}...", file=sys.stderr)
+            started = time.perf_counter()
+            summary = asyncio.run(retrieval.build_index(
+                docs_dir, index_dir, embedder, full=True, ivf_min_chunks=ivf_min, chunk_tokens=args.chunk_tokens
+            ))
+            build_s = time.perf_counter() - started
+
+            # Un fichero cambiado: solo ese se vuelve a embeber
+            changed = os.path.join(docs_dir, "doc00000.md")
+            with open(changed, "a", encoding="utf-8") as f:
+                f.write("\n\nPárrafo añadido para el reindexado incremental.")
+            started = time.perf_counter()
+            incremental = asyncio.run(retrieval.build_index(
+                docs_dir, index_dir, embedder, ivf_min_chunks=ivf_min, chunk_tokens=args.chunk_tokens
+            ))
+            incremental_s = time.perf_counter() - started
+
+            started = time.perf_counter()
+            index = retrieval.VectorIndex.load(index_dir)
+            load_ms = (time.perf_counter() - started) * 1000
+            # Primera pasada para traer las páginas del memmap a la caché del sistema
+            measure_queries(index, embedder, queries[:20], args.k, FULL_SCAN)
+
+            result = {
+                "chunks": summary["chunks"],
+                "vectors_mb": round(os.path.getsize(os.path.join(index_dir, index.meta["vectors"])) / 2 ** 20, 1),
+                "build_s": round(build_s, 2),
+                "incremental_s": round(incremental_s, 2),
+                "incremental_embedded_files": incremental["embedded"],
+                "load_ms": round(load_ms, 1),
+            }
+            if mode == "flat":
+                result["query_ms"] = summarize(measure_queries(index, embedder, queries, args.k, FULL_SCAN))
+                result.update(quality(index, embedder, queries, args.k, FULL_SCAN, args.topics))
+            else:
+                result["lists"] = len(index.centroids)
+                result["nprobe"] = {}
+                for nprobe in (int(n) for n in args.nprobe.split(",")):
+                    result["nprobe"][nprobe] = {
+                        "query_ms": summarize(measure_queries(index, embedder, queries, args.k, nprobe)),
+                        **quality(index, embedder, queries, args.k, nprobe, args.topics),
+                    }
+            results[mode] = result
+
+    report = {
+        "meta": {
+            "timestamp": datetime.now(timezone.utc).isoformat(),
+            "git_commit": git_commit(),
+            "args": vars(args),
+            "queries": len(queries),
+        },
+        "results": results,
+    }
+    output = json.dumps(report, indent=2)
+    if args.output:
+        with open(args.output, "w") as f:
+            f.write(output + "\n")
+    print(output)
+
+
+if __name__ == "__main__":
+    main()
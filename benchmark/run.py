@@ -0,0 +1,433 @@
+"""
+Driver de carga offline para chat.py, chat_m.py y app.py
+
+Arranca benchmark.mock_azure en un subproceso, apunta la configuración al mock
+y ejecuta cada app en este mismo proceso (ASGI, sin red en la entrada), de modo
+que el CPU y la memoria medidos son los de la app (más el driver).
+
+Uso:
+    python -m benchmark.run --targets chat,chat_m,bot --requests 300 --concurrency 20 \\
+        --latency lognormal --latency-mean 0.2 --output bench.json --baseline anterior.json
+"""
+import argparse
+import asyncio
+import gc
+import importlib
+import json
+import os
+import platform
+import random
+import resource
+import socket
+import subprocess
+import sys
+import tempfile
+import time
+import uuid
+from collections import Counter, defaultdict
+from datetime import datetime, timezone
+from typing import Awaitable, Callable, Dict, List, Optional
+
+import httpx
+
+DEPLOYMENT = "bench"
+
+QUESTIONS = [
+    "¿Cómo solicito vacaciones?",
+    "¿Dónde están los SOP de monitorización?",
+    "¿Qué es un CRF?",
+    "¿Cómo reporto un evento adverso grave?",
+    "¿Cuál es el horario de la oficina?",
+]
+
+
+def rss_mb() -> float:
+    """Memoria residente actual del proceso (MB)"""
+    try:
+        with open("/proc/self/status") as status:
+            for line in status:
+                if line.startswith("VmRSS:"):
+                    return int(line.split()[1]) / 1024
+    except OSError:
+        pass
+    # Sin /proc: máximo histórico (KB en Linux, bytes en macOS)
+    maxrss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return maxrss / (1024 * 1024 if sys.platform == "darwin" else 1024)
+
+
+def percentile(ordered: List[float], p: float) -> float:
+    if not ordered:
+        return 0.0
+    index = min(int(round(p / 100 * (len(ordered) - 1))), len(ordered) - 1)
+    return ordered[index]
+
+
+def git_commit() -> Optional[str]:
+    try:
+        return subprocess.run(
+            ["git", "rev-parse", "--short", "HEAD"],
+            capture_output=True, text=True, check=True
+        ).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def free_port() -> int:
+    with socket.socket() as sock:
+        sock.bind(("127.0.0.1", 0))
+        return sock.getsockname()[1]
+
+
+def start_mock(args, port: int, extra: Optional[List[str]] = None) -> subprocess.Popen:
+    """Lanza el Azure OpenAI simulado y espera a que acepte conexiones"""
+    command = [
+        sys.executable, "-m", "benchmark.mock_azure",
+        "--port", str(port),
+        "--latency", args.latency,
+        "--latency-mean", str(args.latency_mean),
+        "--latency-sigma", str(args.latency_sigma),
+        "--tokens-per-second", str(args.tokens_per_second),
+        "--completion-tokens", str(args.completion_tokens),
+        "--rate-limit-prob", str(args.rate_limit_prob),
+        "--retry-after-ms", str(args.retry_after_ms),
+        "--seed", str(args.seed),
+        "--prefill-tokens-per-second", str(getattr(args, "prefill_tokens_per_second", 0.0)),
+        *(extra or []),
+    ]
+    process = subprocess.Popen(command)
+    deadline = time.monotonic() + 15
+    while time.monotonic() < deadline:
+        try:
+            with socket.create_connection(("127.0.0.1", port), timeout=0.2):
+                return process
+        except OSError:
+            time.sleep(0.1)
+    process.kill()
+    raise RuntimeError("El mock de Azure OpenAI no arrancó")
+
+
+def configure_environment(mock_url: str, args):
+    """Variables de entorno antes de importar la config de las apps"""
+    os.environ["AZURE_OPENAI_ENDPOINT"] = mock_url
+    os.environ["AZURE_OPENAI_DEPLOYMENT_NAME"] = DEPLOYMENT
+    os.environ["AZURE_OPENAI_API_KEY"] = "bench"
+    os.environ.pop("AZURE_OPENAI_BACKENDS", None)
+    # Bot Framework sin autenticación (app id vacío)
+    os.environ["MicrosoftAppId"] = ""
+    os.environ["MicrosoftAppPassword"] = ""
+    # Cuota amplia: se mide la app, no el gobernador (salvo que se indique otra)
+    os.environ.setdefault("AZURE_OPENAI_RPM", "100000")
+    os.environ.setdefault("AZURE_OPENAI_TPM", "100000000")
+    # Todas las peticiones salen de la misma IP: sin admisión salvo que se pida (benchmark.admission)
+    os.environ.setdefault("ADMISSION_ENABLED", "false")
+    os.environ["BOT_STREAMING"] = "true" if args.bot_streaming else "false"
+    os.environ["BOT_STREAM_UPDATE_INTERVAL"] = "0.2"
+    os.environ["BOT_ASYNC_MODE"] = "true" if args.bot_async else "false"
+    # Memoria del bot en un fichero propio de la ejecución: nada de turnos de corridas anteriores
+    os.environ.setdefault("BOT_MEMORY_DB", os.path.join(tempfile.mkdtemp(prefix="bench-"), "bot_memory.db"))
+    if getattr(args, "prompt_context_file", None):
+        os.environ["PROMPT_CONTEXT_FILE"] = args.prompt_context_file
+
+
+class Recorder:
+    """Latencias y códigos de estado de un escenario"""
+
+    def __init__(self):
+        self.latencies: List[float] = []
+        self.by_tag: Dict[str, List[float]] = defaultdict(list)
+        self.status = Counter()
+        self.errors = 0
+
+    async def timed(self, request: Awaitable[httpx.Response], tag: Optional[str] = None) -> Optional[httpx.Response]:
+        started = time.perf_counter()
+        try:
+            response = await request
+        except Exception as e:
+            self.errors += 1
+            self.status[type(e).__name__] += 1
+            return None
+        elapsed = time.perf_counter() - started
+        self.latencies.append(elapsed)
+        if tag is not None:
+            self.by_tag[tag].append(elapsed)
+        self.status[str(response.status_code)] += 1
+        if response.status_code >= 400:
+            self.errors += 1
+        return response
+
+
+def summarize(latencies: List[float]) -> dict:
+    ordered = sorted(latencies)
+    return {
+        "p50": round(percentile(ordered, 50) * 1000, 2),
+        "p95": round(percentile(ordered, 95) * 1000, 2),
+        "p99": round(percentile(ordered, 99) * 1000, 2),
+        "mean": round(sum(ordered) / len(ordered) * 1000, 2) if ordered else 0.0,
+        "max": round(ordered[-1] * 1000, 2) if ordered else 0.0,
+    }
+
+
+# === ESCENARIOS ===
+# Cada escenario devuelve trabajos; un trabajo hace una o más peticiones
+
+Job = Callable[[httpx.AsyncClient, Recorder], Awaitable[None]]
+
+
+def chat_jobs(args, rng: random.Random, start: int = 0) -> List[Job]:
+    """Preguntas sueltas a chat.py /chat (una fracción repetida para la caché)"""
+    def job(n: int) -> Job:
+        if rng.random() < args.repeat_ratio:
+            message = rng.choice(QUESTIONS)
+        else:
+            message = f"{rng.choice(QUESTIONS)} (consulta {n})"
+
+        async def run(client: httpx.AsyncClient, recorder: Recorder):
+            await recorder.timed(client.post("/chat", json={"message": message}))
+        return run
+
+    return [job(n) for n in range(start, start + args.requests)]
+
+
+def chat_m_jobs(args, rng: random.Random, start: int = 0) -> List[Job]:
+    """Conversaciones de chat_m.py con historial creciente (un trabajo por sesión)"""
+    def conversation(n: int) -> Job:
+        async def run(client: httpx.AsyncClient, recorder: Recorder):
+            session_id = None
+            for turn in range(args.turns):
+                body = {"session_id": session_id, "message": f"{rng.choice(QUESTIONS)} (turno {turn} de {n})"}
+                response = await recorder.timed(client.post("/chat", json=body), tag=f"turn_{turn + 1}")
+                if response is not None and response.status_code == 200:
+                    session_id = response.json().get("session_id")
+        return run
+
+    return [conversation(n) for n in range(start, start + max(args.requests // args.turns, 1))]
+
+
+def activity_body(kind: str, n: int, service_url: str, text: str) -> dict:
+    """Actividad sintética de Teams del tipo indicado"""
+    body = {
+        "type": kind,
+        "id": uuid.uuid4().hex,
+        "timestamp": datetime.now(timezone.utc).isoformat(),
+        "serviceUrl": service_url,
+        "channelId": "msteams",
+        "from": {"id": f"user-{n % 50}", "name": "Bench"},
+        "recipient": {"id": "bot", "name": "Evidenze Bot"},
+        "conversation": {"id": f"conv-{n % 50}"},
+        "channelData": {"tenant": {"id": "bench-tenant"}},
+    }
+    if kind == "message":
+        body["text"] = text
+    elif kind == "messageReaction":
+        body["reactionsAdded"] = [{"type": "like"}]
+        body["replyToId"] = uuid.uuid4().hex
+    elif kind == "conversationUpdate":
+        # Solo el bot entra: no hay a quién saludar
+        body["membersAdded"] = [{"id": "bot", "name": "Evidenze Bot"}]
+    return body
+
+
+def parse_mix(spec: str) -> List[tuple]:
+    """'message:0.6,typing:0.3' -> [(tipo, peso), ...]"""
+    mix = []
+    for part in spec.split(","):
+        if not part.strip():
+            continue
+        kind, _, weight = part.partition(":")
+        mix.append((kind.strip(), float(weight or 1)))
+    return mix
+
+
+def bot_jobs(args, rng: random.Random, service_url: str, start: int = 0) -> List[Job]:
+    """Actividades sintéticas de Bot Framework contra app.py /api/messages"""
+    kinds, weights = zip(*parse_mix(args.bot_mix))
+
+    def activity(n: int) -> Job:
+        kind = rng.choices(kinds, weights)[0]
+        body = activity_body(kind, n, service_url, f"{rng.choice(QUESTIONS)} (mensaje {n})")
+
+        async def run(client: httpx.AsyncClient, recorder: Recorder):
+            await recorder.timed(client.post("/api/messages", json=body), tag=kind)
+        return run
+
+    return [activity(n) for n in range(start, start + args.requests)]
+
+
+TARGETS = {
+    "chat": "chat",
+    "chat_m": "chat_m",
+    "bot": "app",
+}
+
+# Qué agrupan las etiquetas del Recorder en cada escenario
+TAG_KINDS = {
+    "chat_m": "turn",
+    "bot": "type",
+}
+
+
+async def mock_stats(mock_url: str) -> dict:
+    async with httpx.AsyncClient(base_url=mock_url) as client:
+        return (await client.get("/mock/stats")).json()
+
+
+async def run_target(name: str, args, mock_url: str) -> dict:
+    module = importlib.import_module(TARGETS[name])
+    app = module.app
+    rng = random.Random(args.seed)
+    if name == "chat":
+        make_jobs = lambda start: chat_jobs(args, rng, start)
+    elif name == "chat_m":
+        make_jobs = lambda start: chat_m_jobs(args, rng, start)
+    else:
+        make_jobs = lambda start: bot_jobs(args, rng, mock_url, start)
+
+    transport = httpx.ASGITransport(app=app)
+    async with app.router.lifespan_context(app):
+        async with httpx.AsyncClient(transport=transport, base_url="http://bench", timeout=120) as client:
+            # Calentamiento (imports perezosos, pool, tokenizador) con mensajes
+            # distintos a los medidos para no precargar la caché
+            warmup = Recorder()
+            for job in make_jobs(args.requests)[:args.warmup]:
+                await job(client, warmup)
+
+            recorder = Recorder()
+            jobs = make_jobs(0)
+            queue: asyncio.Queue = asyncio.Queue()
+            for job in jobs:
+                queue.put_nowait(job)
+
+            async def worker():
+                while not queue.empty():
+                    job = queue.get_nowait()
+                    await job(client, recorder)
+
+            mock_before = await mock_stats(mock_url)
+            gc.collect()
+            rss_start = rss_mb()
+            cpu_start = time.process_time()
+            started = time.perf_counter()
+            await asyncio.gather(*(worker() for _ in range(args.concurrency)))
+            duration = time.perf_counter() - started
+            cpu = time.process_time() - cpu_start
+            gc.collect()
+            rss_end = rss_mb()
+            mock_after = await mock_stats(mock_url)
+
+    total = len(recorder.latencies) + sum(v for k, v in recorder.status.items() if not k.isdigit())
+    result = {
+        "requests": total,
+        "errors": recorder.errors,
+        "status": dict(recorder.status),
+        "duration_s": round(duration, 3),
+        "rps": round(total / duration, 2) if duration else 0.0,
+        "latency_ms": summarize(recorder.latencies),
+        "cpu_ms_per_request": round(cpu / total * 1000, 3) if total else 0.0,
+        "rss_mb_start": round(rss_start, 1),
+        "rss_mb_end": round(rss_end, 1),
+        "rss_growth_mb": round(rss_end - rss_start, 1),
+        "upstream": {key: mock_after[key] - mock_before.get(key, 0) for key in mock_after},
+    }
+    if recorder.by_tag:
+        result[f"latency_by_{TAG_KINDS[name]}_ms"] = {tag: summarize(values) for tag, values in recorder.by_tag.items()}
+    return result
+
+
+async def run_targets(targets: List[str], args, mock_url: str) -> dict:
+    # Un único event loop: el estado compartido (router, gobernadores) vive en él
+    results = {}
+    for name in targets:
+        print(f"▶️ {name}...", file=sys.stderr)
+        results[name] = await run_target(name, args, mock_url)
+    return results
+
+
+def compare(results: dict, baseline_path: str) -> List[str]:
+    """Diferencias de RPS, p95 y CPU contra una ejecución anterior"""
+    with open(baseline_path) as f:
+        baseline = json.load(f)["results"]
+    lines = []
+    for name, current in results.items():
+        before = baseline.get(name)
+        if before is None:
+            continue
+        for label, now, then in [
+            ("rps", current["rps"], before["rps"]),
+            ("p95_ms", current["latency_ms"]["p95"], before["latency_ms"]["p95"]),
+            ("cpu_ms_per_request", current["cpu_ms_per_request"], before["cpu_ms_per_request"]),
+        ]:
+            change = (now - then) / then * 100 if then else 0.0
+            lines.append(f"{name:8s} {label:20s} {then:10.2f} -> {now:10.2f} ({change:+.1f}%)")
+    return lines
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(description="Benchmark offline de los endpoints de chat y del bot")
+    parser.add_argument("--targets", default="chat,chat_m,bot", help="Lista separada por comas: chat, chat_m, bot")
+    parser.add_argument("--requests", type=int, default=200)
+    parser.add_argument("--concurrency", type=int, default=20)
+    parser.add_argument("--warmup", type=int, default=5)
+    parser.add_argument("--turns", type=int, default=8, help="Turnos por conversación en chat_m")
+    parser.add_argument("--repeat-ratio", type=float, default=0.0, help="Fracción de preguntas repetidas en chat")
+    parser.add_argument("--bot-streaming", action="store_true", help="El bot edita el mensaje token a token")
+    parser.add_argument("--bot-async", action="store_true", help="Webhook con ack inmediato y cola de turnos")
+    parser.add_argument(
+        "--bot-mix", default="message:1",
+        help="Mezcla de tipos de actividad del bot, p. ej. message:0.5,typing:0.3,messageReaction:0.1,conversationUpdate:0.1"
+    )
+    parser.add_argument("--latency", choices=["fixed", "uniform", "exponential", "lognormal"], default="fixed")
+    parser.add_argument("--latency-mean", type=float, default=0.1)
+    parser.add_argument("--latency-sigma", type=float, default=0.5)
+    parser.add_argument("--tokens-per-second", type=float, default=0.0)
+    parser.add_argument("--completion-tokens", type=int, default=50)
+    parser.add_argument("--rate-limit-prob", type=float, default=0.0)
+    parser.add_argument(
+        "--prefill-tokens-per-second", type=float, default=0.0,
+        help="Coste del prompt no cacheado en el mock (0 = sin coste)"
+    )
+    parser.add_argument("--prompt-context-file", help="PROMPT_CONTEXT_FILE de las apps (prefijo común)")
+    parser.add_argument("--retry-after-ms", type=int, default=500)
+    parser.add_argument("--seed", type=int, default=1)
+    parser.add_argument("--output", help="Fichero JSON de resultados")
+    parser.add_argument("--baseline", help="JSON de una ejecución anterior para comparar")
+    return parser.parse_args()
+
+
+def main():
+    args = parse_args()
+    targets = [t.strip() for t in args.targets.split(",") if t.strip()]
+    unknown = set(targets) - set(TARGETS)
+    if unknown:
+        raise SystemExit(f"Targets desconocidos: {', '.join(sorted(unknown))}")
+
+    port = free_port()
+    mock_url = f"http://127.0.0.1:{port}"
+    mock = start_mock(args, port)
+    try:
+        configure_environment(mock_url, args)
+        results = asyncio.run(run_targets(targets, args, mock_url))
+    finally:
+        mock.terminate()
+        mock.wait()
+
+    report = {
+        "meta": {
+            "timestamp": datetime.now(timezone.utc).isoformat(),
+            "git_commit": git_commit(),
+            "python": platform.python_version(),
+            "platform": platform.platform(),
+            "args": vars(args),
+        },
+        "results": results,
+    }
+    output = json.dumps(report, indent=2, ensure_ascii=False)
+    if args.output:
+        with open(args.output, "w") as f:
+            f.write(output + "\n")
+    print(output)
+    if args.baseline:
+        print("\n".join(compare(results, args.baseline)), file=sys.stderr)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,175 @@
+"""
+Coste de arranque: tiempo de import de cada app y memoria por worker de gunicorn
+
+- Import: cada módulo en un proceso nuevo (sin caché de módulos), con el tiempo
+  hasta poder servir (import + preload() si la app lo tiene) y la RSS resultante.
+- Workers: gunicorn con N workers uvicorn, con y sin --preload; RSS, PSS y
+  memoria compartida de cada worker (smaps_rollup) y tiempo hasta el primer 200.
+
+Uso:
+    python -m benchmark.startup --targets app,chat,chat_m --workers 4 --output startup.json
+"""
+import argparse
+import json
+import os
+import subprocess
+import sys
+import time
+from datetime import datetime, timezone
+from typing import Dict, List
+
+import httpx
+
+from benchmark.run import free_port, git_commit
+
+IMPORT_SNIPPET = """
+import json, time
+started = time.perf_counter()
+import {module} as target
+imported = time.perf_counter()
+if hasattr(target, "preload"):
+    target.preload()
+ready = time.perf_counter()
+rss = 0
+with open("/proc/self/status") as status:
+    for line in status:
+        if line.startswith("VmRSS:"):
+            rss = int(line.split()[1]) / 1024
+print(json.dumps({{"import_ms": (imported - started) * 1000, "ready_ms": (ready - started) * 1000, "rss_mb": rss}}))
+"""
+
+
+def environment() -> Dict[str, str]:
+    """Config válida sin red: el arranque no llega a llamar al modelo"""
+    env = dict(os.environ)
+    env.update({
+        "AZURE_OPENAI_ENDPOINT": "http://127.0.0.1:9",
+        "AZURE_OPENAI_DEPLOYMENT_NAME": "bench",
+        "AZURE_OPENAI_API_KEY": "bench",
+        "MicrosoftAppId": "",
+        "MicrosoftAppPassword": "",
+        "OPENAI_WARMUP": "false",
+    })
+    env.pop("AZURE_OPENAI_BACKENDS", None)
+    return env
+
+
+def measure_import(module: str, runs: int) -> dict:
+    samples = []
+    for _ in range(runs):
+        output = subprocess.run(
+            [sys.executable, "-c", IMPORT_SNIPPET.format(module=module)],
+            env=environment(), capture_output=True, text=True, check=True
+        ).stdout
+        samples.append(json.loads(output.strip().splitlines()[-1]))
+    # Mediana de cada medida
+    return {
+        key: round(sorted(sample[key] for sample in samples)[len(samples) // 2], 1)
+        for key in samples[0]
+    }
+
+
+def smaps(pid: int) -> dict:
+    """Rss, Pss y memoria compartida (MB) de un proceso"""
+    values = {}
+    with open(f"/proc/{pid}/smaps_rollup") as rollup:
+        for line in rollup:
+            parts = line.split()
+            if len(parts) >= 2 and parts[1].isdigit():
+                values[parts[0].rstrip(":")] = int(parts[1]) / 1024
+    return {
+        "rss_mb": round(values.get("Rss", 0), 1),
+        "pss_mb": round(values.get("Pss", 0), 1),
+        "shared_mb": round(values.get("Shared_Clean", 0) + values.get("Shared_Dirty", 0), 1),
+    }
+
+
+def children(pid: int) -> List[int]:
+    pids = []
+    for task in os.listdir(f"/proc/{pid}/task"):
+        with open(f"/proc/{pid}/task/{task}/children") as f:
+            pids.extend(int(child) for child in f.read().split())
+    return pids
+
+
+def measure_workers(module: str, workers: int, preload: bool) -> dict:
+    port = free_port()
+    env = environment()
+    env["GUNICORN_PRELOAD"] = "true" if preload else "false"
+    started = time.perf_counter()
+    process = subprocess.Popen(
+        [
+            sys.executable, "-m", "gunicorn", f"{module}:app",
+            "-c", "gunicorn.conf.py",
+            "--bind", f"127.0.0.1:{port}",
+            "--workers", str(workers),
+        ],
+        env=env, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL
+    )
+    try:
+        ready_ms = None
+        deadline = time.monotonic() + 60
+        while time.monotonic() < deadline and ready_ms is None:
+            try:
+                if httpx.get(f"http://127.0.0.1:{port}/", timeout=1).status_code < 500:
+                    ready_ms = (time.perf_counter() - started) * 1000
+            except httpx.HTTPError:
+                time.sleep(0.05)
+        if ready_ms is None:
+            raise RuntimeError(f"gunicorn {module}:app no arrancó")
+        # Todos los workers arrancados y con alguna petición atendida
+        while len(children(process.pid)) < workers and time.monotonic() < deadline:
+            time.sleep(0.1)
+        time.sleep(2)
+        for _ in range(workers * 10):
+            httpx.get(f"http://127.0.0.1:{port}/health", timeout=5)
+        per_worker = [smaps(pid) for pid in children(process.pid)]
+        return {
+            "ready_ms": round(ready_ms, 1),
+            "master": smaps(process.pid),
+            "workers": per_worker,
+            "worker_pss_mb_avg": round(sum(w["pss_mb"] for w in per_worker) / len(per_worker), 1),
+            "worker_rss_mb_avg": round(sum(w["rss_mb"] for w in per_worker) / len(per_worker), 1),
+            "total_pss_mb": round(smaps(process.pid)["pss_mb"] + sum(w["pss_mb"] for w in per_worker), 1),
+        }
+    finally:
+        process.terminate()
+        process.wait(timeout=30)
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark de arranque y memoria por worker")
+    parser.add_argument("--targets", default="app,chat,chat_m")
+    parser.add_argument("--runs", type=int, default=5, help="Imports por módulo (se toma la mediana)")
+    parser.add_argument("--workers", type=int, default=4)
+    parser.add_argument("--skip-gunicorn", action="store_true")
+    parser.add_argument("--output", help="Fichero JSON de resultados")
+    args = parser.parse_args()
+
+    results = {}
+    for module in args.targets.split(","):
+        print(f"▶️ {module}...", file=sys.stderr)
+        results[module] = {"import": measure_import(module, args.runs)}
+        if not args.skip_gunicorn:
+            results[module]["gunicorn"] = {
+                "preload": measure_workers(module, args.workers, preload=True),
+                "no_preload": measure_workers(module, args.workers, preload=False),
+            }
+
+    report = {
+        "meta": {
+            "timestamp": datetime.now(timezone.utc).isoformat(),
+            "git_commit": git_commit(),
+            "args": vars(args),
+        },
+        "results": results,
+    }
+    output = json.dumps(report, indent=2)
+    if args.output:
+        with open(args.output, "w") as f:
+            f.write(output + "\n")
+    print(output)
+
+
+if __name__ == "__main__":
+    main()
@@ -1,23 +1,96 @@
 """
 Bot Handler para Teams con Azure OpenAI
 """
+import asyncio
 import logging
 import os
-from typing import List
-from botbuilder.core import ActivityHandler, TurnContext
-from botbuilder.schema import ChannelAccount
-from openai import AsyncAzureOpenAI
+import time
+from typing import List, Optional, Tuple
+from botbuilder.core import ActivityHandler, MessageFactory, TurnContext
+from botbuilder.schema import Activity, ActivityTypes, ChannelAccount
+import admission
+import conversation_store
+import faq
+import llm
+import metrics
+import prompts
+import retrieval
+import usage_ledger
 from config import (
-    AZURE_OPENAI_ENDPOINT,
-    AZURE_OPENAI_API_VERSION,
-    AZURE_OPENAI_DEPLOYMENT_NAME,
-    SYSTEM_PROMPT,
-    MAX_TOKENS,
-    TEMPERATURE
+    BOT_STREAMING,
+    BOT_STREAM_UPDATE_INTERVAL,
+    BOT_PROGRESS_INDICATOR,
+    BOT_TYPING_INTERVAL,
+    BOT_MAX_MESSAGE_CHARS
 )
 
 logger = logging.getLogger(__name__)
 
+USER_AGENT = "Teams-Bot/1.0"
+
+# Si el modelo termina sin texto, el mensaje de progreso no se queda tal cual
+EMPTY_REPLY = "🤔 No obtuve una respuesta. Intenta reformular la consulta."
+
+def split_message(text: str, limit: int = BOT_MAX_MESSAGE_CHARS) -> List[str]:
+    """Parte una respuesta larga en trozos de como mucho limit caracteres
+    (por párrafo, línea o palabra si se puede)"""
+    parts = []
+    while len(text) > limit:
+        for separator in ("\n\n", "\n", " "):
+            cut = text.rfind(separator, limit // 2, limit)
+            if cut > 0:
+                break
+        else:
+            cut = limit
+        parts.append(text[:cut].rstrip())
+        text = text[cut:].lstrip()
+    if text:
+        parts.append(text)
+    return parts
+
+def _error_text(error: Exception) -> str:
+    """Lo que ve el usuario cuando falla el turno"""
+    if llm.retry_after(error) is not None:
+        return f"⏳ {llm.BUSY_MESSAGE}."
+    return "😔 No pude procesar tu consulta. Intenta de nuevo."
+
+def _account(activity: Activity) -> Tuple[str, str]:
+    """(usuario, equipo) de Teams a los que imputar el consumo del turno"""
+    sender = activity.from_property
+    user = (getattr(sender, "aad_object_id", None) or sender.id or "") if sender else ""
+    team = ((activity.channel_data or {}).get("team") or {}).get("id", "")
+    return user, team
+
+class TypingIndicator:
+    """Indicador nativo "escribiendo..." renovado hasta que se detiene"""
+    
+    def __init__(self, turn_context: TurnContext):
+        self._turn_context = turn_context
+        self._stop = asyncio.Event()
+        self._task: Optional[asyncio.Task] = None
+    
+    def start(self):
+        self._task = asyncio.create_task(self._run())
+    
+    async def stop(self):
+        """Espera al envío en curso para que no llegue después de la respuesta"""
+        if self._task is None:
+            return
+        self._stop.set()
+        await asyncio.gather(self._task, return_exceptions=True)
+        self._task = None
+    
+    async def _run(self):
+        try:
+            while not self._stop.is_set():
+                await self._turn_context.send_activity(Activity(type=ActivityTypes.typing))
+                try:
+                    await asyncio.wait_for(self._stop.wait(), BOT_TYPING_INTERVAL)
+                except asyncio.TimeoutError:
+                    pass
+        except Exception as e:
+            logger.warning(f"⚠️ No se pudo enviar el indicador de escritura: {e}")
+
 class TeamsOpenAIBot(ActivityHandler):
     """Bot que procesa mensajes de Teams con Azure OpenAI"""
     
@@ -34,7 +107,7 @@ class TeamsOpenAIBot(ActivityHandler):
         user_message = turn_context.activity.text.strip()
         user_name = turn_context.activity.from_property.name or "Usuario"
         
-        logger.info(f"👤 {user_name}: {user_message}")
+        logger.info("👤 Mensaje de Teams", extra={"user_name": user_name, "user_message": user_message})
         
         # Verificar API Key
         if not self.is_ready():
@@ -46,44 +119,158 @@ class TeamsOpenAIBot(ActivityHandler):
             await turn_context.send_activity(f"¡Hola {user_name}! 👋 ¿En qué puedo ayudarte?")
             return
         
+        # Preguntas frecuentes con respuesta fija: sin llamar al modelo
+        answer = faq.lookup(user_message, "teams")
+        if answer:
+            reply = answer.text()
+            await self._send_text(turn_context, reply)
+            self._remember(turn_context, user_message, reply)
+            return
+        
         # Procesar con OpenAI
         await self._process_message(turn_context, user_message, user_name)
     
     async def _process_message(self, turn_context: TurnContext, message: str, user_name: str):
         """Procesa el mensaje con OpenAI usando API Key"""
+        conversation = turn_context.activity.conversation
+        conversation_id = conversation.id if conversation else None
+        store = conversation_store.get_store()
+        typing = None
+        # Los workers de la cola de turnos son tareas de larga vida: se deshace al terminar
+        user, team = _account(turn_context.activity)
+        account = usage_ledger.set_account(user, team)
+        ticket = None
         try:
-            await turn_context.send_activity("🤔 Procesando...")
-            
-            # Crear cliente con API Key
-            client = AsyncAzureOpenAI(
-                azure_endpoint=AZURE_OPENAI_ENDPOINT,
-                api_version=AZURE_OPENAI_API_VERSION,
-                api_key=os.environ.get("AZURE_OPENAI_API_KEY"),
-                default_headers={"User-Agent": "Teams-Bot/1.0"}
-            )
+            # Plaza para el turno: si no la hay a tiempo, se avisa sin llegar a Azure
+            ticket = await admission.acquire(user or conversation_id or "", "teams")
+            # Turnos previos de la conversación (memoria compartida entre workers)
+            history = await store.history(conversation_id) if store and conversation_id else []
+            passages = await retrieval.context(message)
+            messages = prompts.build("teams", message, history, passages=passages)
+            # Solo las consultas sin contexto previo son cacheables
+            cacheable = not history
             
-            # Llamar a OpenAI
-            response = await client.chat.completions.create(
-                model=AZURE_OPENAI_DEPLOYMENT_NAME,
-                messages=[
-                    {"role": "system", "content": SYSTEM_PROMPT},
-                    {"role": "user", "content": f"Usuario: {user_name}\nConsulta: {message}"}
-                ],
-                max_tokens=MAX_TOKENS,
-                temperature=TEMPERATURE
-            )
+            activity_id = None
+            if BOT_PROGRESS_INDICATOR == "typing":
+                typing = TypingIndicator(turn_context)
+                typing.start()
+            else:
+                placeholder = await turn_context.send_activity("🤔 Procesando...")
+                activity_id = placeholder.id if placeholder else None
             
-            # Enviar respuesta
-            ai_response = response.choices[0].message.content
-            await turn_context.send_activity(ai_response)
+            if BOT_STREAMING and (typing or activity_id):
+                reply = await self._stream_reply(turn_context, messages, activity_id, typing, cacheable)
+            else:
+                # Llamar a OpenAI (o a la caché de respuestas)
+                completion = await llm.create_completion(messages, USER_AGENT, cacheable=cacheable)
+                reply = completion.text
+                
+                # Enviar respuesta (en varios mensajes si es muy larga)
+                if typing:
+                    await typing.stop()
+                await self._send_text(turn_context, reply)
+                
+                # Log de tokens
+                logger.info(f"💰 Tokens: {completion.total_tokens} (prefijo en caché: {completion.cached_tokens})")
             
-            # Log de tokens
-            usage = response.usage
-            logger.info(f"💰 Tokens: {usage.total_tokens}")
+            if reply:
+                self._remember(turn_context, message, reply)
             
+        except admission.Shed:
+            await turn_context.send_activity(f"⏳ {llm.BUSY_MESSAGE}.")
         except Exception as e:
             logger.error(f"❌ Error procesando mensaje: {e}")
-            await turn_context.send_activity("😔 No pude procesar tu consulta. Intenta de nuevo.")
+            metrics.record_error("bot", e)
+            if typing:
+                await typing.stop()
+            await turn_context.send_activity(_error_text(e))
+        finally:
+            if typing:
+                await typing.stop()
+            admission.release(ticket)
+            usage_ledger.reset_account(account)
+    
+    async def _stream_reply(
+        self,
+        turn_context: TurnContext,
+        messages: list,
+        activity_id: Optional[str],
+        typing: Optional[TypingIndicator],
+        cacheable: bool
+    ) -> str:
+        """Edita el mensaje a medida que llegan los tokens; devuelve el texto final
+        
+        Con el indicador "typing" no hay mensaje previo: se crea con el primer
+        texto y a partir de ahí se edita. Si la respuesta falla o llega vacía, el
+        mensaje ya mostrado (placeholder o vista previa) pasa a decirlo; si falla
+        sin haber mostrado nada, el error sube y se envía como mensaje.
+        """
+        stream = llm.CompletionStream(messages, USER_AGENT, cacheable=cacheable)
+        last_update = time.monotonic()
+        editable = True
+        
+        try:
+            async for _ in stream:
+                # Teams limita las ediciones: actualizar como mucho cada intervalo
+                if not editable or time.monotonic() - last_update < BOT_STREAM_UPDATE_INTERVAL:
+                    continue
+                preview = stream.text[:BOT_MAX_MESSAGE_CHARS] + " ▌"
+                if activity_id is None:
+                    if typing:
+                        await typing.stop()
+                    sent = await turn_context.send_activity(preview)
+                    activity_id = sent.id if sent else None
+                    editable = activity_id is not None
+                else:
+                    await self._update_text(turn_context, activity_id, preview)
+                last_update = time.monotonic()
+        except Exception as e:
+            if activity_id is None:
+                raise
+            logger.error(f"❌ Error en la respuesta en streaming: {e}")
+            metrics.record_error("bot", e)
+            if typing:
+                await typing.stop()
+            # Nada de vista previa a medias con el cursor: el error ocupa su lugar
+            await self._update_text(turn_context, activity_id, _error_text(e))
+            return ""
+        
+        if typing:
+            await typing.stop()
+        
+        # Versión final sin cursor; lo que no cabe va en mensajes adicionales
+        parts = split_message(stream.text) or [EMPTY_REPLY]
+        if parts and activity_id is not None:
+            await self._update_text(turn_context, activity_id, parts[0])
+            parts = parts[1:]
+        if parts:
+            await turn_context.send_activities([MessageFactory.text(part) for part in parts])
+        
+        if stream.usage:
+            logger.info(f"💰 Tokens: {stream.usage.total_tokens} (prefijo en caché: {metrics.cached_tokens(stream.usage)})")
+        return stream.text
+    
+    def _remember(self, turn_context: TurnContext, message: str, reply: str):
+        """Guarda el turno en la memoria de la conversación (si está activa)"""
+        store = conversation_store.get_store()
+        conversation = turn_context.activity.conversation
+        if store and conversation and conversation.id:
+            store.append(conversation.id, "user", message)
+            store.append(conversation.id, "assistant", reply)
+    
+    async def _send_text(self, turn_context: TurnContext, text: str):
+        """Envía la respuesta; si supera el límite de Teams, varios mensajes en un solo lote"""
+        parts = split_message(text)
+        if len(parts) == 1:
+            await turn_context.send_activity(parts[0])
+        elif parts:
+            await turn_context.send_activities([MessageFactory.text(part) for part in parts])
+    
+    async def _update_text(self, turn_context: TurnContext, activity_id: str, text: str):
+        """Reemplaza el texto de una actividad ya enviada"""
+        await turn_context.update_activity(
+            Activity(id=activity_id, type=ActivityTypes.message, text=text)
+        )
     
     async def on_members_added_activity(self, members_added: List[ChannelAccount], turn_context: TurnContext):
         """Saluda a nuevos miembros"""
@@ -0,0 +1,229 @@
+"""
+Camino rápido de autenticación para /api/messages
+
+- Caché acotada de tokens ya validados (clave: hash del header + serviceUrl +
+  canal), con expiración en el exp del propio token.
+- Metadatos OpenID y claves de firma precargados y refrescados en segundo plano:
+  el SDK los descarga con requests (bloqueante) dentro del event loop y
+  reconstruye la clave pública en cada validación.
+
+Un token que no está en caché pasa por la validación completa del SDK.
+"""
+import asyncio
+import hashlib
+import json
+import logging
+import time
+from collections import OrderedDict
+from typing import Dict, List, Optional, Tuple
+
+import httpx
+from botbuilder.core import BotFrameworkAdapter
+from botbuilder.schema import Activity
+from botframework.connector.auth import (
+    AuthenticationConstants,
+    ChannelValidation,
+    ClaimsIdentity,
+    JwtTokenExtractor
+)
+from botframework.connector.auth.jwt_token_extractor import _OpenIdConfig, _OpenIdMetadata
+from jwt.algorithms import RSAAlgorithm
+
+import metrics
+from config import (
+    BOT_AUTH_CACHE_ENABLED,
+    BOT_AUTH_CACHE_MAX_ENTRIES,
+    BOT_AUTH_CACHE_MAX_TTL,
+    BOT_OPENID_METADATA_URL,
+    BOT_EMULATOR_OPENID_METADATA_URL,
+    BOT_OPENID_REFRESH_INTERVAL
+)
+
+logger = logging.getLogger(__name__)
+
+# Mínimo entre refrescos forzados por un kid desconocido
+UNKNOWN_KID_REFRESH_INTERVAL = 300.0
+
+
+class PrefetchedOpenIdMetadata(_OpenIdMetadata):
+    """Sustituto de _OpenIdMetadata que no hace I/O bloqueante al validar
+
+    Las claves se descargan con httpx (async) y se convierten a clave pública una
+    sola vez por refresco.
+    """
+
+    def __init__(self, url: str):
+        super().__init__(url)
+        self._configs: Dict[str, _OpenIdConfig] = {}
+        self._attempted_at = 0.0
+        self._refreshing: Optional[asyncio.Task] = None
+        self.refreshes = 0
+        self.failures = 0
+
+    async def get(self, key_id: str):
+        config = self._configs.get(key_id)
+        if config is not None:
+            return config
+        # Kid desconocido (rotación aún no vista): como mucho un refresco cada tanto
+        if time.monotonic() - self._attempted_at >= UNKNOWN_KID_REFRESH_INTERVAL:
+            await self.refresh()
+        return self._configs.get(key_id)
+
+    async def refresh(self):
+        """Un único refresco en curso; los demás esperan al mismo"""
+        if self._refreshing is None or self._refreshing.done():
+            self._refreshing = asyncio.ensure_future(self._refresh())
+        await asyncio.shield(self._refreshing)
+
+    async def _refresh(self):
+        self._attempted_at = time.monotonic()
+        try:
+            async with httpx.AsyncClient(timeout=10.0) as client:
+                response = await client.get(self.url)
+                response.raise_for_status()
+                keys_response = await client.get(response.json()["jwks_uri"])
+                keys_response.raise_for_status()
+            keys = keys_response.json()["keys"]
+        except Exception as e:
+            self.failures += 1
+            logger.warning(f"⚠️ No se pudieron refrescar las claves OpenID de {self.url}: {e}")
+            return
+        configs = {}
+        for key in keys:
+            if key.get("kty") != "RSA" or "kid" not in key:
+                continue
+            configs[key["kid"]] = _OpenIdConfig(RSAAlgorithm.from_jwk(json.dumps(key)), key.get("endorsements", []))
+        self.keys = keys
+        self._configs = configs
+        self.refreshes += 1
+        logger.info(f"🔑 Claves OpenID actualizadas ({len(configs)}) desde {self.url}")
+
+
+class AuthCache:
+    """Identidades ya validadas por hash del token, hasta su exp"""
+
+    def __init__(self, max_entries: int, max_ttl: float):
+        self.max_entries = max_entries
+        self.max_ttl = max_ttl
+        # clave -> (expira en time.time(), identidad)
+        self._entries: "OrderedDict[str, Tuple[float, ClaimsIdentity]]" = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+
+    @staticmethod
+    def key(auth_header: str, activity: Activity) -> str:
+        # serviceUrl y canal forman parte de la validación (claim serviceurl, endorsements)
+        raw = "\x1f".join([auth_header, activity.service_url or "", activity.channel_id or ""])
+        return hashlib.sha256(raw.encode("utf-8")).hexdigest()
+
+    def get(self, key: str) -> Optional[ClaimsIdentity]:
+        entry = self._entries.get(key)
+        if entry is None:
+            self.misses += 1
+            return None
+        expires_at, identity = entry
+        if expires_at <= time.time():
+            del self._entries[key]
+            self.misses += 1
+            return None
+        self._entries.move_to_end(key)
+        self.hits += 1
+        return identity
+
+    def set(self, key: str, identity: ClaimsIdentity):
+        exp = identity.claims.get("exp")
+        if not isinstance(exp, (int, float)):
+            return
+        expires_at = min(float(exp), time.time() + self.max_ttl)
+        if expires_at <= time.time():
+            return
+        self._entries[key] = (expires_at, identity)
+        self._entries.move_to_end(key)
+        while len(self._entries) > self.max_entries:
+            self._entries.popitem(last=False)
+
+    def stats(self) -> dict:
+        lookups = self.hits + self.misses
+        return {
+            "entries": len(self._entries),
+            "hits": self.hits,
+            "misses": self.misses,
+            "hit_rate": round(self.hits / lookups, 3) if lookups else 0.0,
+        }
+
+
+class CachingBotFrameworkAdapter(BotFrameworkAdapter):
+    """BotFrameworkAdapter con caché de tokens validados"""
+
+    def __init__(self, settings):
+        super().__init__(settings)
+        self.auth_cache = AuthCache(BOT_AUTH_CACHE_MAX_ENTRIES, BOT_AUTH_CACHE_MAX_TTL)
+
+    async def _authenticate_request(self, request: Activity, auth_header: str) -> ClaimsIdentity:
+        if not auth_header or not BOT_AUTH_CACHE_ENABLED:
+            return await super()._authenticate_request(request, auth_header)
+        key = AuthCache.key(auth_header, request)
+        identity = self.auth_cache.get(key)
+        if identity is not None:
+            return identity
+        identity = await super()._authenticate_request(request, auth_header)
+        self.auth_cache.set(key, identity)
+        return identity
+
+
+_metadata: List[PrefetchedOpenIdMetadata] = []
+_refresher: Optional[asyncio.Task] = None
+
+
+def _install_metadata() -> List[PrefetchedOpenIdMetadata]:
+    """Registra los metadatos precargados en la caché de clase del SDK"""
+    if BOT_OPENID_METADATA_URL:
+        ChannelValidation.open_id_metadata_endpoint = BOT_OPENID_METADATA_URL
+    channel_url = ChannelValidation.open_id_metadata_endpoint or AuthenticationConstants.TO_BOT_FROM_CHANNEL_OPENID_METADATA_URL
+    emulator_url = AuthenticationConstants.TO_BOT_FROM_EMULATOR_OPENID_METADATA_URL
+
+    installed = []
+    # (clave en la caché del SDK, URL desde la que se descarga)
+    for cache_url, fetch_url in [
+        (channel_url, channel_url),
+        (emulator_url, BOT_EMULATOR_OPENID_METADATA_URL or emulator_url),
+    ]:
+        metadata = PrefetchedOpenIdMetadata(fetch_url)
+        JwtTokenExtractor.metadataCache[cache_url] = metadata
+        installed.append(metadata)
+    return installed
+
+
+async def _refresh_loop():
+    while True:
+        await asyncio.sleep(BOT_OPENID_REFRESH_INTERVAL)
+        for metadata in _metadata:
+            await metadata.refresh()
+
+
+async def start():
+    """Precarga las claves de firma y lanza el refresco periódico"""
+    global _metadata, _refresher
+    if not _metadata:
+        _metadata = _install_metadata()
+    await asyncio.gather(*(metadata.refresh() for metadata in _metadata))
+    _refresher = asyncio.create_task(_refresh_loop())
+
+
+async def stop():
+    global _refresher
+    if _refresher is not None:
+        _refresher.cancel()
+        await asyncio.gather(_refresher, return_exceptions=True)
+        _refresher = None
+
+
+def stats() -> List[dict]:
+    """Estado de las claves precargadas por URL de metadatos"""
+    return [
+        {"url": m.url, "keys": len(m._configs), "refreshes": m.refreshes, "failures": m.failures}
+        for m in _metadata
+    ]
+
+
+metrics.register_stats("bot_openid", stats, label="url")
@@ -1,26 +1,59 @@
 """
 Chatbot Web con Azure OpenAI
 """
-import os
 import logging
-from fastapi import FastAPI, Request, Form
-from fastapi.responses import HTMLResponse, JSONResponse
-from openai import AsyncAzureOpenAI
-from config import (
-    AZURE_OPENAI_ENDPOINT,
-    AZURE_OPENAI_API_VERSION,
-    AZURE_OPENAI_DEPLOYMENT_NAME,
-    SYSTEM_PROMPT,
-    MAX_TOKENS,
-    TEMPERATURE
-)
+from contextlib import asynccontextmanager
+from functools import lru_cache
+from fastapi import APIRouter, FastAPI, Request, Form
+from fastapi.responses import HTMLResponse, ORJSONResponse, StreamingResponse
+import admission
+import config
+import deadline
+import faq
+import llm
+import logging_setup
+import metrics
+import openai_client
+import prompts
+import retrieval
+import response_cache
+import router
+import usage_ledger
 
 # Configurar logging
-logging.basicConfig(level=logging.INFO)
+logging_setup.setup()
 logger = logging.getLogger(__name__)
 
-# Crear app FastAPI
-app = FastAPI(title="Chatbot Web Evidenze")
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+    """Abre el pool de Azure OpenAI al arrancar y lo cierra al apagar"""
+    config.validate()
+    await openai_client.startup()
+    await usage_ledger.start()
+    yield
+    deadline.begin_drain()
+    await usage_ledger.stop()
+    await openai_client.shutdown()
+
+# Crear app FastAPI (las rutas van en routes para poder montarlas en service.py)
+app = FastAPI(lifespan=lifespan, title="Chatbot Web Evidenze", default_response_class=ORJSONResponse)
+metrics.instrument(app)
+logging_setup.instrument(app)
+admission.instrument(app)
+deadline.instrument(app)
+routes = APIRouter()
+
+USER_AGENT = "WebChat/1.0"
+# Sin autenticación delante, los consumos del chat web se imputan a este usuario
+ANONYMOUS_USER = "anonimo"
+
+def preload():
+    """Abre el índice de recuperación antes del fork (gunicorn --preload)"""
+    retrieval.preload()
+
+async def _build_messages(user_message: str) -> list:
+    """Mensajes para una consulta sin historial, con la documentación que venga al caso"""
+    return prompts.build("chat", user_message, passages=await retrieval.context(user_message))
 
 # HTML para la interfaz
 HTML_TEMPLATE = """
@@ -65,6 +98,9 @@ HTML_TEMPLATE = """
     </div>
 
     <script>
+        // Ruta base del chat (vacía si se sirve en la raíz)
+        const BASE = '__BASE__';
+        
         async function sendMessage() {
             const input = document.getElementById('message-input');
             const message = input.value.trim();
@@ -82,21 +118,30 @@ HTML_TEMPLATE = """
             document.getElementById('chat-container').appendChild(loadingDiv);
             
             try {
-                // Enviar mensaje al backend
-                const response = await fetch('/chat', {
+                // Enviar mensaje al backend y leer la respuesta en streaming
+                const response = await fetch(BASE + '/chat/stream', {
                     method: 'POST',
                     headers: { 'Content-Type': 'application/json' },
                     body: JSON.stringify({ message: message })
                 });
                 
-                const data = await response.json();
+                if (!response.ok || !response.body) {
+                    throw new Error('HTTP ' + response.status);
+                }
                 
-                // Remover indicador de carga
-                loadingDiv.remove();
+                let botDiv = null;
+                const ok = await readStream(response, function(delta) {
+                    // Remover indicador de carga con el primer token
+                    if (!botDiv) {
+                        loadingDiv.remove();
+                        botDiv = addMessage('', 'bot-message');
+                    }
+                    botDiv.textContent += delta;
+                    scrollToBottom();
+                });
                 
-                if (data.response) {
-                    addMessage(data.response, 'bot-message');
-                } else {
+                loadingDiv.remove();
+                if (!ok && !botDiv) {
                     addMessage('Error: No se pudo procesar tu mensaje', 'bot-message');
                 }
             } catch (error) {
@@ -105,6 +150,33 @@ HTML_TEMPLATE = """
             }
         }
         
+        async function readStream(response, onDelta) {
+            // Parser mínimo de Server-Sent Events
+            const reader = response.body.getReader();
+            const decoder = new TextDecoder();
+            let buffer = '';
+            while (true) {
+                const { value, done } = await reader.read();
+                if (done) return false;
+                buffer += decoder.decode(value, { stream: true });
+                let sep;
+                while ((sep = buffer.indexOf('\\n\\n')) !== -1) {
+                    const line = buffer.slice(0, sep);
+                    buffer = buffer.slice(sep + 2);
+                    if (!line.startsWith('data: ')) continue;
+                    const event = JSON.parse(line.slice(6));
+                    if (event.delta) onDelta(event.delta);
+                    if (event.done) return true;
+                    if (event.error) return false;
+                }
+            }
+        }
+        
+        function scrollToBottom() {
+            const chatContainer = document.getElementById('chat-container');
+            chatContainer.scrollTop = chatContainer.scrollHeight;
+        }
+        
         function addMessage(text, className) {
             const chatContainer = document.getElementById('chat-container');
             const messageDiv = document.createElement('div');
@@ -112,6 +184,7 @@ HTML_TEMPLATE = """
             messageDiv.textContent = text;
             chatContainer.appendChild(messageDiv);
             chatContainer.scrollTop = chatContainer.scrollHeight;
+            return messageDiv;
         }
         
         function handleKeyPress(event) {
@@ -124,12 +197,17 @@ HTML_TEMPLATE = """
 </html>
 """
 
-@app.get("/", response_class=HTMLResponse)
-async def root():
+@lru_cache(maxsize=8)
+def _page(base: str) -> str:
+    """HTML con las llamadas a la API bajo la ruta en la que se sirve la página"""
+    return HTML_TEMPLATE.replace("__BASE__", base)
+
+@routes.get("/", response_class=HTMLResponse)
+async def root(request: Request):
     """Página principal del chatbot"""
-    return HTML_TEMPLATE
+    return _page(request.url.path.rstrip("/"))
 
-@app.post("/chat")
+@routes.post("/chat")
 async def chat(request: Request):
     """Endpoint para procesar mensajes del chat"""
     try:
@@ -138,40 +216,85 @@ async def chat(request: Request):
         user_message = body.get("message", "").strip()
         
         if not user_message:
-            return JSONResponse({"error": "Mensaje vacío"}, status_code=400)
+            return ORJSONResponse({"error": "Mensaje vacío"}, status_code=400)
         
-        # Crear cliente OpenAI
-        client = AsyncAzureOpenAI(
-            azure_endpoint=AZURE_OPENAI_ENDPOINT,
-            api_version=AZURE_OPENAI_API_VERSION,
-            api_key=os.environ.get("AZURE_OPENAI_API_KEY"),
-            default_headers={"User-Agent": "WebChat/1.0"}
-        )
+        # Cada petición corre en su propio contexto: no hace falta deshacerlo
+        usage_ledger.set_account(usage_ledger.web_user(request.headers, ANONYMOUS_USER))
         
-        # Llamar a OpenAI
-        response = await client.chat.completions.create(
-            model=AZURE_OPENAI_DEPLOYMENT_NAME,
-            messages=[
-                {"role": "system", "content": SYSTEM_PROMPT},
-                {"role": "user", "content": user_message}
-            ],
-            max_tokens=MAX_TOKENS,
-            temperature=TEMPERATURE
-        )
+        # Preguntas frecuentes con respuesta fija: sin llamar al modelo
+        answer = faq.lookup(user_message, "chat")
+        if answer:
+            return ORJSONResponse({"response": answer.text(), "faq": answer.id})
+        
+        # Plaza para el turno (límites por usuario); sin ella no se llega a Azure
+        await admission.admit(request, "chat")
         
-        # Extraer respuesta
-        ai_response = response.choices[0].message.content
+        # Llamar a OpenAI
+        completion = await llm.create_completion(await _build_messages(user_message), USER_AGENT, cacheable=True)
         
         # Log para monitoreo
-        logger.info(f"Chat - Usuario: {user_message[:50]}... | Tokens: {response.usage.total_tokens}")
+        logger.info("Chat", extra={
+            "user_message": user_message,
+            "tokens": completion.total_tokens,
+            "cached_prompt_tokens": completion.cached_tokens,
+            "cache": completion.cached
+        })
         
-        return JSONResponse({"response": ai_response})
+        return ORJSONResponse({"response": completion.text})
         
+    except admission.Shed as e:
+        return admission.shed_response(e)
     except Exception as e:
         logger.error(f"Error en chat: {e}")
-        return JSONResponse({"error": "Error procesando mensaje"}, status_code=500)
+        metrics.record_error("chat", e)
+        wait = llm.retry_after(e)
+        if wait is not None:
+            # Sin cupo en Azure: 503 con Retry-After en vez de un 500
+            return ORJSONResponse(
+                {"error": llm.BUSY_MESSAGE},
+                status_code=503,
+                headers={"Retry-After": str(max(int(wait), 1))}
+            )
+        return ORJSONResponse({"error": "Error procesando mensaje"}, status_code=500)
 
-@app.get("/health")
+@routes.post("/chat/stream")
+async def chat_stream(request: Request):
+    """Endpoint de chat con respuesta token a token (Server-Sent Events)"""
+    body = await request.json()
+    user_message = body.get("message", "").strip()
+    
+    if not user_message:
+        return ORJSONResponse({"error": "Mensaje vacío"}, status_code=400)
+    
+    usage_ledger.set_account(usage_ledger.web_user(request.headers, ANONYMOUS_USER))
+    answer = faq.lookup(user_message, "chat")
+    if answer:
+        events = llm.sse_text(answer.text(), faq=answer.id)
+    else:
+        try:
+            await admission.admit(request, "chat")
+        except admission.Shed as e:
+            return admission.shed_response(e)
+        events = llm.sse_stream(
+            llm.CompletionStream(await _build_messages(user_message), USER_AGENT, cacheable=True)
+        )
+    return StreamingResponse(
+        events,
+        media_type="text/event-stream",
+        headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"}
+    )
+
+@routes.get("/health")
 async def health():
     """Health check"""
-    return {"status": "healthy", "service": "chatbot-web"}
\ No newline at end of file
+    cache = response_cache.get_cache()
+    return {
+        "status": "healthy",
+        "service": "chatbot-web",
+        "pool": openai_client.pool_stats(),
+        "cache": cache.stats() if cache else None,
+        "singleflight": llm.flight.stats(),
+        "router": router.get_router().stats()
+    }
+
+app.include_router(routes)
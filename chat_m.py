@@ -1,26 +1,89 @@
 """
 Chatbot Web con Azure OpenAI - Evidenze con Memoria de Sesión
 """
-import os
 import logging
-from fastapi import FastAPI, Request
-from fastapi.responses import HTMLResponse, JSONResponse
-from openai import AsyncAzureOpenAI
+from contextlib import asynccontextmanager
+from functools import lru_cache
+from typing import Optional, Tuple
+from fastapi import APIRouter, FastAPI, Request
+from fastapi.responses import HTMLResponse, ORJSONResponse, StreamingResponse
+import admission
+import config
+import deadline
+import faq
+import llm
+import logging_setup
+import metrics
+import openai_client
+import retrieval
+import router
+import usage_ledger
+from history import HistoryManager
+from tokens import warmup as warmup_tokenizer
+from session_store import SessionNotFound, SessionStore
 from config import (
-    AZURE_OPENAI_ENDPOINT,
-    AZURE_OPENAI_API_VERSION,
-    AZURE_OPENAI_DEPLOYMENT_NAME,
-    SYSTEM_PROMPT,
-    MAX_TOKENS,
-    TEMPERATURE
+    CHAT_MAX_SESSIONS,
+    CHAT_SESSION_MAX_TURNS,
+    CHAT_SESSION_MAX_BYTES,
+    CHAT_SESSIONS_MAX_BYTES,
+    CHAT_SESSION_IDLE_TTL
 )
 
 # Configurar logging
-logging.basicConfig(level=logging.INFO)
+logging_setup.setup()
 logger = logging.getLogger(__name__)
 
-# Crear app FastAPI
-app = FastAPI(title="Evidenze AI Chatbot")
+def preload():
+    """Abre el índice de recuperación antes del fork (gunicorn --preload)"""
+    retrieval.preload()
+
+async def startup():
+    """Arranque propio del chat con memoria (el pool de Azure lo abre quien lo monta)"""
+    warmup_tokenizer()
+
+async def shutdown():
+    """Espera a los resúmenes de historial en curso"""
+    await history.drain()
+
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+    """Abre el pool de Azure OpenAI al arrancar y lo cierra al apagar"""
+    config.validate(SURFACE)
+    await openai_client.startup()
+    await usage_ledger.start()
+    await startup()
+    yield
+    deadline.begin_drain()
+    await shutdown()
+    await usage_ledger.stop()
+    await openai_client.shutdown()
+
+# Crear app FastAPI (despliegue independiente; service.py monta routes)
+app = FastAPI(lifespan=lifespan, title="Evidenze AI Chatbot", default_response_class=ORJSONResponse)
+metrics.instrument(app)
+logging_setup.instrument(app)
+admission.instrument(app)
+deadline.instrument(app)
+routes = APIRouter()
+
+USER_AGENT = "EvidenzeChat/1.0"
+
+# El system prompt lo fija el servidor (prompts.py), no el navegador
+SURFACE = "chat_m"
+
+# Memoria temporal por sesión: solo en RAM, acotada y con expiración
+sessions = SessionStore(
+    max_sessions=CHAT_MAX_SESSIONS,
+    max_turns=CHAT_SESSION_MAX_TURNS,
+    max_session_bytes=CHAT_SESSION_MAX_BYTES,
+    max_total_bytes=CHAT_SESSIONS_MAX_BYTES,
+    idle_ttl=CHAT_SESSION_IDLE_TTL
+)
+
+metrics.register_stats("chat_sessions", sessions.stats)
+
+# Ventana por presupuesto de tokens + resumen rodante
+history = HistoryManager(sessions)
 
 # HTML para la interfaz con diseño Evidenze
 HTML_TEMPLATE = """
@@ -257,13 +320,12 @@ HTML_TEMPLATE = """
     </div>
 
     <script>
-        // Memoria de conversación - EXACTAMENTE como tu código que funcionaba, pero con historial
-        var conversationHistory = [
-            {
-                "role": "system",
-                "content": "Eres un asistente de IA profesional de Evidenze, una empresa CRO especializada en investigación clínica y servicios farmacéuticos. Proporciona respuestas útiles, profesionales y precisas."
-            }
-        ];
+        // Ruta base del chat (vacía si se sirve en la raíz)
+        const BASE = '__BASE__';
+        
+        // Id opaco de la sesión: el historial vive en el servidor, solo en memoria
+        var sessionId = null;
+        var userMessages = 0;
         
         async function sendMessage() {
             const input = document.getElementById('message-input');
@@ -275,12 +337,7 @@ HTML_TEMPLATE = """
             addMessage(message, 'user-message');
             input.value = '';
             
-            // Agregar al historial
-            conversationHistory.push({
-                "role": "user",
-                "content": message
-            });
-            
+            userMessages++;
             updateMessageCount();
             
             // Mostrar indicador de carga (IGUAL que tu versión)
@@ -290,27 +347,37 @@ HTML_TEMPLATE = """
             document.getElementById('chat-container').appendChild(loadingDiv);
             
             try {
-                // Enviar historial completo al backend
-                const response = await fetch('/chat', {
-                    method: 'POST',
-                    headers: { 'Content-Type': 'application/json' },
-                    body: JSON.stringify({ messages: conversationHistory })
-                });
+                // Enviar solo el mensaje nuevo y leer la respuesta en streaming
+                let response = await postTurn(message);
+                
+                if (response.status === 404 && sessionId) {
+                    // El servidor ya no tiene la sesión (expiró): se avisa y se empieza otra
+                    sessionId = null;
+                    addMessage('La sesión anterior expiró: sigo sin el historial previo.', 'bot-message');
+                    response = await postTurn(message);
+                }
+                
+                if (!response.ok || !response.body) {
+                    throw new Error('HTTP ' + response.status);
+                }
+                sessionId = response.headers.get('X-Session-Id') || sessionId;
                 
-                const data = await response.json();
+                let botDiv = null;
+                let answer = '';
+                const ok = await readStream(response, function(delta) {
+                    // Remover indicador de carga con el primer token
+                    if (!botDiv) {
+                        loadingDiv.remove();
+                        botDiv = addMessage('', 'bot-message');
+                    }
+                    answer += delta;
+                    botDiv.textContent = answer;
+                    scrollToBottom();
+                });
                 
-                // Remover indicador de carga
                 loadingDiv.remove();
                 
-                if (data.response) {
-                    addMessage(data.response, 'bot-message');
-                    
-                    // Agregar respuesta al historial
-                    conversationHistory.push({
-                        "role": "assistant",
-                        "content": data.response
-                    });
-                } else {
+                if (!ok && !botDiv) {
                     addMessage('Error: No se pudo procesar tu mensaje', 'bot-message');
                 }
             } catch (error) {
@@ -319,6 +386,41 @@ HTML_TEMPLATE = """
             }
         }
         
+        function postTurn(message) {
+            return fetch(BASE + '/chat/stream', {
+                method: 'POST',
+                headers: { 'Content-Type': 'application/json' },
+                body: JSON.stringify({ session_id: sessionId, message: message })
+            });
+        }
+        
+        async function readStream(response, onDelta) {
+            // Parser mínimo de Server-Sent Events
+            const reader = response.body.getReader();
+            const decoder = new TextDecoder();
+            let buffer = '';
+            while (true) {
+                const { value, done } = await reader.read();
+                if (done) return false;
+                buffer += decoder.decode(value, { stream: true });
+                let sep;
+                while ((sep = buffer.indexOf('\\n\\n')) !== -1) {
+                    const line = buffer.slice(0, sep);
+                    buffer = buffer.slice(sep + 2);
+                    if (!line.startsWith('data: ')) continue;
+                    const event = JSON.parse(line.slice(6));
+                    if (event.delta) onDelta(event.delta);
+                    if (event.done) return true;
+                    if (event.error) return false;
+                }
+            }
+        }
+        
+        function scrollToBottom() {
+            const chatContainer = document.getElementById('chat-container');
+            chatContainer.scrollTop = chatContainer.scrollHeight;
+        }
+        
         function addMessage(text, className) {
             const chatContainer = document.getElementById('chat-container');
             const messageDiv = document.createElement('div');
@@ -326,6 +428,7 @@ HTML_TEMPLATE = """
             messageDiv.textContent = text;
             chatContainer.appendChild(messageDiv);
             chatContainer.scrollTop = chatContainer.scrollHeight;
+            return messageDiv;
         }
         
         function handleKeyPress(event) {
@@ -335,18 +438,25 @@ HTML_TEMPLATE = """
         }
         
         function updateMessageCount() {
-            var userMessages = 0;
-            for (var i = 0; i < conversationHistory.length; i++) {
-                if (conversationHistory[i].role === 'user') {
-                    userMessages++;
-                }
-            }
             document.getElementById('message-count').textContent = userMessages;
         }
         
-        function clearConversation() {
+        async function clearConversation() {
             if (confirm('¿Estás seguro de que quieres limpiar el historial de la conversación?')) {
-                conversationHistory = [conversationHistory[0]]; // Mantener solo system prompt
+                // Borrar la memoria de la sesión en el servidor
+                if (sessionId) {
+                    try {
+                        await fetch(BASE + '/chat/clear', {
+                            method: 'POST',
+                            headers: { 'Content-Type': 'application/json' },
+                            body: JSON.stringify({ session_id: sessionId })
+                        });
+                    } catch (error) {
+                        // La sesión igualmente expira por inactividad
+                    }
+                }
+                sessionId = null;
+                userMessages = 0;
                 
                 const chatContainer = document.getElementById('chat-container');
                 chatContainer.innerHTML = '<div class="message bot-message"><strong>Bienvenido al Asistente de IA de Evidenze</strong><br>Soy tu asistente inteligente especializado en investigación clínica y servicios farmacéuticos.<br>Puedo ayudarte con consultas profesionales y recordaré nuestra conversación durante esta sesión.<br>¿En qué puedo asistirte hoy?</div>';
@@ -359,56 +469,167 @@ HTML_TEMPLATE = """
 </html>
 """
 
-@app.get("/", response_class=HTMLResponse)
-async def root():
+@lru_cache(maxsize=8)
+def _page(base: str) -> str:
+    """HTML con las llamadas a la API bajo la ruta en la que se sirve la página"""
+    return HTML_TEMPLATE.replace("__BASE__", base)
+
+@routes.get("/", response_class=HTMLResponse)
+async def root(request: Request):
     """Página principal del chatbot Evidenze"""
-    return HTML_TEMPLATE
+    return _page(request.url.path.rstrip("/"))
+
+def _parse_turn(body: dict) -> Tuple[Optional[str], str]:
+    """Extrae el id de sesión y el nuevo mensaje del usuario"""
+    session_id = body.get("session_id") or None
+    user_message = str(body.get("message", "")).strip()
+    return session_id, user_message
+
+def _session_not_found() -> ORJSONResponse:
+    """El id no existe en este proceso: el navegador debe saber que el historial se perdió"""
+    return ORJSONResponse(
+        {"error": "La sesión ya no existe en el servidor", "session_expired": True},
+        status_code=404
+    )
+
+def _set_account(request: Request, session_id: str):
+    """Imputa el turno (y el resumen que dispare) al usuario autenticado o a la sesión"""
+    usage_ledger.set_account(usage_ledger.web_user(request.headers, f"session:{session_id}"))
 
-@app.post("/chat")
+@routes.post("/chat")
 async def chat(request: Request):
     """Endpoint para procesar mensajes del chat con memoria"""
     try:
-        # Obtener historial de conversación
+        # Solo llega el mensaje nuevo: el historial vive en el servidor
         body = await request.json()
-        messages = body.get("messages", [])
+        session_id, user_message = _parse_turn(body)
         
-        if not messages or len(messages) < 2:
-            return JSONResponse({"error": "Historial de conversación inválido"}, status_code=400)
+        if not user_message:
+            return ORJSONResponse({"error": "Mensaje vacío"}, status_code=400)
         
-        # Crear cliente OpenAI
-        client = AsyncAzureOpenAI(
-            azure_endpoint=AZURE_OPENAI_ENDPOINT,
-            api_version=AZURE_OPENAI_API_VERSION,
-            api_key=os.environ.get("AZURE_OPENAI_API_KEY"),
-            default_headers={"User-Agent": "EvidenzeChat/1.0"}
-        )
+        session_id, session = sessions.get_or_create(session_id)
+        _set_account(request, session_id)
+        
+        # Preguntas frecuentes con respuesta fija: sin llamar al modelo
+        answer = faq.lookup(user_message, SURFACE)
+        if answer:
+            sessions.append(session_id, "user", user_message)
+            sessions.append(session_id, "assistant", answer.text())
+            return ORJSONResponse(
+                {"response": answer.text(), "session_id": session_id, "faq": answer.id},
+                headers={"X-Session-Id": session_id}
+            )
+        
+        # Por IP o usuario autenticado, no por sesión: abrir sesiones nuevas no da más plazas
+        await admission.admit(request, SURFACE)
+        passages = await retrieval.context(user_message)
+        messages = history.build(SURFACE, session, user_message, passages)
         
         # Llamar a OpenAI con el historial completo
-        response = await client.chat.completions.create(
-            model=AZURE_OPENAI_DEPLOYMENT_NAME,
-            messages=messages,
-            max_tokens=MAX_TOKENS,
-            temperature=TEMPERATURE
-        )
+        completion = await llm.create_completion(messages, USER_AGENT)
         
         # Extraer respuesta
-        ai_response = response.choices[0].message.content
+        ai_response = completion.text
+        sessions.append(session_id, "user", user_message)
+        sessions.append(session_id, "assistant", ai_response)
+        history.schedule_compaction(session_id, SURFACE)
         
         # Log para monitoreo
-        user_message = messages[-1]["content"]
-        logger.info(f"Evidenze Chat - Usuario: {user_message[:50]}... | Historial: {len(messages)} msgs | Tokens: {response.usage.total_tokens}")
-        
-        return JSONResponse({"response": ai_response})
+        logger.info("Evidenze Chat", extra={
+            "user_message": user_message,
+            "history_messages": len(messages),
+            "tokens": completion.total_tokens,
+            "cached_prompt_tokens": completion.cached_tokens
+        })
+        
+        return ORJSONResponse(
+            {"response": ai_response, "session_id": session_id},
+            headers={"X-Session-Id": session_id}
+        )
         
+    except SessionNotFound:
+        return _session_not_found()
+    except admission.Shed as e:
+        return admission.shed_response(e)
     except Exception as e:
         logger.error(f"Error en chat de Evidenze: {e}")
-        return JSONResponse({"error": "Error procesando mensaje"}, status_code=500)
+        metrics.record_error("chat", e)
+        wait = llm.retry_after(e)
+        if wait is not None:
+            # Sin cupo en Azure: 503 con Retry-After en vez de un 500
+            return ORJSONResponse(
+                {"error": llm.BUSY_MESSAGE},
+                status_code=503,
+                headers={"Retry-After": str(max(int(wait), 1))}
+            )
+        return ORJSONResponse({"error": "Error procesando mensaje"}, status_code=500)
 
-@app.get("/health")
+@routes.post("/chat/stream")
+async def chat_stream(request: Request):
+    """Endpoint de chat con memoria y respuesta token a token (Server-Sent Events)"""
+    body = await request.json()
+    session_id, user_message = _parse_turn(body)
+    
+    if not user_message:
+        return ORJSONResponse({"error": "Mensaje vacío"}, status_code=400)
+    
+    try:
+        session_id, session = sessions.get_or_create(session_id)
+    except SessionNotFound:
+        return _session_not_found()
+    headers = {"Cache-Control": "no-cache", "X-Accel-Buffering": "no", "X-Session-Id": session_id}
+    _set_account(request, session_id)
+    
+    answer = faq.lookup(user_message, SURFACE)
+    if answer:
+        sessions.append(session_id, "user", user_message)
+        sessions.append(session_id, "assistant", answer.text())
+        return StreamingResponse(
+            llm.sse_text(answer.text(), faq=answer.id),
+            media_type="text/event-stream",
+            headers=headers
+        )
+    
+    try:
+        await admission.admit(request, SURFACE)
+    except admission.Shed as e:
+        return admission.shed_response(e)
+    passages = await retrieval.context(user_message)
+    messages = history.build(SURFACE, session, user_message, passages)
+    stream = llm.CompletionStream(messages, USER_AGENT)
+    
+    async def relay():
+        async for event in llm.sse_stream(stream):
+            yield event
+        # El turno solo se guarda si la respuesta llegó completa
+        if stream.completed:
+            sessions.append(session_id, "user", user_message)
+            sessions.append(session_id, "assistant", stream.text)
+            history.schedule_compaction(session_id, SURFACE)
+    
+    return StreamingResponse(
+        relay(),
+        media_type="text/event-stream",
+        headers=headers
+    )
+
+@routes.post("/chat/clear")
+async def chat_clear(request: Request):
+    """Borra del servidor el historial de la sesión"""
+    body = await request.json()
+    cleared = sessions.clear(body.get("session_id"))
+    return {"cleared": cleared}
+
+@routes.get("/health")
 async def health():
     """Health check para Evidenze chatbot"""
     return {
         "status": "healthy", 
         "service": "evidenze-chatbot",
-        "features": ["session_memory", "gdpr_compliant", "azure_openai"]
-    }
\ No newline at end of file
+        "features": ["session_memory", "gdpr_compliant", "azure_openai"],
+        "sessions": sessions.stats(),
+        "pool": openai_client.pool_stats(),
+        "router": router.get_router().stats()
+    }
+
+app.include_router(routes)
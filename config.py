@@ -1,21 +1,393 @@
 """
 Configuración para el Bot de Teams con Azure OpenAI
+
+Importar este módulo no lee el entorno, no configura logging ni lanza errores:
+Settings se construye una vez desde el entorno (get_settings) y se valida
+explícitamente al arrancar (validate). Los módulos siguen usando
+`from config import X`, que se resuelve contra get_settings().
 """
 import os
+import json
 import logging
+from dataclasses import dataclass, field, fields
+from typing import Iterable, List, Optional
 
-# Configurar logging
-logging.basicConfig(level=logging.INFO)
 logger = logging.getLogger(__name__)
 
-# === CONFIGURACIÓN DE AZURE OPENAI ===
-AZURE_OPENAI_ENDPOINT = os.environ.get("AZURE_OPENAI_ENDPOINT")
-AZURE_OPENAI_API_VERSION = os.environ.get("AZURE_OPENAI_API_VERSION", "2024-02-15-preview")
-AZURE_OPENAI_DEPLOYMENT_NAME = os.environ.get("AZURE_OPENAI_DEPLOYMENT_NAME")
+# Valores del entorno que no se pudieron interpretar (los informa validate)
+_parse_errors: List[str] = []
+
+
+def _env(name: str, default, cast=None):
+    """Campo de Settings leído de la variable de entorno name"""
+    cast = cast or type(default)
+
+    def read():
+        raw = os.environ.get(name)
+        if raw is None:
+            return default
+        if cast is bool:
+            return raw.strip().lower() == "true"
+        if raw == "":
+            return default
+        try:
+            return cast(raw)
+        except ValueError:
+            _parse_errors.append(f"{name}={raw!r} no es un valor válido")
+            return default
+
+    return field(default_factory=read)
+
+
+@dataclass(frozen=True)
+class Settings:
+    """Configuración tipada del proceso (mismos nombres que las constantes del módulo)"""
+
+    # === CONFIGURACIÓN DE AZURE OPENAI ===
+    AZURE_OPENAI_ENDPOINT: Optional[str] = _env("AZURE_OPENAI_ENDPOINT", None, str)
+    AZURE_OPENAI_API_VERSION: str = _env("AZURE_OPENAI_API_VERSION", "2024-02-15-preview")
+    AZURE_OPENAI_DEPLOYMENT_NAME: Optional[str] = _env("AZURE_OPENAI_DEPLOYMENT_NAME", None, str)
+
+    # === POOL DE DEPLOYMENTS (multi-región) ===
+    # JSON con una lista de backends, p. ej.:
+    # [{"name": "weu", "endpoint": "https://...", "deployment": "gpt-4o",
+    #   "api_key_env": "AZURE_OPENAI_API_KEY_WEU", "weight": 2, "rpm": 300, "tpm": 50000}]
+    # Sin definir, se usa un único backend con las variables de arriba.
+    AZURE_OPENAI_BACKENDS: list = field(default_factory=list)
+
+    # === ROUTER: SALUD DE BACKENDS Y HEDGING ===
+    ROUTER_FAILURE_THRESHOLD: int = _env("ROUTER_FAILURE_THRESHOLD", 3)
+    ROUTER_EJECT_SECONDS: float = _env("ROUTER_EJECT_SECONDS", 30.0)
+    ROUTER_HEDGING: bool = _env("ROUTER_HEDGING", False)
+    ROUTER_HEDGE_MIN_DELAY: float = _env("ROUTER_HEDGE_MIN_DELAY", 2.0)
+
+    # === CONFIGURACIÓN DEL BOT FRAMEWORK ===
+    BOT_APP_ID: str = _env("MicrosoftAppId", "")
+    BOT_APP_PASSWORD: str = _env("MicrosoftAppPassword", "")
+
+    # === TURNOS DEL BOT EN SEGUNDO PLANO ===
+    # true: /api/messages valida, encola y responde 200 al instante; la respuesta
+    # se envía después de forma proactiva (evita timeouts y reenvíos del canal)
+    BOT_ASYNC_MODE: bool = _env("BOT_ASYNC_MODE", False)
+    BOT_WORKERS: int = _env("BOT_WORKERS", 16)
+    BOT_QUEUE_MAX: int = _env("BOT_QUEUE_MAX", 500)
+    BOT_QUEUE_DRAIN_TIMEOUT: float = _env("BOT_QUEUE_DRAIN_TIMEOUT", 20.0)
+
+    # === AUTENTICACIÓN DE BOT FRAMEWORK ===
+    BOT_AUTH_CACHE_ENABLED: bool = _env("BOT_AUTH_CACHE_ENABLED", True)
+    BOT_AUTH_CACHE_MAX_ENTRIES: int = _env("BOT_AUTH_CACHE_MAX_ENTRIES", 1000)
+    # Tope adicional al exp del token (segundos)
+    BOT_AUTH_CACHE_MAX_TTL: float = _env("BOT_AUTH_CACHE_MAX_TTL", 3600.0)
+    # Vacío = URLs públicas de Bot Framework (útil para apuntar a un stand-in local)
+    BOT_OPENID_METADATA_URL: str = _env("BOT_OPENID_METADATA_URL", "")
+    BOT_EMULATOR_OPENID_METADATA_URL: str = _env("BOT_EMULATOR_OPENID_METADATA_URL", "")
+    BOT_OPENID_REFRESH_INTERVAL: float = _env("BOT_OPENID_REFRESH_INTERVAL", 6 * 3600.0)
+
+    # === CONECTOR DE BOT FRAMEWORK (envíos a Teams) ===
+    # Pool httpx propio y token de la app cacheado, en lugar de requests en hilos
+    BOT_CONNECTOR_POOLED: bool = _env("BOT_CONNECTOR_POOLED", True)
+    BOT_CONNECTOR_MAX_CONNECTIONS: int = _env("BOT_CONNECTOR_MAX_CONNECTIONS", 50)
+    BOT_CONNECTOR_KEEPALIVE_EXPIRY: float = _env("BOT_CONNECTOR_KEEPALIVE_EXPIRY", 90.0)
+    BOT_CONNECTOR_TIMEOUT: float = _env("BOT_CONNECTOR_TIMEOUT", 30.0)
+    # Indicador mientras se genera: "placeholder" (mensaje "Procesando...") o "typing"
+    BOT_PROGRESS_INDICATOR: str = _env("BOT_PROGRESS_INDICATOR", "placeholder", str.lower)
+    BOT_TYPING_INTERVAL: float = _env("BOT_TYPING_INTERVAL", 3.0)
+    # Respuestas más largas se parten en varios mensajes (Teams admite ~28 KB por mensaje)
+    BOT_MAX_MESSAGE_CHARS: int = _env("BOT_MAX_MESSAGE_CHARS", 7000)
+
+    # === DEDUPLICACIÓN DE ACTIVIDADES REENVIADAS ===
+    BOT_DEDUP_ENABLED: bool = _env("BOT_DEDUP_ENABLED", True)
+    BOT_DEDUP_TTL: float = _env("BOT_DEDUP_TTL", 600.0)
+    BOT_DEDUP_MAX_ENTRIES: int = _env("BOT_DEDUP_MAX_ENTRIES", 10000)
+    # Ruta de un fichero SQLite compartido entre workers (vacío = solo memoria)
+    BOT_DEDUP_DB: str = _env("BOT_DEDUP_DB", "")
+
+    # === MEMORIA DE CONVERSACIÓN DEL BOT (por conversación de Teams) ===
+    BOT_MEMORY_ENABLED: bool = _env("BOT_MEMORY_ENABLED", True)
+    BOT_MEMORY_MAX_TURNS: int = _env("BOT_MEMORY_MAX_TURNS", 12)
+    BOT_MEMORY_MAX_BYTES: int = _env("BOT_MEMORY_MAX_BYTES", 16 * 1024)
+    BOT_MEMORY_TTL: float = _env("BOT_MEMORY_TTL", 24 * 3600.0)
+    BOT_MEMORY_MAX_CACHED: int = _env("BOT_MEMORY_MAX_CACHED", 2000)
+    # Fichero SQLite compartido entre workers: sin él, cada worker vería solo sus turnos
+    BOT_MEMORY_DB: str = _env("BOT_MEMORY_DB", "bot_memory.db")
+    BOT_MEMORY_FLUSH_INTERVAL: float = _env("BOT_MEMORY_FLUSH_INTERVAL", 0.05)
+
+    # === POOL DE CONEXIONES HACIA AZURE OPENAI ===
+    OPENAI_MAX_CONNECTIONS: int = _env("OPENAI_MAX_CONNECTIONS", 100)
+    OPENAI_MAX_KEEPALIVE: int = _env("OPENAI_MAX_KEEPALIVE", 20)
+    OPENAI_KEEPALIVE_EXPIRY: float = _env("OPENAI_KEEPALIVE_EXPIRY", 60.0)
+    OPENAI_HTTP2: bool = _env("OPENAI_HTTP2", True)
+    OPENAI_WARMUP: bool = _env("OPENAI_WARMUP", True)
+
+    # === CUOTA DEL DEPLOYMENT (gobernador TPM/RPM) ===
+    RATE_GOVERNOR_ENABLED: bool = _env("RATE_GOVERNOR_ENABLED", True)
+    AZURE_OPENAI_RPM: float = _env("AZURE_OPENAI_RPM", 300.0)
+    AZURE_OPENAI_TPM: float = _env("AZURE_OPENAI_TPM", 50000.0)
+    RATE_MAX_QUEUE: int = _env("RATE_MAX_QUEUE", 100)
+    RATE_MAX_WAIT: float = _env("RATE_MAX_WAIT", 20.0)
+    OPENAI_MAX_RETRIES: int = _env("OPENAI_MAX_RETRIES", 2)
+    # Peso de cada cliente (User-Agent) en el reparto de la cuota, p. ej.
+    # {"Teams-Bot/1.0": 2, "WebChat/1.0": 1, "EvidenzeChat/1.0": 1}; sin peso = 1
+    RATE_CLIENT_WEIGHTS: dict = _env("RATE_CLIENT_WEIGHTS", {}, json.loads)
+
+    # === STREAMING ===
+    # include_usage en streaming requiere api-version 2024-09-01-preview o superior
+    OPENAI_STREAM_USAGE: bool = _env("OPENAI_STREAM_USAGE", False)
+    BOT_STREAMING: bool = _env("BOT_STREAMING", True)
+    BOT_STREAM_UPDATE_INTERVAL: float = _env("BOT_STREAM_UPDATE_INTERVAL", 1.0)
+
+    # === PROCESOS ===
+    # Workers del servidor (lo leen gunicorn y uvicorn --workers); los almacenes
+    # que solo viven en la RAM de un proceso lo necesitan para validar
+    WEB_CONCURRENCY: int = _env("WEB_CONCURRENCY", 1)
+
+    # === SESIONES DEL CHAT CON MEMORIA (solo en RAM) ===
+    CHAT_MAX_SESSIONS: int = _env("CHAT_MAX_SESSIONS", 5000)
+    CHAT_SESSION_MAX_TURNS: int = _env("CHAT_SESSION_MAX_TURNS", 40)
+    CHAT_SESSION_MAX_BYTES: int = _env("CHAT_SESSION_MAX_BYTES", 64 * 1024)
+    CHAT_SESSIONS_MAX_BYTES: int = _env("CHAT_SESSIONS_MAX_BYTES", 64 * 1024 * 1024)
+    CHAT_SESSION_IDLE_TTL: float = _env("CHAT_SESSION_IDLE_TTL", 1800.0)
+    # Cada sesión vive en un solo worker: con WEB_CONCURRENCY > 1 el balanceador tiene
+    # que mandar siempre al mismo worker las peticiones de una sesión (afinidad)
+    CHAT_SESSIONS_STICKY: bool = _env("CHAT_SESSIONS_STICKY", False)
+
+    # === VENTANA DE HISTORIAL ===
+    CHAT_HISTORY_TOKEN_BUDGET: int = _env("CHAT_HISTORY_TOKEN_BUDGET", 3000)
+    CHAT_SUMMARY_MAX_TOKENS: int = _env("CHAT_SUMMARY_MAX_TOKENS", 300)
+    TOKENIZER_ENCODING: str = _env("TOKENIZER_ENCODING", "cl100k_base")
+
+    # === CACHÉ DE RESPUESTAS ===
+    RESPONSE_CACHE_ENABLED: bool = _env("RESPONSE_CACHE_ENABLED", True)
+    RESPONSE_CACHE_TTL: float = _env("RESPONSE_CACHE_TTL", 3600.0)
+    RESPONSE_CACHE_MAX_ENTRIES: int = _env("RESPONSE_CACHE_MAX_ENTRIES", 1000)
+    # Ruta de un fichero SQLite compartido entre workers (vacío = solo memoria)
+    RESPONSE_CACHE_DB: str = _env("RESPONSE_CACHE_DB", "")
+
+    # === PROMPT ===
+    # Fichero de texto con políticas y contexto común a todas las superficies; va
+    # en el prefijo estable del prompt (cacheable por el proveedor desde 1024 tokens)
+    PROMPT_CONTEXT_FILE: str = _env("PROMPT_CONTEXT_FILE", "")
+
+    # === RECUPERACIÓN SOBRE DOCUMENTOS INTERNOS (retrieval.py) ===
+    RETRIEVAL_ENABLED: bool = _env("RETRIEVAL_ENABLED", False)
+    RETRIEVAL_DOCS_DIR: str = _env("RETRIEVAL_DOCS_DIR", "docs")
+    RETRIEVAL_INDEX_DIR: str = _env("RETRIEVAL_INDEX_DIR", "retrieval_index")
+    # "hash" (local y determinista), "azure" (deployment de embeddings) o "modulo:fabrica"
+    RETRIEVAL_EMBEDDER: str = _env("RETRIEVAL_EMBEDDER", "hash")
+    RETRIEVAL_EMBEDDING_DEPLOYMENT: str = _env("RETRIEVAL_EMBEDDING_DEPLOYMENT", "")
+    RETRIEVAL_HASH_DIM: int = _env("RETRIEVAL_HASH_DIM", 512)
+    RETRIEVAL_CHUNK_TOKENS: int = _env("RETRIEVAL_CHUNK_TOKENS", 300)
+    RETRIEVAL_TOP_K: int = _env("RETRIEVAL_TOP_K", 4)
+    RETRIEVAL_MIN_SCORE: float = _env("RETRIEVAL_MIN_SCORE", 0.2)
+    # Tope de tokens de los fragmentos que se añaden al prompt
+    RETRIEVAL_MAX_TOKENS: int = _env("RETRIEVAL_MAX_TOKENS", 1200)
+    # A partir de cuántos fragmentos se particiona el índice (IVF) y cuántas listas se visitan
+    RETRIEVAL_IVF_MIN_CHUNKS: int = _env("RETRIEVAL_IVF_MIN_CHUNKS", 20000)
+    RETRIEVAL_IVF_NPROBE: int = _env("RETRIEVAL_IVF_NPROBE", 16)
+    # Cada cuántos segundos se mira si hay un índice nuevo en disco
+    RETRIEVAL_RELOAD_INTERVAL: float = _env("RETRIEVAL_RELOAD_INTERVAL", 30.0)
+
+    # === RESPUESTAS FRECUENTES SIN MODELO (faq.py) ===
+    # JSON con preguntas y respuestas fijas (vacío = desactivado); ver faq.example.json
+    FAQ_FILE: str = _env("FAQ_FILE", "")
+    # Similitud mínima con una variante y ventaja mínima sobre otra entrada
+    FAQ_MIN_SCORE: float = _env("FAQ_MIN_SCORE", 0.8)
+    FAQ_MIN_MARGIN: float = _env("FAQ_MIN_MARGIN", 0.1)
+    FAQ_RELOAD_INTERVAL: float = _env("FAQ_RELOAD_INTERVAL", 5.0)
+
+    # === LIBRO DE CONSUMO POR USUARIO Y EQUIPO (usage_ledger.py) ===
+    # SQLite con los consumos de cada llamada (vacío = desactivado)
+    USAGE_LEDGER_DB: str = _env("USAGE_LEDGER_DB", "")
+    # Registros pendientes en memoria; si el disco no da abasto se pierden los más antiguos
+    USAGE_LEDGER_BUFFER: int = _env("USAGE_LEDGER_BUFFER", 10000)
+    USAGE_LEDGER_FLUSH_INTERVAL: float = _env("USAGE_LEDGER_FLUSH_INTERVAL", 1.0)
+    # Días de eventos sueltos que se conservan (el acumulado diario no caduca)
+    USAGE_LEDGER_RETENTION_DAYS: float = _env("USAGE_LEDGER_RETENTION_DAYS", 90.0)
+
+    # === ADMISIÓN DE TURNOS (admission.py: límites por usuario y descarte temprano) ===
+    ADMISSION_ENABLED: bool = _env("ADMISSION_ENABLED", True)
+    # Turnos en curso en el proceso (recuperación + modelo)
+    ADMISSION_MAX_IN_FLIGHT: int = _env("ADMISSION_MAX_IN_FLIGHT", 64)
+    ADMISSION_MAX_QUEUE: int = _env("ADMISSION_MAX_QUEUE", 256)
+    # Espera máxima en cola; quien no llegaría a tiempo se rechaza al llegar
+    ADMISSION_MAX_WAIT: float = _env("ADMISSION_MAX_WAIT", 10.0)
+    ADMISSION_USER_CONCURRENCY: int = _env("ADMISSION_USER_CONCURRENCY", 2)
+    ADMISSION_USER_MAX_QUEUE: int = _env("ADMISSION_USER_MAX_QUEUE", 4)
+    # 0 = sin límite de ritmo por usuario
+    ADMISSION_USER_RPM: float = _env("ADMISSION_USER_RPM", 30.0)
+    # Pesos por usuario en el reparto (JSON, p. ej. {"cuenta-servicio@evidenze.com": 4})
+    ADMISSION_USER_WEIGHTS: dict = _env("ADMISSION_USER_WEIGHTS", {}, json.loads)
+
+    # === PLAZOS DE PETICIÓN Y CANCELACIÓN (deadline.py) ===
+    # Segundos desde que entra la petición (o se encola el turno) hasta rendirse;
+    # acota la espera por cuota, los reintentos y el timeout de cada llamada a Azure
+    REQUEST_DEADLINE: float = _env("REQUEST_DEADLINE", 45.0)
+    # Al apagar, plazo para las peticiones en curso (debe caber en GUNICORN_GRACEFUL_TIMEOUT)
+    DEADLINE_DRAIN_TIMEOUT: float = _env("DEADLINE_DRAIN_TIMEOUT", 15.0)
+
+    # === COALESCENCIA DE LLAMADAS IDÉNTICAS (funciona aun sin caché) ===
+    SINGLEFLIGHT_ENABLED: bool = _env("SINGLEFLIGHT_ENABLED", True)
+
+    # === LOGS (logging_setup.py: cola y escritura en un hilo aparte) ===
+    LOG_LEVEL: str = _env("LOG_LEVEL", "INFO")
+    # json (una línea por registro) o text (legible, para desarrollo)
+    LOG_FORMAT: str = _env("LOG_FORMAT", "json")
+    # Registros pendientes de escribir; si la salida no da abasto se descartan (y se cuentan)
+    LOG_QUEUE_SIZE: int = _env("LOG_QUEUE_SIZE", 10000)
+    # Fracción de peticiones cuyos INFO/DEBUG se escriben (avisos y errores siempre)
+    LOG_SAMPLE_RATE: float = _env("LOG_SAMPLE_RATE", 1.0)
+    # Texto de los usuarios en los logs: omit (solo la longitud), hash (longitud y huella) o full
+    LOG_MESSAGE_CONTENT: str = _env("LOG_MESSAGE_CONTENT", "omit")
+
+    # === MÉTRICAS (endpoint /metrics en formato Prometheus) ===
+    METRICS_ENABLED: bool = _env("METRICS_ENABLED", True)
+
+    # === SERVICIO CONSOLIDADO (service.py: bot y chats en un mismo proceso) ===
+    SERVICE_TEAMS_ENABLED: bool = _env("SERVICE_TEAMS_ENABLED", True)
+    SERVICE_CHAT_ENABLED: bool = _env("SERVICE_CHAT_ENABLED", True)
+    SERVICE_CHAT_M_ENABLED: bool = _env("SERVICE_CHAT_M_ENABLED", True)
+    # Vacío = en la raíz (el bot mantiene /api/messages)
+    SERVICE_TEAMS_PREFIX: str = _env("SERVICE_TEAMS_PREFIX", "")
+    SERVICE_CHAT_PREFIX: str = _env("SERVICE_CHAT_PREFIX", "/web")
+    SERVICE_CHAT_M_PREFIX: str = _env("SERVICE_CHAT_M_PREFIX", "/memoria")
+
+    def __post_init__(self):
+        backends = self._load_backends()
+        object.__setattr__(self, "AZURE_OPENAI_BACKENDS", backends)
+        if backends:
+            # El primer backend hace de principal (claves de caché, precalentado)
+            object.__setattr__(
+                self, "AZURE_OPENAI_ENDPOINT", self.AZURE_OPENAI_ENDPOINT or backends[0].get("endpoint")
+            )
+            object.__setattr__(
+                self, "AZURE_OPENAI_DEPLOYMENT_NAME", self.AZURE_OPENAI_DEPLOYMENT_NAME or backends[0].get("deployment")
+            )
+
+    def _load_backends(self) -> list:
+        raw = os.environ.get("AZURE_OPENAI_BACKENDS", "").strip()
+        if not raw:
+            return [{
+                "name": "default",
+                "endpoint": self.AZURE_OPENAI_ENDPOINT,
+                "deployment": self.AZURE_OPENAI_DEPLOYMENT_NAME,
+                "api_key_env": "AZURE_OPENAI_API_KEY",
+            }]
+        try:
+            backends = json.loads(raw)
+        except ValueError as e:
+            _parse_errors.append(f"AZURE_OPENAI_BACKENDS no es JSON válido: {e}")
+            return []
+        if not isinstance(backends, list):
+            _parse_errors.append("AZURE_OPENAI_BACKENDS debe ser una lista")
+            return []
+        return backends
+
+    def problems(self, surfaces: Iterable[str] = (), workers: Optional[int] = None) -> List[str]:
+        """Errores de configuración (vacío si todo es válido), más los de las superficies dadas
+
+        workers: número real de workers si lo fija quien arranca (gunicorn); si no, WEB_CONCURRENCY
+        """
+        problems = []
+        workers = workers or self.WEB_CONCURRENCY
+        if not self.AZURE_OPENAI_ENDPOINT:
+            problems.append("AZURE_OPENAI_ENDPOINT es requerido")
+        if not self.AZURE_OPENAI_DEPLOYMENT_NAME:
+            problems.append("AZURE_OPENAI_DEPLOYMENT_NAME es requerido")
+        for backend in self.AZURE_OPENAI_BACKENDS:
+            if not backend.get("endpoint") or not backend.get("deployment"):
+                problems.append("Cada backend de AZURE_OPENAI_BACKENDS requiere endpoint y deployment")
+                break
+        if self.BOT_PROGRESS_INDICATOR not in ("placeholder", "typing"):
+            problems.append("BOT_PROGRESS_INDICATOR debe ser 'placeholder' o 'typing'")
+        weights = self.RATE_CLIENT_WEIGHTS
+        if not isinstance(weights, dict) or not all(
+            isinstance(w, (int, float)) and w > 0 for w in weights.values()
+        ):
+            problems.append("RATE_CLIENT_WEIGHTS debe ser un objeto JSON con pesos positivos")
+        if self.ADMISSION_ENABLED:
+            if self.ADMISSION_MAX_IN_FLIGHT < 1 or self.ADMISSION_USER_CONCURRENCY < 1:
+                problems.append("ADMISSION_MAX_IN_FLIGHT y ADMISSION_USER_CONCURRENCY deben ser al menos 1")
+            weights = self.ADMISSION_USER_WEIGHTS
+            if not isinstance(weights, dict) or not all(
+                isinstance(w, (int, float)) and w > 0 for w in weights.values()
+            ):
+                problems.append("ADMISSION_USER_WEIGHTS debe ser un objeto JSON con pesos positivos")
+        if self.REQUEST_DEADLINE <= 0 or self.DEADLINE_DRAIN_TIMEOUT <= 0:
+            problems.append("REQUEST_DEADLINE y DEADLINE_DRAIN_TIMEOUT deben ser positivos")
+        if not isinstance(logging.getLevelName(self.LOG_LEVEL.upper()), int):
+            problems.append("LOG_LEVEL debe ser DEBUG, INFO, WARNING, ERROR o CRITICAL")
+        if self.LOG_FORMAT not in ("json", "text"):
+            problems.append("LOG_FORMAT debe ser 'json' o 'text'")
+        if self.LOG_MESSAGE_CONTENT not in ("omit", "hash", "full"):
+            problems.append("LOG_MESSAGE_CONTENT debe ser 'omit', 'hash' o 'full'")
+        if not 0 <= self.LOG_SAMPLE_RATE <= 1:
+            problems.append("LOG_SAMPLE_RATE debe estar entre 0 y 1")
+        if not 0 < self.FAQ_MIN_SCORE <= 1:
+            problems.append("FAQ_MIN_SCORE debe estar entre 0 y 1")
+        if self.RETRIEVAL_ENABLED:
+            embedder = self.RETRIEVAL_EMBEDDER
+            if embedder not in ("hash", "azure") and ":" not in embedder:
+                problems.append("RETRIEVAL_EMBEDDER debe ser 'hash', 'azure' o 'modulo:fabrica'")
+            if embedder == "azure" and not self.RETRIEVAL_EMBEDDING_DEPLOYMENT:
+                problems.append("RETRIEVAL_EMBEDDING_DEPLOYMENT es requerido con RETRIEVAL_EMBEDDER=azure")
+        prefixes = [
+            prefix for enabled, prefix in (
+                (self.SERVICE_TEAMS_ENABLED, self.SERVICE_TEAMS_PREFIX),
+                (self.SERVICE_CHAT_ENABLED, self.SERVICE_CHAT_PREFIX),
+                (self.SERVICE_CHAT_M_ENABLED, self.SERVICE_CHAT_M_PREFIX),
+            ) if enabled
+        ]
+        if any(p and (not p.startswith("/") or p.endswith("/")) for p in prefixes):
+            problems.append("Los SERVICE_*_PREFIX deben empezar por '/' y no terminar en '/'")
+        if len(set(prefixes)) < len(prefixes):
+            problems.append("Cada superficie habilitada necesita un SERVICE_*_PREFIX distinto")
+        if workers < 1:
+            problems.append("WEB_CONCURRENCY debe ser al menos 1")
+        if "chat_m" in surfaces and workers > 1 and not self.CHAT_SESSIONS_STICKY:
+            problems.append(
+                "Las sesiones de chat_m solo viven en la RAM de un worker: usa WEB_CONCURRENCY=1 "
+                "o CHAT_SESSIONS_STICKY=true con afinidad de sesión en el balanceador"
+            )
+        return problems
+
+
+_FIELDS = frozenset(f.name for f in fields(Settings))
+_settings: Optional[Settings] = None
+_validated = False
+_validated_surfaces = set()
+
+
+def get_settings() -> Settings:
+    """Settings del proceso, leídos del entorno la primera vez"""
+    global _settings
+    if _settings is None:
+        _parse_errors.clear()
+        _settings = Settings()
+    return _settings
+
+
+def validate(*surfaces: str, workers: Optional[int] = None) -> Settings:
+    """Valida una sola vez (y cada superficie nueva); ValueError con todos los problemas encontrados"""
+    global _validated
+    settings = get_settings()
+    pending = set(surfaces) - _validated_surfaces
+    if not _validated or pending:
+        problems = _parse_errors + settings.problems(pending, workers)
+        if problems:
+            raise ValueError("; ".join(problems))
+        _validated_surfaces.update(pending)
+        if not _validated:
+            _validated = True
+            logger.info("✅ Configuración cargada correctamente")
+    return settings
+
+
+def __getattr__(name: str):
+    # from config import X  ->  get_settings().X
+    if name in _FIELDS:
+        return getattr(get_settings(), name)
+    raise AttributeError(f"module {__name__!r} has no attribute {name!r}")
 
-# === CONFIGURACIÓN DEL BOT FRAMEWORK ===
-BOT_APP_ID = os.environ.get("MicrosoftAppId", "")
-BOT_APP_PASSWORD = os.environ.get("MicrosoftAppPassword", "")
 
 # === CONFIGURACIÓN DE AZURE OPENAI ===
 MAX_TOKENS = 500
@@ -29,11 +401,3 @@ Mantén tus respuestas concisas pero completas.
 Usa emojis ocasionalmente para hacer la conversación más amigable.
 Siempre responde en español.
 """
-
-# === VALIDACIÓN ===
-if not AZURE_OPENAI_ENDPOINT:
-    raise ValueError("AZURE_OPENAI_ENDPOINT es requerido")
-if not AZURE_OPENAI_DEPLOYMENT_NAME:
-    raise ValueError("AZURE_OPENAI_DEPLOYMENT_NAME es requerido")
-
-logger.info("✅ Configuración cargada correctamente")
\ No newline at end of file
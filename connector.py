@@ -0,0 +1,230 @@
+"""
+Envíos al Bot Connector (respuestas a Teams) por un pool httpx persistente
+
+El ConnectorClient del SDK manda cada petición con requests desde un hilo del
+executor (una sesión por hilo) y firma cada envío pidiendo el token a MSAL
+dentro del event loop. Aquí los clientes del adapter comparten un único
+httpx.AsyncClient con keep-alive y el token de la app se cachea hasta poco
+antes de su exp, refrescándolo fuera del event loop.
+"""
+import asyncio
+import logging
+import time
+from typing import Any, Dict, Optional, Tuple
+
+import httpx
+import jwt
+from botbuilder.core.bot_framework_adapter import USER_AGENT
+from botframework.connector.aio import ConnectorClient
+from botframework.connector.auth import AppCredentials, MicrosoftAppCredentials
+from msrest.pipeline import AsyncHTTPPolicy, AsyncPipeline, Request, Response
+from msrest.pipeline import AsyncHTTPSender as AsyncPipelineSender
+from msrest.pipeline.universal import RawDeserializer
+from msrest.universal_http import ClientRequest
+from msrest.universal_http.async_abc import AsyncClientResponse, AsyncHTTPSender
+
+import bot_auth
+import metrics
+from config import (
+    BOT_CONNECTOR_POOLED,
+    BOT_CONNECTOR_MAX_CONNECTIONS,
+    BOT_CONNECTOR_KEEPALIVE_EXPIRY,
+    BOT_CONNECTOR_TIMEOUT
+)
+
+logger = logging.getLogger(__name__)
+
+# Margen antes del exp del token de la app para pedir uno nuevo
+TOKEN_REFRESH_MARGIN = 300.0
+# Vida supuesta si el token no trae exp legible
+TOKEN_DEFAULT_TTL = 600.0
+
+CONNECTOR_DURATION = metrics.histogram(
+    "bot_connector_request_seconds", "Duración de las llamadas al Bot Connector", ("method", "status")
+)
+
+_http_client: Optional[httpx.AsyncClient] = None
+
+_stats = {
+    "requests": 0,
+    "connections_opened": 0,
+    "token_fetches": 0,
+    "token_retries": 0,
+}
+
+
+async def _trace(event_name: str, info: dict):
+    if event_name == "connection.connect_tcp.complete":
+        _stats["connections_opened"] += 1
+
+
+def _get_http_client() -> httpx.AsyncClient:
+    global _http_client
+    if _http_client is None:
+        _http_client = httpx.AsyncClient(
+            limits=httpx.Limits(
+                max_connections=BOT_CONNECTOR_MAX_CONNECTIONS,
+                max_keepalive_connections=BOT_CONNECTOR_MAX_CONNECTIONS,
+                keepalive_expiry=BOT_CONNECTOR_KEEPALIVE_EXPIRY
+            ),
+            timeout=httpx.Timeout(BOT_CONNECTOR_TIMEOUT, connect=10.0)
+        )
+    return _http_client
+
+
+class _TokenCache:
+    """Token de la app por (app id, scope), con un único refresco en curso"""
+
+    def __init__(self):
+        # clave -> (token, renovar a partir de time.time())
+        self._tokens: Dict[Tuple[str, str], Tuple[str, float]] = {}
+        self._pending: Dict[Tuple[str, str], asyncio.Future] = {}
+
+    async def get(self, credentials: AppCredentials, force: bool = False) -> str:
+        key = (credentials.microsoft_app_id, credentials.oauth_scope)
+        entry = self._tokens.get(key)
+        if entry is not None and not force and entry[1] > time.time():
+            return entry[0]
+        pending = self._pending.get(key)
+        if pending is None:
+            pending = asyncio.ensure_future(self._fetch(key, credentials, force))
+            self._pending[key] = pending
+            pending.add_done_callback(lambda _: self._pending.pop(key, None))
+        return await asyncio.shield(pending)
+
+    async def _fetch(self, key: Tuple[str, str], credentials: AppCredentials, force: bool) -> str:
+        # MSAL hace I/O bloqueante (descubrimiento de authority, petición a AAD)
+        token = await asyncio.to_thread(credentials.get_access_token, force)
+        _stats["token_fetches"] += 1
+        self._tokens[key] = (token, _refresh_at(token))
+        return token
+
+
+def _refresh_at(token: str) -> float:
+    try:
+        exp = jwt.decode(token, options={"verify_signature": False}).get("exp")
+    except jwt.PyJWTError:
+        exp = None
+    if not isinstance(exp, (int, float)):
+        return time.time() + TOKEN_DEFAULT_TTL
+    return float(exp) - TOKEN_REFRESH_MARGIN
+
+
+_tokens = _TokenCache()
+
+
+class _TokenPolicy(AsyncHTTPPolicy):
+    """Firma con el token cacheado; ante un 401 lo renueva y reintenta una vez"""
+
+    def __init__(self, credentials: AppCredentials):
+        super().__init__()
+        self._credentials = credentials
+
+    async def send(self, request: Request, **kwargs: Any) -> Response:
+        if not self._credentials._should_set_token(None):
+            return await self.next.send(request, **kwargs)
+        token = await _tokens.get(self._credentials)
+        request.http_request.headers["Authorization"] = f"Bearer {token}"
+        response = await self.next.send(request, **kwargs)
+        if response.http_response.status_code == 401:
+            _stats["token_retries"] += 1
+            token = await _tokens.get(self._credentials, force=True)
+            request.http_request.headers["Authorization"] = f"Bearer {token}"
+            response = await self.next.send(request, **kwargs)
+        return response
+
+
+class _HttpxClientResponse(AsyncClientResponse):
+    def __init__(self, request: ClientRequest, response: httpx.Response):
+        super().__init__(request, response)
+        self.status_code = response.status_code
+        self.headers = response.headers
+        self.reason = response.reason_phrase
+
+    def body(self) -> bytes:
+        return self.internal_response.content
+
+
+class _HttpxDriver(AsyncHTTPSender):
+    """Driver msrest sobre el httpx.AsyncClient compartido"""
+
+    async def __aenter__(self):
+        return self
+
+    async def __aexit__(self, *exc_details):
+        # El pool es del proceso, no de cada ConnectorClient
+        pass
+
+    async def send(self, request: ClientRequest, **config: Any) -> AsyncClientResponse:
+        _stats["requests"] += 1
+        started = time.perf_counter()
+        response = await _get_http_client().request(
+            request.method,
+            request.url,
+            headers=dict(request.headers),
+            content=request.data,
+            extensions={"trace": _trace}
+        )
+        CONNECTOR_DURATION.observe(time.perf_counter() - started, request.method, str(response.status_code))
+        return _HttpxClientResponse(request, response)
+
+
+class _PipelineSender(AsyncPipelineSender):
+    def __init__(self):
+        self.driver = _HttpxDriver()
+
+    async def __aenter__(self):
+        return self
+
+    async def __aexit__(self, *exc_details):
+        pass
+
+    async def send(self, request: Request, **config: Any) -> Response:
+        return Response(request, await self.driver.send(request.http_request))
+
+
+def _build_pipeline(config) -> AsyncPipeline:
+    """Mismas políticas que el pipeline por defecto del SDK, con firma y envío propios"""
+    policies = [config.user_agent_policy, RawDeserializer(), config.http_logger_policy]
+    if config.credentials:
+        policies.insert(1, _TokenPolicy(config.credentials))
+    return AsyncPipeline(policies, _PipelineSender())
+
+
+class PooledBotFrameworkAdapter(bot_auth.CachingBotFrameworkAdapter):
+    """Adapter cuyos ConnectorClient comparten el pool httpx del proceso"""
+
+    def _get_or_create_connector_client(self, service_url: str, credentials: AppCredentials) -> ConnectorClient:
+        if not BOT_CONNECTOR_POOLED:
+            return super()._get_or_create_connector_client(service_url, credentials)
+        if not credentials:
+            credentials = MicrosoftAppCredentials.empty()
+        client_key = self.key_for_connector_client(service_url, credentials.microsoft_app_id, credentials.oauth_scope)
+        client = self._connector_client_cache.get(client_key)
+        if not client:
+            client = ConnectorClient(credentials, base_url=service_url, pipeline_type=_build_pipeline)
+            client.config.add_user_agent(USER_AGENT)
+            self._connector_client_cache[client_key] = client
+        return client
+
+
+async def shutdown():
+    """Cierra el pool del conector"""
+    global _http_client
+    if _http_client is not None:
+        await _http_client.aclose()
+        logger.info("👋 Pool del Bot Connector cerrado")
+    _http_client = None
+
+
+def stats() -> dict:
+    requests = _stats["requests"]
+    opened = _stats["connections_opened"]
+    return {
+        **_stats,
+        "connections_reused": max(requests - opened, 0),
+        "pooled": BOT_CONNECTOR_POOLED,
+    }
+
+
+metrics.register_stats("bot_connector", stats)
@@ -0,0 +1,347 @@
+"""
+Memoria de conversación del bot de Teams, por id de conversación
+
+Cada proceso guarda en RAM los turnos recientes de las conversaciones activas
+(LRU con topes de turnos y bytes). Con una ruta SQLite (WAL; BOT_MEMORY_DB, que
+por defecto es bot_memory.db) los turnos se comparten entre workers: las escrituras se agrupan y se vuelcan en segundo
+plano, y en cada lectura se compara el último id escrito en disco con el de
+la copia local para recargar solo si otro worker añadió turnos.
+"""
+import asyncio
+import logging
+import sqlite3
+import threading
+import time
+from collections import OrderedDict, deque
+from typing import Dict, List, Optional, Tuple
+
+import metrics
+from config import (
+    BOT_MEMORY_ENABLED,
+    BOT_MEMORY_MAX_TURNS,
+    BOT_MEMORY_MAX_BYTES,
+    BOT_MEMORY_TTL,
+    BOT_MEMORY_MAX_CACHED,
+    BOT_MEMORY_DB,
+    BOT_MEMORY_FLUSH_INTERVAL
+)
+
+logger = logging.getLogger(__name__)
+
+# Cada cuánto se borran en disco los turnos caducados
+PURGE_INTERVAL = 300.0
+
+
+class Turn:
+    __slots__ = ("role", "content", "at", "size")
+
+    def __init__(self, role: str, content: str, at: float):
+        self.role = role
+        self.content = content
+        self.at = at
+        self.size = len(content.encode("utf-8"))
+
+
+class Conversation:
+    """Turnos recientes de una conversación y su sincronización con disco"""
+    __slots__ = ("turns", "size", "last_seen", "synced_id", "unflushed")
+
+    def __init__(self):
+        self.turns = deque()
+        self.size = 0
+        self.last_seen = time.monotonic()
+        # Último id de disco incorporado a esta copia
+        self.synced_id = 0
+        # Turnos del final de la cola aún no volcados a disco
+        self.unflushed = 0
+
+
+class _SQLiteTurns:
+    """Turnos en disco, una fila por turno (los workers solo insertan)
+
+    Las escrituras van por una conexión usada desde un hilo; las lecturas, por
+    otra conexión en el propio event loop: en WAL un lector no espera al
+    escritor y una consulta por índice cuesta microsegundos.
+    """
+
+    def __init__(self, path: str):
+        self._lock = threading.Lock()
+        self._db = sqlite3.connect(path, check_same_thread=False, isolation_level=None)
+        self._db.execute("PRAGMA journal_mode=WAL")
+        self._db.execute("PRAGMA synchronous=NORMAL")
+        self._db.execute(
+            "CREATE TABLE IF NOT EXISTS conversation_turns ("
+            "id INTEGER PRIMARY KEY AUTOINCREMENT, conversation_id TEXT NOT NULL, "
+            "role TEXT NOT NULL, content TEXT NOT NULL, at REAL NOT NULL)"
+        )
+        self._db.execute(
+            "CREATE INDEX IF NOT EXISTS conversation_turns_by_id "
+            "ON conversation_turns (conversation_id, id)"
+        )
+        # Espera corta: si la base está bloqueada se sirve la copia en memoria
+        self._reader = sqlite3.connect(path, check_same_thread=False, isolation_level=None, timeout=0.05)
+
+    def last_id(self, conversation_id: str) -> int:
+        row = self._reader.execute(
+            "SELECT MAX(id) FROM conversation_turns WHERE conversation_id = ?", (conversation_id,)
+        ).fetchone()
+        return row[0] or 0
+
+    def load(self, conversation_id: str, limit: int, since: float) -> List[tuple]:
+        """Últimos turnos no caducados, del más antiguo al más reciente"""
+        rows = self._reader.execute(
+            "SELECT id, role, content, at FROM conversation_turns "
+            "WHERE conversation_id = ? AND at > ? ORDER BY id DESC LIMIT ?",
+            (conversation_id, since, limit)
+        ).fetchall()
+        rows.reverse()
+        return rows
+
+    def append_many(self, turns: List[tuple], keep: int) -> Dict[str, Tuple[int, int]]:
+        """Inserta un lote en una transacción y recorta cada conversación a keep turnos
+
+        Devuelve, por conversación, el último id que había antes del lote y el
+        último id del lote.
+        """
+        ids: Dict[str, Tuple[int, int]] = {}
+        with self._lock:
+            self._db.execute("BEGIN IMMEDIATE")
+            try:
+                for conversation_id, role, content, at in turns:
+                    if conversation_id not in ids:
+                        row = self._db.execute(
+                            "SELECT MAX(id) FROM conversation_turns WHERE conversation_id = ?", (conversation_id,)
+                        ).fetchone()
+                        ids[conversation_id] = (row[0] or 0, 0)
+                    cursor = self._db.execute(
+                        "INSERT INTO conversation_turns (conversation_id, role, content, at) VALUES (?, ?, ?, ?)",
+                        (conversation_id, role, content, at)
+                    )
+                    ids[conversation_id] = (ids[conversation_id][0], cursor.lastrowid)
+                for conversation_id in ids:
+                    self._db.execute(
+                        "DELETE FROM conversation_turns WHERE conversation_id = ? AND id <= ("
+                        "SELECT id FROM conversation_turns WHERE conversation_id = ? "
+                        "ORDER BY id DESC LIMIT 1 OFFSET ?)",
+                        (conversation_id, conversation_id, keep)
+                    )
+                self._db.execute("COMMIT")
+            except BaseException:
+                self._db.execute("ROLLBACK")
+                raise
+        return ids
+
+    def delete(self, conversation_id: str):
+        with self._lock:
+            self._db.execute("DELETE FROM conversation_turns WHERE conversation_id = ?", (conversation_id,))
+
+    def purge(self, since: float):
+        with self._lock:
+            self._db.execute("DELETE FROM conversation_turns WHERE at <= ?", (since,))
+
+
+class ConversationStore:
+    """Historial acotado por conversación: caché en proceso + SQLite compartido opcional"""
+
+    def __init__(
+        self,
+        max_turns: int,
+        max_bytes: int,
+        ttl: float,
+        max_cached: int,
+        db_path: str = "",
+        flush_interval: float = 0.05
+    ):
+        self.max_turns = max_turns
+        self.max_bytes = max_bytes
+        self.ttl = ttl
+        self.max_cached = max_cached
+        self.flush_interval = flush_interval
+        self._cache: "OrderedDict[str, Conversation]" = OrderedDict()
+        self._disk = _SQLiteTurns(db_path) if db_path else None
+        # Turnos pendientes de volcar: (conversation_id, Turn)
+        self._pending: List[Tuple[str, Turn]] = []
+        self._flush_lock = asyncio.Lock()
+        self._flusher: Optional[asyncio.Task] = None
+        self._purged_at = 0.0
+        self.hits = 0
+        self.reloads = 0
+        self.flushes = 0
+        self.flushed_turns = 0
+        self.flush_errors = 0
+
+    async def start(self):
+        if self._disk is not None and self._flusher is None:
+            self._flusher = asyncio.create_task(self._flush_loop())
+
+    async def stop(self):
+        """Vuelca lo pendiente antes de apagar"""
+        if self._flusher is not None:
+            self._flusher.cancel()
+            await asyncio.gather(self._flusher, return_exceptions=True)
+            self._flusher = None
+        await self.flush()
+
+    async def history(self, conversation_id: str) -> List[dict]:
+        """Turnos recientes en formato de mensajes de chat"""
+        conversation = self._get(conversation_id)
+        if self._disk is not None:
+            conversation = await self._sync(conversation_id, conversation)
+        if conversation is None:
+            return []
+        return [{"role": turn.role, "content": turn.content} for turn in conversation.turns]
+
+    def append(self, conversation_id: str, role: str, content: str):
+        """Agrega un turno en memoria y lo deja en cola para disco"""
+        conversation = self._get(conversation_id)
+        if conversation is None:
+            conversation = Conversation()
+            self._cache[conversation_id] = conversation
+            while len(self._cache) > self.max_cached:
+                self._cache.popitem(last=False)
+        turn = Turn(role, content, time.time())
+        self._push(conversation, turn)
+        if self._disk is not None:
+            conversation.unflushed += 1
+            self._pending.append((conversation_id, turn))
+
+    async def clear(self, conversation_id: str):
+        self._cache.pop(conversation_id, None)
+        if self._disk is not None:
+            async with self._flush_lock:
+                self._pending = [(cid, turn) for cid, turn in self._pending if cid != conversation_id]
+                await asyncio.to_thread(self._disk.delete, conversation_id)
+
+    async def flush(self):
+        """Escribe en una sola transacción todos los turnos pendientes"""
+        if self._disk is None or not self._pending:
+            return
+        async with self._flush_lock:
+            batch, self._pending = self._pending, []
+            if not batch:
+                return
+            rows = [(cid, turn.role, turn.content, turn.at) for cid, turn in batch]
+            try:
+                ids = await asyncio.to_thread(self._disk.append_many, rows, self.max_turns)
+            except Exception as e:
+                # Se reintenta en el próximo volcado
+                self._pending = batch + self._pending
+                self.flush_errors += 1
+                logger.warning(f"⚠️ No se pudo guardar la memoria de conversación: {e}")
+                return
+            counts: Dict[str, int] = {}
+            for cid, _ in batch:
+                counts[cid] = counts.get(cid, 0) + 1
+            for cid, (previous_id, last_id) in ids.items():
+                conversation = self._cache.get(cid)
+                if conversation is not None:
+                    conversation.unflushed = max(conversation.unflushed - counts[cid], 0)
+                    # Si otro worker escribió antes que este lote, la copia no está al día:
+                    # synced_id no avanza y la próxima lectura recarga desde disco
+                    if conversation.synced_id == previous_id:
+                        conversation.synced_id = last_id
+            self.flushes += 1
+            self.flushed_turns += len(batch)
+
+    def stats(self) -> dict:
+        return {
+            "cached": len(self._cache),
+            "hits": self.hits,
+            "reloads": self.reloads,
+            "pending": len(self._pending),
+            "flushes": self.flushes,
+            "flushed_turns": self.flushed_turns,
+            "flush_errors": self.flush_errors,
+            "shared": self._disk is not None,
+        }
+
+    def _get(self, conversation_id: str) -> Optional[Conversation]:
+        conversation = self._cache.get(conversation_id)
+        if conversation is None:
+            return None
+        now = time.monotonic()
+        if now - conversation.last_seen > self.ttl:
+            del self._cache[conversation_id]
+            return None
+        conversation.last_seen = now
+        self._cache.move_to_end(conversation_id)
+        return conversation
+
+    async def _sync(self, conversation_id: str, conversation: Optional[Conversation]) -> Optional[Conversation]:
+        """Recarga desde disco solo si otro worker escribió después de nuestra copia"""
+        try:
+            last_id = self._disk.last_id(conversation_id)
+        except sqlite3.Error as e:
+            logger.warning(f"⚠️ Memoria de conversación no disponible en disco: {e}")
+            return conversation
+        if conversation is not None and last_id == conversation.synced_id:
+            self.hits += 1
+            return conversation
+        if conversation is None and last_id == 0:
+            return None
+        async with self._flush_lock:
+            # Un volcado propio recién terminado puede haber igualado los ids
+            if conversation is not None and conversation.synced_id >= last_id:
+                self.hits += 1
+                return conversation
+            try:
+                rows = self._disk.load(conversation_id, self.max_turns, time.time() - self.ttl)
+            except sqlite3.Error as e:
+                logger.warning(f"⚠️ Memoria de conversación no disponible en disco: {e}")
+                return conversation
+            fresh = Conversation()
+            for row_id, role, content, at in rows:
+                self._push(fresh, Turn(role, content, at))
+            fresh.synced_id = last_id
+            if conversation is not None and conversation.unflushed:
+                # Turnos locales aún en cola: siguen siendo los más recientes
+                for turn in list(conversation.turns)[-conversation.unflushed:]:
+                    self._push(fresh, turn)
+                fresh.unflushed = conversation.unflushed
+            self._cache[conversation_id] = fresh
+            self._cache.move_to_end(conversation_id)
+            while len(self._cache) > self.max_cached:
+                self._cache.popitem(last=False)
+            self.reloads += 1
+            return fresh
+
+    def _push(self, conversation: Conversation, turn: Turn):
+        """Agrega al final respetando los topes de turnos y bytes"""
+        conversation.turns.append(turn)
+        conversation.size += turn.size
+        while len(conversation.turns) > 1 and (
+            len(conversation.turns) > self.max_turns or conversation.size > self.max_bytes
+        ):
+            conversation.size -= conversation.turns.popleft().size
+
+    async def _flush_loop(self):
+        while True:
+            await asyncio.sleep(self.flush_interval)
+            await self.flush()
+            if time.monotonic() - self._purged_at >= PURGE_INTERVAL:
+                self._purged_at = time.monotonic()
+                try:
+                    await asyncio.to_thread(self._disk.purge, time.time() - self.ttl)
+                except Exception as e:
+                    logger.warning(f"⚠️ No se pudieron purgar turnos caducados: {e}")
+
+
+_store: Optional[ConversationStore] = None
+
+
+def get_store() -> Optional[ConversationStore]:
+    """Memoria compartida del proceso (None si está deshabilitada)"""
+    global _store
+    if BOT_MEMORY_ENABLED and _store is None:
+        _store = ConversationStore(
+            BOT_MEMORY_MAX_TURNS,
+            BOT_MEMORY_MAX_BYTES,
+            BOT_MEMORY_TTL,
+            BOT_MEMORY_MAX_CACHED,
+            BOT_MEMORY_DB,
+            BOT_MEMORY_FLUSH_INTERVAL
+        )
+    return _store
+
+
+metrics.register_stats("bot_memory", lambda: _store.stats() if _store else None)
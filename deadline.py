@@ -0,0 +1,246 @@
+"""
+Plazo de cada petición y cancelación del trabajo que ya nadie espera
+
+El plazo empieza al entrar la petición (DeadlineMiddleware) y viaja en un
+contextvar hasta la llamada a Azure OpenAI; los turnos del bot encolados
+conservan el de la petición que los trajo. Con lo que queda se acotan:
+
+- la espera por plaza (admission) y por cuota (rate_governor)
+- los reintentos y sus pausas (router)
+- el timeout de cada llamada, en lugar de los 60 s del cliente compartido
+
+Si el cliente cierra la conexión antes de recibir la respuesta, el middleware
+cancela la petición en curso, streaming incluido, y la llamada a Azure se corta
+ahí. Al apagar (SIGTERM en el worker de gunicorn, o el lifespan), ningún plazo
+pasa de DEADLINE_DRAIN_TIMEOUT: lo que esté en curso termina o se rinde dentro
+del margen de graceful_timeout.
+
+Las llamadas cortadas se cuentan por motivo (disconnect, deadline, shutdown)
+junto con una estimación de los tokens de respuesta que no se generaron.
+"""
+import asyncio
+import contextvars
+import logging
+import time
+from typing import Optional
+
+import metrics
+from rate_governor import RateLimited
+from config import (
+    REQUEST_DEADLINE,
+    DEADLINE_DRAIN_TIMEOUT
+)
+
+logger = logging.getLogger(__name__)
+
+UPSTREAM_CANCELLED = metrics.counter(
+    "upstream_cancelled_total",
+    "Llamadas al modelo abandonadas antes de terminar, por tipo y motivo",
+    ("kind", "reason")
+)
+UPSTREAM_SAVED_TOKENS = metrics.counter(
+    "upstream_cancelled_saved_tokens_total",
+    "Tokens de respuesta que se estima que no llegaron a generarse por las cancelaciones",
+    ("reason",)
+)
+
+
+class DeadlineExceeded(RateLimited):
+    """Se agotó el plazo de la petición; se responde como a una falta de cupo"""
+
+    def __init__(self):
+        super().__init__("Plazo de la petición agotado", retry_after=1.0)
+
+
+class _Budget:
+    """Plazo de una petición (monotonic) y, si se canceló, por qué"""
+    __slots__ = ("until", "cancelled")
+
+    def __init__(self, until: float):
+        self.until = until
+        self.cancelled: Optional[str] = None
+
+
+_budget: contextvars.ContextVar[Optional[_Budget]] = contextvars.ContextVar("deadline", default=None)
+
+# Tope para todos los plazos desde que empieza el apagado
+_drain_until: Optional[float] = None
+
+# Media móvil de tokens de respuesta de las llamadas completas (para estimar el ahorro)
+_expected_completion: Optional[float] = None
+
+_stats = {
+    "cancelled": 0,
+    "billed_tokens": 0,
+    "saved_tokens": 0,
+}
+
+
+def start(budget: float = REQUEST_DEADLINE) -> contextvars.Token:
+    """Abre un plazo nuevo para el contexto actual (petición o tarea en segundo plano)"""
+    return _budget.set(_Budget(time.monotonic() + budget))
+
+
+def reset(token: contextvars.Token):
+    _budget.reset(token)
+
+
+def at() -> Optional[float]:
+    """Instante (monotonic) en que vence el plazo; None sin plazo ni apagado"""
+    current = _budget.get()
+    until = current.until if current is not None else None
+    if _drain_until is not None:
+        until = _drain_until if until is None else min(until, _drain_until)
+    return until
+
+
+def remaining() -> Optional[float]:
+    until = at()
+    return None if until is None else until - time.monotonic()
+
+
+def expired() -> bool:
+    left = remaining()
+    return left is not None and left <= 0
+
+
+def budget(limit: float) -> float:
+    """limit recortado a lo que le queda a la petición"""
+    left = remaining()
+    return limit if left is None else max(min(limit, left), 0.0)
+
+
+def check():
+    """Lanza DeadlineExceeded si ya no queda plazo"""
+    if expired():
+        raise DeadlineExceeded()
+
+
+async def sleep(seconds: float):
+    """Pausa entre reintentos; si no cabe en el plazo, no merece la pena esperar"""
+    left = remaining()
+    if left is not None and seconds >= left:
+        raise DeadlineExceeded()
+    await asyncio.sleep(seconds)
+
+
+def begin_drain(budget: float = DEADLINE_DRAIN_TIMEOUT):
+    """Apagado: ningún plazo, en curso o futuro, pasa de budget segundos desde ahora"""
+    global _drain_until
+    until = time.monotonic() + budget
+    if _drain_until is None or until < _drain_until:
+        _drain_until = until
+        logger.info(f"🚦 Apagando: lo que esté en curso tiene {budget:.0f}s para terminar")
+
+
+def draining() -> bool:
+    return _drain_until is not None
+
+
+def _reason() -> str:
+    current = _budget.get()
+    if current is not None and current.cancelled:
+        return current.cancelled
+    if draining():
+        return "shutdown"
+    return "deadline" if expired() else "cancelled"
+
+
+def observe_completion(completion_tokens: int):
+    """Tokens de respuesta de una llamada que terminó (referencia para el ahorro)"""
+    global _expected_completion
+    if _expected_completion is None:
+        _expected_completion = float(completion_tokens)
+    else:
+        _expected_completion += 0.1 * (completion_tokens - _expected_completion)
+
+
+def record_cancel(kind: str, generated_tokens: int = 0):
+    """Una llamada al modelo (call o stream) abandonada tras generar generated_tokens"""
+    reason = _reason()
+    saved = max(int((_expected_completion or 0) - generated_tokens), 0)
+    UPSTREAM_CANCELLED.inc(kind, reason)
+    UPSTREAM_SAVED_TOKENS.inc(reason, amount=saved)
+    _stats["cancelled"] += 1
+    _stats["billed_tokens"] += generated_tokens
+    _stats["saved_tokens"] += saved
+    logger.info(f"✂️ Llamada al modelo cortada ({reason}) tras {generated_tokens} tokens")
+
+
+def stats() -> dict:
+    return {
+        **_stats,
+        "expected_completion_tokens": round(_expected_completion or 0, 1),
+        "draining": draining(),
+    }
+
+
+class DeadlineMiddleware:
+    """Middleware ASGI puro: abre el plazo y cancela la petición si el cliente se va
+
+    Una vez leído el cuerpo, solo este middleware escucha la conexión: la app
+    (StreamingResponse, request.is_disconnected()) recibe el http.disconnect a
+    través de él. Tras enviar la respuesta completa ya no se cancela nada
+    (tareas en segundo plano de la propia petición).
+    """
+
+    def __init__(self, app):
+        self.app = app
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http":
+            await self.app(scope, receive, send)
+            return
+
+        current = _Budget(time.monotonic() + REQUEST_DEADLINE)
+        token = _budget.set(current)
+        task = asyncio.current_task()
+        body_read = asyncio.Event()
+        disconnected = asyncio.Event()
+        responded = False
+
+        async def receive_guarded():
+            if body_read.is_set():
+                await disconnected.wait()
+                return {"type": "http.disconnect"}
+            message = await receive()
+            if message["type"] == "http.disconnect":
+                disconnected.set()
+            elif not message.get("more_body", False):
+                body_read.set()
+            return message
+
+        async def send_tracked(message):
+            nonlocal responded
+            if message["type"] == "http.response.body" and not message.get("more_body", False):
+                responded = True
+            await send(message)
+
+        async def watch():
+            await body_read.wait()
+            message = await receive()
+            if message["type"] == "http.disconnect":
+                disconnected.set()
+                if not responded:
+                    current.cancelled = "disconnect"
+                    task.cancel()
+
+        watcher = asyncio.create_task(watch())
+        try:
+            await self.app(scope, receive_guarded, send_tracked)
+        except asyncio.CancelledError:
+            if current.cancelled != "disconnect":
+                raise
+            # Nadie espera ya la respuesta: se da por atendida
+            task.uncancel()
+        finally:
+            watcher.cancel()
+            _budget.reset(token)
+
+
+def instrument(app):
+    """Añade el plazo por petición y la cancelación por desconexión a una app FastAPI"""
+    app.add_middleware(DeadlineMiddleware)
+
+
+metrics.register_stats("deadline", stats)
@@ -0,0 +1,277 @@
+"""
+Respuestas frecuentes sin llamar al modelo (atajo antes de Azure OpenAI)
+
+FAQ_FILE es un JSON con una lista de entradas:
+
+    [{"id": "vacaciones",
+      "questions": ["¿Cómo pido vacaciones?", "solicitar días libres"],
+      "answer": "Se solicitan en el portal de RR. HH. ...",
+      "links": [{"title": "Portal de RR. HH.", "url": "https://..."}]}]
+
+Cada variante se normaliza (minúsculas, sin acentos ni puntuación ni palabras
+vacías) y se indexa por trigramas de caracteres: los errores de tecleo y los
+plurales siguen coincidiendo. Las negaciones y los interrogativos no son
+palabras vacías aquí: "¿cuándo NO se paga?" no es "¿cuándo se paga?".
+
+Una consulta se responde desde la tabla solo si:
+
+- su similitud (Dice de trigramas) con la mejor variante llega a FAQ_MIN_SCORE
+  y supera por FAQ_MIN_MARGIN a la mejor de otra entrada
+- la consulta y la variante están ambas negadas o ninguna lo está
+- cada palabra de la consulta se parece a alguna de la variante ("cambio
+  contraseña wifi" no es "¿cómo cambio mi contraseña?")
+
+Si no, sigue al modelo. El fichero se recarga solo cuando cambia, sin reiniciar.
+"""
+import json
+import logging
+import os
+import re
+import time
+from typing import Dict, List, Optional, Tuple
+
+import metrics
+from normalize import STOPWORDS, normalize_message
+from config import (
+    FAQ_FILE,
+    FAQ_MIN_SCORE,
+    FAQ_MIN_MARGIN,
+    FAQ_RELOAD_INTERVAL
+)
+
+logger = logging.getLogger(__name__)
+
+FAQ_LOOKUPS = metrics.counter(
+    "faq_lookups_total",
+    "Consultas al atajo de respuestas frecuentes por superficie y resultado (hit, miss, ambiguous)",
+    ("surface", "result")
+)
+
+
+NEGATIONS = frozenset("no ni nunca jamas tampoco sin nada nadie ningun ninguna".split())
+INTERROGATIVES = frozenset(
+    "como cual cuales cuando cuanto cuanta cuantos cuantas donde que quien quienes porque".split()
+)
+# Las generales menos lo que cambia la pregunta, más cortesías que no la cambian
+FAQ_STOPWORDS = (STOPWORDS - NEGATIONS - INTERROGATIVES) | frozenset(
+    "hola buenas buenos dias tardes noches gracias favor porfa".split()
+)
+
+_POR_QUE = re.compile(r"\bpor que\b")
+
+# Parecido mínimo (Dice de trigramas) de una palabra de la consulta con la de la variante
+WORD_MIN_SCORE = 0.5
+
+
+def _key(text: str) -> str:
+    """Palabras que distinguen la consulta, normalizadas ("por qué" cuenta como una)"""
+    text = _POR_QUE.sub("porque", normalize_message(text))
+    return " ".join(w for w in text.split() if w not in FAQ_STOPWORDS)
+
+
+def _negated(key: str) -> bool:
+    return not NEGATIONS.isdisjoint(key.split())
+
+
+def _trigrams(key: str) -> Dict[str, int]:
+    grams: Dict[str, int] = {}
+    for word in key.split():
+        padded = f" {word} "
+        for i in range(len(padded) - 2):
+            gram = padded[i:i + 3]
+            grams[gram] = grams.get(gram, 0) + 1
+    return grams
+
+
+def _dice(a: Dict[str, int], b: Dict[str, int]) -> float:
+    common = sum(min(count, b.get(gram, 0)) for gram, count in a.items())
+    return 2 * common / (sum(a.values()) + sum(b.values()))
+
+
+def _covered(key: str, variant_key: str) -> bool:
+    """Cada palabra de la consulta tiene una parecida en la variante"""
+    variant_words = [_trigrams(w) for w in variant_key.split()]
+    return all(
+        any(_dice(_trigrams(word), other) >= WORD_MIN_SCORE for other in variant_words)
+        for word in key.split()
+    )
+
+
+class Answer:
+    """Entrada de la tabla: respuesta fija y enlaces"""
+    __slots__ = ("id", "answer", "links")
+
+    def __init__(self, id: str, answer: str, links: List[dict]):
+        self.id = id
+        self.answer = answer
+        self.links = links
+
+    def text(self) -> str:
+        """Respuesta con los enlaces en markdown (Teams y chats web)"""
+        if not self.links:
+            return self.answer
+        links = "\n".join(f"🔗 [{link['title']}]({link['url']})" for link in self.links)
+        return f"{self.answer}\n\n{links}"
+
+
+class FaqIndex:
+    """Índice invertido trigrama -> variantes, construido una vez por versión del fichero"""
+
+    def __init__(self, entries: List[dict]):
+        self.answers: List[Answer] = []
+        # Por variante: entrada a la que pertenece, clave, si está negada y número de trigramas
+        self._owner: List[int] = []
+        self._keys: List[str] = []
+        self._negated: List[bool] = []
+        self._sizes: List[int] = []
+        self._exact: Dict[str, int] = {}
+        self._postings: Dict[str, List[Tuple[int, int]]] = {}
+        for n, entry in enumerate(entries):
+            self.answers.append(Answer(str(entry.get("id", n)), entry["answer"], entry.get("links") or []))
+            for question in entry["questions"]:
+                key = _key(question)
+                if not key:
+                    continue
+                variant = len(self._owner)
+                self._owner.append(n)
+                self._keys.append(key)
+                self._negated.append(_negated(key))
+                grams = _trigrams(key)
+                self._sizes.append(sum(grams.values()))
+                self._exact.setdefault(key, n)
+                for gram, count in grams.items():
+                    self._postings.setdefault(gram, []).append((variant, count))
+
+    def __len__(self) -> int:
+        return len(self.answers)
+
+    def match(self, text: str) -> Tuple[Optional[Answer], float, float]:
+        """(mejor entrada, su similitud, similitud de la mejor de otra entrada)
+
+        La entrada es None si su mejor variante deja palabras de la consulta sin cubrir.
+        """
+        key = _key(text)
+        if not key:
+            return None, 0.0, 0.0
+        exact = self._exact.get(key)
+        if exact is not None:
+            return self.answers[exact], 1.0, 0.0
+        grams = _trigrams(key)
+        size = sum(grams.values())
+        shared: Dict[int, int] = {}
+        for gram, count in grams.items():
+            for variant, variant_count in self._postings.get(gram, ()):
+                shared[variant] = shared.get(variant, 0) + min(count, variant_count)
+        negated = _negated(key)
+        # Mejor similitud por entrada (la de su variante más parecida)
+        best: Dict[int, Tuple[float, int]] = {}
+        for variant, common in shared.items():
+            if self._negated[variant] != negated:
+                continue
+            score = 2 * common / (size + self._sizes[variant])
+            owner = self._owner[variant]
+            if score > best.get(owner, (0.0, 0))[0]:
+                best[owner] = (score, variant)
+        if not best:
+            return None, 0.0, 0.0
+        ranked = sorted(best.items(), key=lambda item: item[1][0], reverse=True)
+        (owner, (score, variant)) = ranked[0]
+        runner_up = ranked[1][1][0] if len(ranked) > 1 else 0.0
+        if not _covered(key, self._keys[variant]):
+            return None, score, runner_up
+        return self.answers[owner], score, runner_up
+
+
+class FaqRouter:
+    """Tabla de respuestas del proceso; se reconstruye cuando cambia el fichero"""
+
+    def __init__(self, path: str, min_score: float = FAQ_MIN_SCORE, min_margin: float = FAQ_MIN_MARGIN):
+        self.path = path
+        self.min_score = min_score
+        self.min_margin = min_margin
+        self.index = FaqIndex([])
+        self._loaded_mtime = None
+        self._checked = 0.0
+        self.reloads = 0
+        self.hits = 0
+        self.misses = 0
+        self.ambiguous = 0
+
+    def load(self):
+        """Relee el fichero si cambió; si no es válido se conserva la tabla anterior"""
+        self._checked = time.monotonic()
+        try:
+            mtime = os.stat(self.path).st_mtime_ns
+        except FileNotFoundError:
+            mtime = None
+        if mtime == self._loaded_mtime:
+            return
+        if mtime is None:
+            logger.warning(f"⚠️ FAQ_FILE no encontrado: {self.path}")
+            self.index = FaqIndex([])
+        else:
+            try:
+                with open(self.path, encoding="utf-8") as f:
+                    self.index = FaqIndex(json.load(f))
+            except (OSError, ValueError, KeyError, TypeError) as e:
+                # Se anota la versión para no reintentar (ni avisar) hasta el próximo cambio
+                logger.warning(f"⚠️ FAQ_FILE no válido, se mantiene la tabla anterior: {e}")
+                self._loaded_mtime = mtime
+                return
+            logger.info(f"📋 Respuestas frecuentes cargadas: {len(self.index)} entradas")
+        self._loaded_mtime = mtime
+        self.reloads += 1
+
+    def lookup(self, text: str, surface: str) -> Optional[Answer]:
+        """Respuesta fija si la consulta coincide con confianza; None para ir al modelo"""
+        if time.monotonic() - self._checked >= FAQ_RELOAD_INTERVAL:
+            self.load()
+        answer, score, runner_up = self.index.match(text)
+        if answer is None or score < self.min_score:
+            result = "miss"
+        elif score - runner_up < self.min_margin:
+            # Se parece a dos entradas distintas: mejor que responda el modelo
+            result = "ambiguous"
+        else:
+            result = "hit"
+        FAQ_LOOKUPS.inc(surface, result)
+        if result == "hit":
+            self.hits += 1
+            logger.info(f"📋 FAQ '{answer.id}' ({score:.2f}) en {surface}")
+            return answer
+        if result == "miss":
+            self.misses += 1
+        else:
+            self.ambiguous += 1
+        return None
+
+    def stats(self) -> dict:
+        lookups = self.hits + self.misses + self.ambiguous
+        return {
+            "entries": len(self.index),
+            "reloads": self.reloads,
+            "hits": self.hits,
+            "misses": self.misses,
+            "ambiguous": self.ambiguous,
+            "hit_rate": round(self.hits / lookups, 3) if lookups else 0.0,
+        }
+
+
+_router: Optional[FaqRouter] = None
+
+
+def get_router() -> Optional[FaqRouter]:
+    """Atajo del proceso (None si no hay FAQ_FILE)"""
+    global _router
+    if FAQ_FILE and _router is None:
+        _router = FaqRouter(FAQ_FILE)
+        _router.load()
+    return _router
+
+
+def lookup(text: str, surface: str) -> Optional[Answer]:
+    router = get_router()
+    return router.lookup(text, surface) if router else None
+
+
+metrics.register_stats("faq", lambda: _router.stats() if _router else None)
@@ -0,0 +1,104 @@
+"""
+Configuración de gunicorn para las apps FastAPI (workers uvicorn)
+
+    gunicorn app:app            # bot de Teams
+    gunicorn chat_m:app         # chat web con memoria
+
+Con preload la app se importa una vez en el master: la configuración se valida
+antes de crear workers (un error para el arranque en lugar de reiniciar
+workers en bucle) y los workers comparten por copy-on-write las páginas de
+los SDK ya cargados. Sockets, hilos y SQLite se abren en el lifespan de cada
+worker, nunca en el master.
+
+Al recibir SIGTERM, el worker recorta los plazos en curso a
+DEADLINE_DRAIN_TIMEOUT (deadline.py) y espera a las conexiones como mucho ese
+tiempo; graceful_timeout tiene que cubrirlo más el lifespan de apagado (cola de
+turnos del bot, volcado del libro de consumo).
+"""
+import gc
+import importlib
+import os
+import sys
+
+from gunicorn.arbiter import Arbiter
+from uvicorn.server import Server
+from uvicorn.workers import UvicornWorker
+
+
+class _DrainingServer(Server):
+    """Con la primera señal de salida, los plazos en curso pasan a ser los del drenaje"""
+
+    def handle_exit(self, sig, frame):
+        if not self.should_exit:
+            import deadline
+            deadline.begin_drain()
+        super().handle_exit(sig, frame)
+
+
+class DrainingUvicornWorker(UvicornWorker):
+    """UvicornWorker con apagado acotado por los plazos de deadline.py
+
+    Sin timeout_graceful_shutdown, uvicorn esperaría a las conexiones hasta que
+    gunicorn matase el worker, y el lifespan de apagado no llegaría a correr.
+    """
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        import logging_setup
+        from config import DEADLINE_DRAIN_TIMEOUT
+        # UvicornWorker acaba de poner los handlers síncronos de gunicorn en uvicorn.*
+        logging_setup.route_uvicorn()
+        # Un segundo más para que las respuestas por plazo agotado lleguen a salir
+        self.config.timeout_graceful_shutdown = DEADLINE_DRAIN_TIMEOUT + 1
+
+    async def _serve(self):
+        self.config.app = self.wsgi
+        server = _DrainingServer(config=self.config)
+        self._install_sigquit_handler()
+        await server.serve(sockets=self.sockets)
+        if not server.started:
+            sys.exit(Arbiter.WORKER_BOOT_ERROR)
+
+
+bind = os.environ.get("GUNICORN_BIND", "0.0.0.0:8000")
+# Sin WEB_CONCURRENCY son 2, salvo que la app sirva chat_m (ver on_starting)
+workers = int(os.environ.get("WEB_CONCURRENCY", "2"))
+worker_class = DrainingUvicornWorker
+preload_app = os.environ.get("GUNICORN_PRELOAD", "true").lower() == "true"
+timeout = int(os.environ.get("GUNICORN_TIMEOUT", "60"))
+graceful_timeout = int(os.environ.get("GUNICORN_GRACEFUL_TIMEOUT", "30"))
+keepalive = int(os.environ.get("GUNICORN_KEEPALIVE", "75"))
+
+
+def _served_surfaces(module) -> list:
+    """Superficies que sirve la app: las habilitadas de service.py o la que declara el módulo"""
+    if hasattr(module, "surfaces"):
+        return [name for name, _, _ in module.surfaces]
+    return [module.SURFACE] if hasattr(module, "SURFACE") else []
+
+
+def on_starting(server):
+    """En el master, tras importar la app (si hay preload) y antes del fork"""
+    if not server.cfg.preload_app:
+        # Cada worker valida en su lifespan con el número de workers del entorno
+        os.environ["WEB_CONCURRENCY"] = str(server.num_workers)
+        return
+    import config
+    app_uri = getattr(server.app, "app_uri", None) or server.cfg.wsgi_app
+    module = importlib.import_module(app_uri.split(":")[0])
+    surfaces = _served_surfaces(module)
+    if (
+        "WEB_CONCURRENCY" not in os.environ and "chat_m" in surfaces
+        and not config.CHAT_SESSIONS_STICKY and server.num_workers > 1
+    ):
+        # Las sesiones de chat_m viven en un worker: sin afinidad declarada, uno solo
+        server.num_workers = 1
+        server.log.info("ℹ️ chat_m sin CHAT_SESSIONS_STICKY: se arranca un único worker")
+    config.validate(*surfaces, workers=server.num_workers)
+    # También lo lee este fichero si se recarga con HUP
+    os.environ["WEB_CONCURRENCY"] = str(server.num_workers)
+    if hasattr(module, "preload"):
+        module.preload()
+    # Lo cargado hasta aquí no vuelve a tocarse: el GC no ensucia sus páginas en los workers
+    gc.freeze()
+    server.log.info("✅ App precargada en el master")
@@ -0,0 +1,126 @@
+"""
+Ventana de historial por presupuesto de tokens y resumen incremental en segundo plano
+"""
+import asyncio
+import logging
+from typing import TYPE_CHECKING, List, Optional, Sequence, Set
+
+import deadline
+import llm
+import prompts
+from session_store import Session, SessionStore
+from tokens import MESSAGE_OVERHEAD, count_tokens, messages_tokens
+from config import (
+    CHAT_HISTORY_TOKEN_BUDGET,
+    CHAT_SUMMARY_MAX_TOKENS
+)
+
+if TYPE_CHECKING:
+    from retrieval import Passage
+
+logger = logging.getLogger(__name__)
+
+SUMMARY_PROMPT = (
+    "Resume la conversación anterior entre un empleado y el asistente de Evidenze. "
+    "Conserva datos concretos, decisiones, nombres y preguntas pendientes. "
+    "Responde solo con el resumen, en español y en pocas frases."
+)
+
+
+class HistoryManager:
+    """Arma la ventana de contexto y pliega los turnos viejos en un resumen"""
+
+    def __init__(self, store: SessionStore, budget: int = CHAT_HISTORY_TOKEN_BUDGET):
+        self.store = store
+        self.budget = budget
+        self._tasks: Set[asyncio.Task] = set()
+
+    def build(
+        self,
+        surface: str,
+        session: Session,
+        user_message: str,
+        passages: Sequence["Passage"] = ()
+    ) -> List[dict]:
+        """Prefijo común + resumen + turnos recientes que entren en el presupuesto"""
+        head = prompts.system_messages(surface, session.summary)
+        # Los fragmentos recuperados restan del presupuesto del historial
+        tail = prompts.context_messages(passages) + [{"role": "user", "content": user_message}]
+
+        history = self.store.history(session)
+        keep = self._recent_count(history, self.budget - messages_tokens(head + tail))
+        window = head + history[len(history) - keep:] + tail
+
+        before = messages_tokens(head + history + tail)
+        after = messages_tokens(window)
+        logger.info(f"🧮 Tokens de prompt: {before} -> {after} ({len(history) - keep} turnos fuera de ventana)")
+        return window
+
+    def schedule_compaction(self, session_id: str, surface: str):
+        """Lanza el resumen incremental después de responder (fuera del camino crítico)"""
+        session = self.store.get(session_id)
+        if session is None or session.summarizing:
+            return
+        session.summarizing = True
+        task = asyncio.create_task(self._compact(session_id, session, surface))
+        self._tasks.add(task)
+        task.add_done_callback(self._tasks.discard)
+
+    async def drain(self):
+        """Espera los resúmenes pendientes (apagado)"""
+        if self._tasks:
+            await asyncio.gather(*self._tasks, return_exceptions=True)
+
+    def _recent_count(self, history: List[dict], available: int) -> int:
+        """Cuántos turnos recientes caben en los tokens disponibles"""
+        used = 0
+        keep = 0
+        for message in reversed(history):
+            used += count_tokens(message["content"]) + MESSAGE_OVERHEAD
+            if used > available:
+                break
+            keep += 1
+        return keep
+
+    async def _compact(self, session_id: str, session: Session, surface: str):
+        """Pliega en el resumen los turnos que ya no entran en la ventana"""
+        # Plazo propio: el de la petición que lo disparó ya no aplica
+        deadline.start()
+        try:
+            await self._fold_overflow(session_id, session, surface)
+        except Exception as e:
+            logger.warning(f"⚠️ No se pudo resumir la sesión: {e}")
+        finally:
+            session.summarizing = False
+
+    async def _fold_overflow(self, session_id: str, session: Session, surface: str):
+        # Con hueco para el mensaje de resumen aunque todavía no exista
+        head_tokens = messages_tokens(prompts.system_messages(surface, session.summary or " "))
+        # Margen para el próximo mensaje del usuario
+        available = self.budget - head_tokens - CHAT_SUMMARY_MAX_TOKENS
+        history = self.store.history(session)
+        overflow = len(history) - self._recent_count(history, available)
+        if overflow <= 0:
+            return
+        # Plegar pares completos usuario/asistente
+        overflow = min(overflow + overflow % 2, len(history))
+
+        folded = list(session.turns)[:overflow]
+        summary = await self._summarize(session.summary, history[:overflow])
+        if summary and self.store.fold(session_id, folded, summary):
+            logger.info(f"📝 Sesión resumida: {overflow} turnos plegados")
+
+    async def _summarize(self, previous: Optional[str], turns: List[dict]) -> str:
+        """Resumen rodante: resumen previo + turnos nuevos -> resumen nuevo"""
+        transcript = "\n".join(f"{t['role']}: {t['content']}" for t in turns)
+        if previous:
+            transcript = f"Resumen previo:\n{previous}\n\nNuevos turnos:\n{transcript}"
+        completion = await llm.create_completion(
+            [
+                {"role": "system", "content": SUMMARY_PROMPT},
+                {"role": "user", "content": transcript}
+            ],
+            "EvidenzeChat-Summary/1.0",
+            max_tokens=CHAT_SUMMARY_MAX_TOKENS
+        )
+        return completion.text.strip()
@@ -0,0 +1,164 @@
+"""
+Deduplicación de actividades reenviadas por Bot Framework
+
+Clave: id de conversación + id de actividad. Un duplicado que llega mientras
+el original sigue en curso se une a su resultado; uno que llega después se
+confirma sin hacer nada. Con una ruta SQLite la marca se comparte entre los
+workers de gunicorn.
+"""
+import asyncio
+import logging
+import sqlite3
+import threading
+import time
+from collections import OrderedDict
+from typing import TYPE_CHECKING, Awaitable, Callable, Optional, Tuple
+
+if TYPE_CHECKING:
+    from botbuilder.schema import Activity
+
+logger = logging.getLogger(__name__)
+
+
+def activity_key(activity: "Activity") -> Optional[str]:
+    """Clave de idempotencia; None si la actividad no trae ids"""
+    if not activity.id or not activity.conversation or not activity.conversation.id:
+        return None
+    return f"{activity.conversation.id}\x1f{activity.id}"
+
+
+class _SQLiteClaims:
+    """Marcas compartidas entre procesos (running / done con expiración)"""
+
+    def __init__(self, path: str):
+        self._lock = threading.Lock()
+        self._db = sqlite3.connect(path, check_same_thread=False, isolation_level=None)
+        self._db.execute("PRAGMA journal_mode=WAL")
+        self._db.execute("PRAGMA synchronous=NORMAL")
+        self._db.execute(
+            "CREATE TABLE IF NOT EXISTS activity_claims ("
+            "key TEXT PRIMARY KEY, state TEXT NOT NULL, expires_at REAL NOT NULL)"
+        )
+
+    def claim(self, key: str, ttl: float) -> bool:
+        """True si este proceso se queda con la actividad"""
+        now = time.time()
+        with self._lock:
+            self._db.execute("DELETE FROM activity_claims WHERE key = ? AND expires_at <= ?", (key, now))
+            cursor = self._db.execute(
+                "INSERT OR IGNORE INTO activity_claims (key, state, expires_at) VALUES (?, 'running', ?)",
+                (key, now + ttl)
+            )
+        return cursor.rowcount == 1
+
+    def finish(self, key: str, ttl: float):
+        with self._lock:
+            self._db.execute(
+                "UPDATE activity_claims SET state = 'done', expires_at = ? WHERE key = ?",
+                (time.time() + ttl, key)
+            )
+
+    def release(self, key: str):
+        with self._lock:
+            self._db.execute("DELETE FROM activity_claims WHERE key = ?", (key,))
+
+    def purge(self):
+        with self._lock:
+            self._db.execute("DELETE FROM activity_claims WHERE expires_at <= ?", (time.time(),))
+
+
+class IdempotencyGuard:
+    """Registro acotado y con TTL de actividades ya vistas"""
+
+    def __init__(self, ttl: float, max_entries: int, db_path: str = ""):
+        self.ttl = ttl
+        self.max_entries = max_entries
+        # key -> (expira, future con el resultado del original)
+        self._seen: "OrderedDict[str, Tuple[float, asyncio.Future]]" = OrderedDict()
+        self._disk = _SQLiteClaims(db_path) if db_path else None
+        if self._disk is not None:
+            self._disk.purge()
+        self.claims = 0
+        self.duplicates_inflight = 0
+        self.duplicates_done = 0
+
+    async def begin(self, key: str) -> Optional[asyncio.Future]:
+        """None si el llamante debe procesar la actividad; si es duplicada,
+        el future del original (ya resuelto si terminó o si lo lleva otro worker)
+        """
+        now = time.monotonic()
+        self._expire(now)
+        entry = self._seen.get(key)
+        if entry is not None:
+            future = entry[1]
+            if future.done():
+                self.duplicates_done += 1
+            else:
+                self.duplicates_inflight += 1
+            return future
+
+        # Se registra antes de ir a disco para que un duplicado local no se cuele
+        future = asyncio.get_running_loop().create_future()
+        self._remember(key, future, now)
+        if self._disk is not None and not await asyncio.to_thread(self._disk.claim, key, self.ttl):
+            # Otro worker la está procesando o ya la procesó
+            future.set_result(None)
+            self.duplicates_done += 1
+            return future
+        self.claims += 1
+        return None
+
+    async def finish(self, key: str, result=None):
+        entry = self._seen.get(key)
+        if entry is not None and not entry[1].done():
+            entry[1].set_result(result)
+        if self._disk is not None:
+            await asyncio.to_thread(self._disk.finish, key, self.ttl)
+
+    async def release(self, key: str, error: BaseException):
+        """El original falló: se olvida la marca para que un reintento sí se procese"""
+        entry = self._seen.pop(key, None)
+        if entry is not None and not entry[1].done():
+            entry[1].set_exception(error)
+            # Evita "exception was never retrieved" si no había duplicados esperando
+            entry[1].exception()
+        if self._disk is not None:
+            await asyncio.to_thread(self._disk.release, key)
+
+    async def run(self, key: Optional[str], fn: Callable[[], Awaitable]) -> Tuple[object, bool]:
+        """Ejecuta fn una sola vez por clave; devuelve (resultado, era_duplicado)"""
+        if key is None:
+            return await fn(), False
+        original = await self.begin(key)
+        if original is not None:
+            logger.info("🔁 Actividad duplicada, se reutiliza el resultado del original")
+            return await asyncio.shield(original), True
+        try:
+            result = await fn()
+        except BaseException as e:
+            await self.release(key, e)
+            raise
+        await self.finish(key, result)
+        return result, False
+
+    def stats(self) -> dict:
+        return {
+            "entries": len(self._seen),
+            "claims": self.claims,
+            "duplicates_inflight": self.duplicates_inflight,
+            "duplicates_done": self.duplicates_done,
+            "shared": self._disk is not None,
+        }
+
+    def _remember(self, key: str, future: asyncio.Future, now: float):
+        self._seen[key] = (now + self.ttl, future)
+        while len(self._seen) > self.max_entries:
+            self._seen.popitem(last=False)
+
+    def _expire(self, now: float):
+        # Orden de inserción = orden de expiración (TTL fijo)
+        while self._seen:
+            key, (expires_at, _) = next(iter(self._seen.items()))
+            if expires_at > now:
+                break
+            del self._seen[key]
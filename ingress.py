@@ -0,0 +1,75 @@
+"""
+Clasificación previa de actividades entrantes de Bot Framework
+
+Lee el body con orjson y mira solo tipo, ids y texto. Las actividades que el
+bot ignora (typing, reacciones, conversationUpdate sin miembros nuevos...) se
+responden sin construir el modelo msrest; el resto se deserializa completo.
+Los tipos van como literales (valores de ActivityTypes) para no cargar
+botbuilder.schema hasta que hace falta deserializar.
+"""
+from typing import TYPE_CHECKING, Optional
+
+import orjson
+
+import metrics
+
+if TYPE_CHECKING:
+    from botbuilder.schema import Activity
+
+# Tipos sin handler en TeamsOpenAIBot (ActivityHandler no hace nada con ellos)
+IGNORED_TYPES = frozenset({
+    "typing",
+    "messageReaction",
+    "messageUpdate",
+    "messageDelete",
+    "endOfConversation",
+    "installationUpdate",
+    "contactRelationUpdate",
+    "deleteUserData",
+    "event",
+    "trace",
+    "handoff",
+    "suggestion",
+})
+CONVERSATION_UPDATE = "conversationUpdate"
+
+ACTIVITIES = metrics.counter("bot_activities_total", "Actividades recibidas por tipo y destino", ("type", "route"))
+
+
+class IncomingActivity:
+    """Vista mínima del body de una actividad (sin modelo msrest)"""
+    __slots__ = ("body", "type", "id", "conversation_id", "text")
+
+    def __init__(self, body: dict):
+        self.body = body
+        self.type: Optional[str] = body.get("type")
+        self.id: Optional[str] = body.get("id")
+        conversation = body.get("conversation") or {}
+        self.conversation_id: Optional[str] = conversation.get("id")
+        self.text: Optional[str] = body.get("text")
+
+    @property
+    def ignorable(self) -> bool:
+        """True si el bot no haría nada con esta actividad"""
+        if self.type in IGNORED_TYPES:
+            return True
+        if self.type == CONVERSATION_UPDATE:
+            # Solo se saluda a miembros nuevos que no sean el propio bot
+            bot_id = (self.body.get("recipient") or {}).get("id")
+            members = self.body.get("membersAdded") or []
+            return not any(member.get("id") != bot_id for member in members)
+        return False
+
+    def to_activity(self) -> "Activity":
+        from botbuilder.schema import Activity
+        return Activity().deserialize(self.body)
+
+
+def parse(raw: bytes) -> IncomingActivity:
+    """Parsea el body y registra el tipo; lanza ValueError si no es JSON válido"""
+    body = orjson.loads(raw)
+    if not isinstance(body, dict):
+        raise ValueError("La actividad debe ser un objeto JSON")
+    incoming = IncomingActivity(body)
+    ACTIVITIES.inc(str(incoming.type), "ignored" if incoming.ignorable else "bot")
+    return incoming
@@ -0,0 +1,365 @@
+"""
+Capa de llamadas a Azure OpenAI compartida por el bot y los chats web
+"""
+import asyncio
+import logging
+import time
+from typing import AsyncIterator, List, Optional
+
+import deadline
+import metrics
+import openai
+import orjson
+import prompts
+import rate_governor
+import response_cache
+import router
+import usage_ledger
+from singleflight import LeaderAbandoned, SingleFlight
+from tokens import count_tokens, messages_tokens
+from config import (
+    AZURE_OPENAI_DEPLOYMENT_NAME,
+    MAX_TOKENS,
+    TEMPERATURE,
+    OPENAI_STREAM_USAGE,
+    OPENAI_MAX_RETRIES,
+    SINGLEFLIGHT_ENABLED
+)
+
+logger = logging.getLogger(__name__)
+
+
+class Completion:
+    """Resultado de una completion (de Azure, de la caché o de una llamada compartida)"""
+    __slots__ = ("text", "usage", "cached", "coalesced")
+
+    def __init__(self, text: str, usage=None, cached: bool = False, coalesced: bool = False):
+        self.text = text
+        self.usage = usage
+        self.cached = cached
+        self.coalesced = coalesced
+
+    @property
+    def total_tokens(self) -> int:
+        return self.usage.total_tokens if self.usage else 0
+
+    @property
+    def cached_tokens(self) -> int:
+        """Tokens del prompt servidos desde la caché de prefijos del proveedor"""
+        return metrics.cached_tokens(self.usage) if self.usage else 0
+
+
+BUSY_MESSAGE = "Hay mucha demanda en este momento, intenta de nuevo en unos segundos"
+
+# Llamadas idénticas en vuelo comparten una única petición a Azure
+flight = SingleFlight()
+metrics.register_stats("singleflight", flight.stats)
+
+
+def cache_key(messages: List[dict], max_tokens: int = MAX_TOKENS) -> str:
+    """Clave de caché para prompts de una sola consulta (system + user)
+
+    El prefijo de la clave es el del prompt común (el que fija la caché al
+    arrancar); el resto de mensajes system entra en el hash.
+    """
+    shared = prompts.shared_prefix()
+    extra = "\n".join(
+        m["content"] for m in messages if m["role"] == "system" and m["content"] != shared
+    )
+    return response_cache.make_key(
+        AZURE_OPENAI_DEPLOYMENT_NAME,
+        shared,
+        messages[-1]["content"],
+        (max_tokens, TEMPERATURE, extra)
+    )
+
+
+async def _send(messages: List[dict], user_agent: str, max_tokens: int, **kwargs):
+    """Envía la petición por el router (cuota, reintentos 429, failover, hedging)
+
+    Devuelve la respuesta cruda (con headers) y el ticket para conciliar el cupo.
+    """
+    estimate = messages_tokens(messages) + max_tokens
+    return await router.get_router().send(
+        {
+            "messages": messages,
+            "max_tokens": max_tokens,
+            "temperature": TEMPERATURE,
+            "extra_headers": {"User-Agent": user_agent},
+            **kwargs
+        },
+        estimate,
+        OPENAI_MAX_RETRIES,
+        client=user_agent
+    )
+
+
+def retry_after(error: Exception) -> Optional[float]:
+    """Segundos sugeridos si el error es por cuota; None en otro caso"""
+    if isinstance(error, rate_governor.RateLimited):
+        return error.retry_after
+    if isinstance(error, openai.RateLimitError):
+        return rate_governor.retry_after_seconds(error.response.headers)
+    return None
+
+
+def _reconcile(ticket, total_tokens: Optional[int], headers=None):
+    router.get_router().reconcile(ticket, total_tokens, headers)
+
+
+def _outcome(error: BaseException) -> str:
+    """Resultado de una llamada fallida para el libro de consumo"""
+    if isinstance(error, (asyncio.CancelledError, GeneratorExit)):
+        return "cancelled"
+    if isinstance(error, deadline.DeadlineExceeded):
+        return "deadline"
+    return "rate_limited" if isinstance(error, Exception) and retry_after(error) is not None else "error"
+
+
+def _abandoned(error: BaseException) -> bool:
+    """La llamada se cortó antes de terminar (cliente que se fue, plazo agotado o apagado)"""
+    return isinstance(error, (asyncio.CancelledError, GeneratorExit, deadline.DeadlineExceeded))
+
+
+def _prefix_cache(usage) -> str:
+    """Etiqueta de métricas: si el prefijo del prompt salió de la caché del proveedor"""
+    if usage is None:
+        return "unknown"
+    return "hit" if metrics.cached_tokens(usage) else "miss"
+
+
+async def _call(messages: List[dict], user_agent: str, max_tokens: int) -> Completion:
+    started = time.perf_counter()
+    try:
+        raw, ticket = await _send(messages, user_agent, max_tokens)
+    except BaseException as e:
+        if _abandoned(e):
+            deadline.record_cancel("call")
+        usage_ledger.record(user_agent, "", None, time.perf_counter() - started, _outcome(e))
+        raise
+    response = raw.parse()
+    _reconcile(ticket, response.usage.total_tokens if response.usage else None, raw.headers)
+    metrics.record_usage(user_agent, response.usage)
+    latency = time.perf_counter() - started
+    metrics.OPENAI_PROMPT_LATENCY.observe(latency, user_agent, _prefix_cache(response.usage))
+    usage_ledger.record(user_agent, ticket.backend.deployment, response.usage, latency, "ok")
+    if response.usage:
+        deadline.observe_completion(response.usage.completion_tokens)
+    return Completion(response.choices[0].message.content or "", response.usage)
+
+
+async def _shared(future, user_agent: str) -> Optional[Completion]:
+    """Espera una llamada en vuelo; None si su líder la abandonó"""
+    started = time.perf_counter()
+    try:
+        result = await flight.wait(future)
+    except LeaderAbandoned:
+        return None
+    logger.info("🔗 Respuesta compartida con una llamada en vuelo")
+    usage_ledger.record(user_agent, "", None, time.perf_counter() - started, "coalesced")
+    return Completion(result.text, cached=result.cached, coalesced=True)
+
+
+async def create_completion(
+    messages: List[dict],
+    user_agent: str,
+    max_tokens: int = MAX_TOKENS,
+    cacheable: bool = False
+) -> Completion:
+    """Llamada completa (sin streaming) a chat.completions
+
+    cacheable marca los prompts de una sola consulta: pasan por la caché de
+    respuestas y se coalescen con las llamadas idénticas en vuelo.
+    """
+    if not cacheable:
+        return await _call(messages, user_agent, max_tokens)
+
+    key = cache_key(messages, max_tokens)
+    cache = response_cache.get_cache()
+    if cache is not None:
+        cached = await cache.get(key)
+        if cached is not None:
+            logger.info("⚡ Respuesta servida desde caché")
+            usage_ledger.record(user_agent, "", None, 0.0, "cache")
+            return Completion(cached, cached=True)
+
+    async def call_and_store() -> Completion:
+        completion = await _call(messages, user_agent, max_tokens)
+        if cache is not None and completion.text:
+            await cache.set(key, completion.text)
+        return completion
+
+    if not SINGLEFLIGHT_ENABLED:
+        return await call_and_store()
+
+    while True:
+        future = flight.joinable(key)
+        if future is None:
+            return await flight.do(key, call_and_store)
+        shared = await _shared(future, user_agent)
+        if shared is not None:
+            return shared
+
+
+class CompletionStream:
+    """Itera los deltas de texto de una completion con stream=True"""
+
+    def __init__(self, messages: List[dict], user_agent: str, cacheable: bool = False):
+        self.messages = messages
+        self.user_agent = user_agent
+        self.cacheable = cacheable
+        self.cached = False
+        self.coalesced = False
+        self.parts: List[str] = []
+        self.usage = None
+        self.ttft: Optional[float] = None
+        self.completed = False
+
+    @property
+    def text(self) -> str:
+        return "".join(self.parts)
+
+    def __aiter__(self) -> AsyncIterator[str]:
+        return self._iterate()
+
+    async def _iterate(self) -> AsyncIterator[str]:
+        if not self.cacheable:
+            async for delta in self._stream():
+                yield delta
+            return
+
+        key = cache_key(self.messages)
+        cache = response_cache.get_cache()
+        if cache is not None:
+            cached = await cache.get(key)
+            if cached is not None:
+                # Acierto de caché: la respuesta completa sale como un único delta
+                self.cached = True
+                usage_ledger.record(self.user_agent, "", None, 0.0, "cache")
+                async for delta in self._emit_whole(cached):
+                    yield delta
+                return
+
+        leader = None
+        if SINGLEFLIGHT_ENABLED:
+            future = flight.joinable(key)
+            while future is not None:
+                shared = await _shared(future, self.user_agent)
+                if shared is not None:
+                    self.cached = shared.cached
+                    self.coalesced = True
+                    async for delta in self._emit_whole(shared.text):
+                        yield delta
+                    return
+                future = flight.joinable(key)
+            leader = flight.lead(key)
+
+        try:
+            async for delta in self._stream():
+                yield delta
+        except BaseException as e:
+            if leader is not None and not leader.done():
+                # Si el cliente del líder se fue, los demás harán su propia llamada
+                abandoned = isinstance(e, (asyncio.CancelledError, GeneratorExit))
+                leader.set_exception(LeaderAbandoned() if abandoned else e)
+            raise
+
+        if cache is not None and self.text:
+            await cache.set(key, self.text)
+        if leader is not None:
+            leader.set_result(Completion(self.text, self.usage))
+
+    async def _emit_whole(self, text: str) -> AsyncIterator[str]:
+        self.ttft = 0.0
+        self.parts.append(text)
+        yield text
+        self.completed = True
+
+    async def _stream(self) -> AsyncIterator[str]:
+        extra = {"stream_options": {"include_usage": True}} if OPENAI_STREAM_USAGE else {}
+        started = time.perf_counter()
+        deployment = ""
+        upstream = None
+        try:
+            raw, ticket = await _send(self.messages, self.user_agent, MAX_TOKENS, stream=True, **extra)
+            deployment = ticket.backend.deployment
+            upstream = raw.parse()
+            async for chunk in upstream:
+                if getattr(chunk, "usage", None):
+                    self.usage = chunk.usage
+                # Azure envía chunks sin choices (filtros de contenido)
+                if not chunk.choices:
+                    continue
+                delta = chunk.choices[0].delta.content
+                if not delta:
+                    continue
+                if self.ttft is None:
+                    self.ttft = time.perf_counter() - started
+                    metrics.OPENAI_TTFT.observe(self.ttft, self.user_agent)
+                    logger.info(f"⚡ Primer token en {self.ttft * 1000:.0f} ms")
+                self.parts.append(delta)
+                yield delta
+                # El timeout de la llamada acota cada lectura, no el stream entero
+                deadline.check()
+        except BaseException as e:
+            if upstream is not None:
+                # Cerrar la conexión es lo que hace que Azure deje de generar
+                try:
+                    await upstream.close()
+                except Exception as close_error:
+                    logger.debug(f"No se pudo cerrar el stream: {close_error}")
+            if _abandoned(e):
+                deadline.record_cancel("stream", count_tokens(self.text))
+            # Lo generado hasta el corte también se factura
+            usage_ledger.record(
+                self.user_agent, deployment, self._usage() if deployment else None,
+                time.perf_counter() - started, _outcome(e)
+            )
+            raise
+        self.completed = True
+        if self.ttft is not None:
+            metrics.OPENAI_PROMPT_LATENCY.observe(self.ttft, self.user_agent, _prefix_cache(self.usage))
+        usage = self._usage()
+        _reconcile(ticket, usage.total_tokens, raw.headers)
+        metrics.record_usage(self.user_agent, usage, estimated=self.usage is None)
+        usage_ledger.record(self.user_agent, deployment, usage, time.perf_counter() - started, "ok")
+        deadline.observe_completion(usage.completion_tokens)
+
+    def _usage(self):
+        """usage del stream o, sin ella, una estimación local para conciliar la cuota"""
+        if self.usage is not None:
+            return self.usage
+        prompt_tokens = messages_tokens(self.messages)
+        completion_tokens = count_tokens(self.text)
+        return openai.types.CompletionUsage(
+            prompt_tokens=prompt_tokens,
+            completion_tokens=completion_tokens,
+            total_tokens=prompt_tokens + completion_tokens
+        )
+
+
+def sse_event(data: dict) -> str:
+    """Formatea un evento Server-Sent Events"""
+    return f"data: {orjson.dumps(data).decode()}\n\n"
+
+
+async def sse_text(text: str, **done) -> AsyncIterator[str]:
+    """Una respuesta ya completa (sin modelo) con los mismos eventos que sse_stream"""
+    yield sse_event({"delta": text})
+    yield sse_event({"done": True, **done})
+
+
+async def sse_stream(stream: CompletionStream) -> AsyncIterator[str]:
+    """Convierte un CompletionStream en eventos SSE (delta, done o error)"""
+    try:
+        async for delta in stream:
+            yield sse_event({"delta": delta})
+        yield sse_event({"done": True})
+    except Exception as e:
+        logger.error(f"❌ Error en streaming: {e}")
+        metrics.record_error("stream", e)
+        wait = retry_after(e)
+        if wait is not None:
+            yield sse_event({"error": BUSY_MESSAGE, "retry_after": round(wait, 1)})
+        else:
+            yield sse_event({"error": "Error procesando mensaje"})
@@ -0,0 +1,268 @@
+"""
+Logs estructurados sin bloquear el event loop
+
+Los handlers de las apps solo encolan el registro (QueueHandler); un hilo
+aparte (QueueListener) les da formato y los escribe. Si la salida se atasca,
+el event loop sigue atendiendo: se llena la cola y, pasado LOG_QUEUE_SIZE, los
+registros se descartan y se cuentan en lugar de esperar.
+
+Antes de encolar, en el hilo que emite, se deciden las dos cosas que no pueden
+esperar al formato:
+
+- Muestreo: cada petición HTTP se sortea una vez con LOG_SAMPLE_RATE y todos
+  sus INFO/DEBUG se escriben o se omiten juntos. Los avisos, los errores y lo
+  que se registra fuera de una petición se escriben siempre.
+- Texto de usuarios: los campos de CONTENT_FIELDS pasados en extra se sustituyen
+  según LOG_MESSAGE_CONTENT (omit: solo la longitud; hash: longitud y huella
+  para correlacionar; full: sin tocar). El texto de usuario va en esos campos,
+  nunca dentro del mensaje.
+
+Cada línea lleva request_id (de X-Request-Id o generado, y devuelto en la
+respuesta) y elapsed_ms desde que empezó la petición. Los turnos del bot en
+segundo plano conservan el de la petición que los encoló.
+
+    logger.info("👤 Mensaje de Teams", extra={"user_message": text})
+"""
+import asyncio
+import atexit
+import contextvars
+import hashlib
+import logging
+import logging.handlers
+import os
+import queue
+import random
+import re
+import sys
+import time
+import uuid
+from typing import Optional, Tuple
+
+import orjson
+
+import metrics
+from config import (
+    LOG_LEVEL,
+    LOG_FORMAT,
+    LOG_QUEUE_SIZE,
+    LOG_SAMPLE_RATE,
+    LOG_MESSAGE_CONTENT
+)
+
+logger = logging.getLogger(__name__)
+
+# Campos de extra con texto escrito por usuarios (o generado a partir de él)
+CONTENT_FIELDS = ("user_message", "user_name", "reply")
+
+# Atributos propios de LogRecord: el resto viene de extra
+_RECORD_FIELDS = frozenset(vars(logging.makeLogRecord({}))) | {"message", "asctime"}
+
+_REQUEST_ID = re.compile(r"[\w.:-]{1,64}")
+
+# (request_id, inicio en perf_counter, si sus INFO/DEBUG se escriben)
+_request: contextvars.ContextVar[Optional[Tuple[str, float, bool]]] = contextvars.ContextVar(
+    "log_request", default=None
+)
+
+
+def redact(text: str, mode: str = LOG_MESSAGE_CONTENT) -> str:
+    """Texto de un usuario tal como puede quedar en los logs"""
+    if mode == "full" or not isinstance(text, str):
+        return text
+    if mode == "hash":
+        return f"sha256:{hashlib.sha256(text.encode()).hexdigest()[:12]} ({len(text)} caracteres)"
+    return f"({len(text)} caracteres)"
+
+
+def _extras(record: logging.LogRecord) -> dict:
+    """Campos de extra de un registro, en el orden en que se pasaron"""
+    return {k: v for k, v in record.__dict__.items() if k not in _RECORD_FIELDS}
+
+
+class JsonFormatter(logging.Formatter):
+    """Una línea JSON por registro"""
+
+    def format(self, record: logging.LogRecord) -> str:
+        entry = {
+            "ts": time.strftime("%Y-%m-%dT%H:%M:%S", time.gmtime(record.created)) + f".{int(record.msecs):03d}Z",
+            "level": record.levelname,
+            "logger": record.name,
+            "msg": record.getMessage(),
+            **_extras(record),
+        }
+        if record.exc_info:
+            entry["exc"] = self.formatException(record.exc_info)
+        return orjson.dumps(entry, default=str).decode()
+
+
+class TextFormatter(logging.Formatter):
+    """Formato legible para desarrollo: el de basicConfig más los campos de extra"""
+
+    def __init__(self):
+        super().__init__("%(asctime)s %(levelname)s %(name)s: %(message)s")
+
+    def format(self, record: logging.LogRecord) -> str:
+        line = super().format(record)
+        extras = _extras(record)
+        if not extras:
+            return line
+        fields = " ".join(f"{k}={v}" for k, v in extras.items())
+        head, newline, rest = line.partition("\n")
+        return f"{head} | {fields}{newline}{rest}"
+
+
+class AsyncLogHandler(logging.handlers.QueueHandler):
+    """Muestrea, redacta y encola; el formato y la escritura quedan para el hilo del listener"""
+
+    def __init__(self, log_queue: queue.Queue):
+        super().__init__(log_queue)
+        self.enqueued = 0
+        self.dropped = 0
+        self.sampled_out = 0
+
+    def emit(self, record: logging.LogRecord):
+        context = _request.get()
+        if context is not None:
+            if record.levelno < logging.WARNING and not context[2]:
+                self.sampled_out += 1
+                return
+            record.request_id = context[0]
+            record.elapsed_ms = round((time.perf_counter() - context[1]) * 1000, 1)
+        if LOG_MESSAGE_CONTENT != "full":
+            for field in CONTENT_FIELDS:
+                if field in record.__dict__:
+                    setattr(record, field, redact(getattr(record, field)))
+        try:
+            self.queue.put_nowait(record)
+        except queue.Full:
+            # La salida no da abasto: se pierde la línea antes que bloquear el loop
+            self.dropped += 1
+            return
+        self.enqueued += 1
+
+    def stats(self) -> dict:
+        return {
+            "queued": self.queue.qsize(),
+            "enqueued": self.enqueued,
+            "dropped": self.dropped,
+            "sampled_out": self.sampled_out,
+        }
+
+
+class _Listener(logging.handlers.QueueListener):
+    def enqueue_sentinel(self):
+        # Con la cola llena put_nowait fallaría: al parar se espera a que haya sitio
+        self.queue.put(self._sentinel)
+
+
+_handler: Optional[AsyncLogHandler] = None
+_listener: Optional[_Listener] = None
+_output: Optional[logging.Handler] = None
+
+
+def _start_listener():
+    global _listener
+    _listener = _Listener(_handler.queue, _output)
+    _listener.start()
+
+
+def _after_fork():
+    # El hilo del listener no pasa al hijo (gunicorn --preload hace fork tras importar la app)
+    if _handler is not None:
+        _handler.queue = queue.Queue(LOG_QUEUE_SIZE)
+        _start_listener()
+
+
+def _stop():
+    if _listener is not None and _listener._thread is not None:
+        _listener.stop()
+
+
+def setup(stream=None):
+    """Sustituye los handlers del root por la cola (una vez por proceso)"""
+    global _handler, _output
+    if _handler is not None:
+        return
+    _output = logging.StreamHandler(stream or sys.stderr)
+    _output.setFormatter(JsonFormatter() if LOG_FORMAT == "json" else TextFormatter())
+    _handler = AsyncLogHandler(queue.Queue(LOG_QUEUE_SIZE))
+    root = logging.getLogger()
+    for handler in root.handlers[:]:
+        root.removeHandler(handler)
+    root.addHandler(_handler)
+    level = logging.getLevelName(LOG_LEVEL.upper())
+    root.setLevel(level if isinstance(level, int) else logging.INFO)
+    # Fichero, línea e hilo no salen en los logs: no se calculan para cada registro.
+    # El pid sí: el formato de gunicorn (master y arranque de workers) usa %(process)d
+    logging._srcfile = None
+    logging.logThreads = False
+    logging.logMultiprocessing = False
+    logging.logAsyncioTasks = False
+    route_uvicorn()
+    _start_listener()
+    os.register_at_fork(after_in_child=_after_fork)
+    atexit.register(_stop)
+
+
+def route_uvicorn():
+    """Manda los logs de uvicorn a la cola del root
+
+    uvicorn trae sus propios handlers síncronos, y el UvicornWorker de gunicorn
+    vuelve a ponerlos al crearse (después del preload): el worker lo llama otra vez.
+    """
+    if _handler is None:
+        return
+    for name in ("uvicorn", "uvicorn.error", "uvicorn.access"):
+        uvicorn_logger = logging.getLogger(name)
+        # Se asigna una lista nueva: la del UvicornWorker es la de los logs de gunicorn
+        uvicorn_logger.handlers = []
+        uvicorn_logger.propagate = True
+    # RequestLogMiddleware ya deja una línea por petición, con su request_id
+    logging.getLogger("uvicorn.access").setLevel(logging.WARNING)
+
+
+class RequestLogMiddleware:
+    """Middleware ASGI puro: request_id, muestreo por petición y una línea al terminar"""
+
+    def __init__(self, app):
+        self.app = app
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http":
+            await self.app(scope, receive, send)
+            return
+
+        incoming = dict(scope["headers"]).get(b"x-request-id", b"").decode("latin-1")
+        rid = incoming if _REQUEST_ID.fullmatch(incoming) else uuid.uuid4().hex[:16]
+        sampled = LOG_SAMPLE_RATE >= 1 or random.random() < LOG_SAMPLE_RATE
+        token = _request.set((rid, time.perf_counter(), sampled))
+        status = 500
+
+        async def send_with_id(message):
+            nonlocal status
+            if message["type"] == "http.response.start":
+                status = message["status"]
+                message["headers"] = [*message.get("headers", ()), (b"x-request-id", rid.encode())]
+            await send(message)
+
+        try:
+            await self.app(scope, receive, send_with_id)
+        except asyncio.CancelledError:
+            if status == 500:
+                status = 499
+            raise
+        finally:
+            logger.log(
+                logging.WARNING if status >= 500 else logging.INFO,
+                "Petición atendida",
+                extra={"method": scope["method"], "path": scope["path"], "status": status}
+            )
+            _request.reset(token)
+
+
+def instrument(app):
+    """Añade el middleware de request_id a una app FastAPI"""
+    app.add_middleware(RequestLogMiddleware)
+
+
+metrics.register_stats("logging", lambda: _handler.stats() if _handler else None)
@@ -0,0 +1,297 @@
+"""
+Métricas en formato Prometheus (contadores, gauges e histogramas)
+
+Sin locks en el camino caliente: todo se actualiza desde el hilo del event
+loop y los acumulados, así como los collectors de pool, caché y router, se
+calculan solo al hacer scrape de /metrics.
+"""
+import asyncio
+import logging
+import time
+from bisect import bisect_left
+from typing import Callable, Dict, Iterable, List, Optional, Tuple
+
+from config import METRICS_ENABLED
+
+logger = logging.getLogger(__name__)
+
+CONTENT_TYPE = "text/plain; version=0.0.4"
+
+LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0, 60.0)
+TOKEN_BUCKETS = (16, 32, 64, 128, 256, 512, 1024, 2048, 4096, 8192)
+RATIO_BUCKETS = (0.0, 0.1, 0.25, 0.5, 0.75, 0.9, 1.0)
+
+def _escape(value: str) -> str:
+    return value.replace("\\", "\\\\").replace("\n", "\\n").replace('"', '\\"')
+
+
+def _labels(names: Iterable[str], values: Iterable[str], extra: str = "") -> str:
+    pairs = [f'{name}="{_escape(str(value))}"' for name, value in zip(names, values)]
+    if extra:
+        pairs.append(extra)
+    return "{" + ",".join(pairs) + "}" if pairs else ""
+
+
+def _number(value: float) -> str:
+    if value == float("inf"):
+        return "+Inf"
+    return repr(float(value)) if isinstance(value, float) else str(value)
+
+
+class _Metric:
+    kind = "untyped"
+
+    def __init__(self, name: str, help: str, labelnames: Tuple[str, ...] = ()):
+        self.name = name
+        self.help = help
+        self.labelnames = tuple(labelnames)
+
+    def header(self) -> List[str]:
+        return [f"# HELP {self.name} {self.help}", f"# TYPE {self.name} {self.kind}"]
+
+
+class Counter(_Metric):
+    """Contador monótono por combinación de labels"""
+    kind = "counter"
+
+    def __init__(self, name: str, help: str, labelnames: Tuple[str, ...] = ()):
+        super().__init__(name, help, labelnames)
+        self._values: Dict[tuple, float] = {}
+
+    def inc(self, *labels: str, amount: float = 1):
+        self._values[labels] = self._values.get(labels, 0) + amount
+
+    def render(self) -> List[str]:
+        lines = self.header()
+        for labels, value in list(self._values.items()):
+            lines.append(f"{self.name}{_labels(self.labelnames, labels)} {_number(value)}")
+        return lines
+
+
+class Gauge(Counter):
+    """Valor que sube y baja (peticiones en vuelo, etc.)"""
+    kind = "gauge"
+
+    def dec(self, *labels: str, amount: float = 1):
+        self._values[labels] = self._values.get(labels, 0) - amount
+
+    def set(self, value: float, *labels: str):
+        self._values[labels] = value
+
+
+class Histogram(_Metric):
+    """Histograma: al observar solo se suma un bucket; el acumulado se arma al hacer scrape"""
+    kind = "histogram"
+
+    def __init__(self, name: str, help: str, labelnames: Tuple[str, ...] = (), buckets=LATENCY_BUCKETS):
+        super().__init__(name, help, labelnames)
+        self.buckets = tuple(buckets)
+        # labels -> [conteo por bucket..., conteo +Inf, suma]
+        self._values: Dict[tuple, list] = {}
+
+    def observe(self, value: float, *labels: str):
+        series = self._values.get(labels)
+        if series is None:
+            series = self._values[labels] = [0] * (len(self.buckets) + 1) + [0.0]
+        series[bisect_left(self.buckets, value)] += 1
+        series[-1] += value
+
+    def render(self) -> List[str]:
+        lines = self.header()
+        for labels, series in list(self._values.items()):
+            cumulative = 0
+            for bound, count in zip(self.buckets + (float("inf"),), series):
+                cumulative += count
+                le = 'le="' + _number(bound) + '"'
+                lines.append(f"{self.name}_bucket{_labels(self.labelnames, labels, le)} {cumulative}")
+            lines.append(f"{self.name}_sum{_labels(self.labelnames, labels)} {_number(series[-1])}")
+            lines.append(f"{self.name}_count{_labels(self.labelnames, labels)} {cumulative}")
+        return lines
+
+
+_metrics: List[_Metric] = []
+_collectors: List[Callable[[], List[str]]] = []
+
+
+def counter(name: str, help: str, labelnames: Tuple[str, ...] = ()) -> Counter:
+    metric = Counter(name, help, labelnames)
+    _metrics.append(metric)
+    return metric
+
+
+def gauge(name: str, help: str, labelnames: Tuple[str, ...] = ()) -> Gauge:
+    metric = Gauge(name, help, labelnames)
+    _metrics.append(metric)
+    return metric
+
+
+def histogram(name: str, help: str, labelnames: Tuple[str, ...] = (), buckets=LATENCY_BUCKETS) -> Histogram:
+    metric = Histogram(name, help, labelnames, buckets)
+    _metrics.append(metric)
+    return metric
+
+
+def register_stats(prefix: str, fn: Callable[[], object], label: Optional[str] = None):
+    """Publica como gauges los valores numéricos de un stats()
+
+    fn devuelve un dict, o una lista de dicts si se pasa label (p. ej. uno por
+    backend); el valor de ese campo pasa a ser el label de cada muestra.
+    """
+    def collect() -> List[str]:
+        stats = fn()
+        if stats is None:
+            return []
+        rows = stats if label else [stats]
+        series: Dict[str, List[str]] = {}
+        for row in rows:
+            labels = _labels((label,), (row[label],)) if label else ""
+            for key, value in row.items():
+                if isinstance(value, bool):
+                    value = int(value)
+                if not isinstance(value, (int, float)):
+                    continue
+                series.setdefault(f"{prefix}_{key}", []).append(f"{prefix}_{key}{labels} {_number(value)}")
+        lines = []
+        for name, samples in series.items():
+            lines.append(f"# TYPE {name} gauge")
+            lines.extend(samples)
+        return lines
+
+    _collectors.append(collect)
+
+
+def render() -> str:
+    """Texto de exposición de Prometheus"""
+    lines: List[str] = []
+    for metric in _metrics:
+        lines.extend(metric.render())
+    for collect in _collectors:
+        try:
+            lines.extend(collect())
+        except Exception as e:
+            logger.warning(f"⚠️ Collector de métricas falló: {e}")
+    return "\n".join(lines) + "\n"
+
+
+# === MÉTRICAS COMPARTIDAS ===
+HTTP_IN_FLIGHT = gauge("http_requests_in_flight", "Peticiones HTTP en curso")
+HTTP_DURATION = histogram(
+    "http_request_duration_seconds",
+    "Latencia de las peticiones HTTP (hasta el último byte)",
+    ("route", "method", "status")
+)
+ERRORS = counter("app_errors_total", "Errores por punto de captura y tipo", ("where", "type"))
+OPENAI_IN_FLIGHT = gauge("openai_requests_in_flight", "Llamadas a Azure OpenAI en curso", ("backend",))
+OPENAI_DURATION = histogram(
+    "openai_request_duration_seconds",
+    "Duración de la llamada a Azure OpenAI (en streaming, hasta los headers)",
+    ("backend", "outcome")
+)
+OPENAI_QUEUE = histogram(
+    "openai_quota_wait_seconds", "Espera en la cola del gobernador de cuota", ("backend", "client")
+)
+OPENAI_TTFT = histogram("openai_time_to_first_token_seconds", "Tiempo hasta el primer token en streaming", ("client",))
+OPENAI_TOKENS = counter("openai_tokens_total", "Tokens consumidos por tipo y cliente", ("kind", "client"))
+OPENAI_COMPLETION_TOKENS = histogram(
+    "openai_completion_tokens",
+    "Tokens generados por respuesta",
+    ("client",),
+    TOKEN_BUCKETS
+)
+
+
+OPENAI_PREFIX_CACHE_RATIO = histogram(
+    "openai_prompt_cached_ratio",
+    "Fracción del prompt servida desde la caché de prefijos del proveedor",
+    ("client",),
+    RATIO_BUCKETS
+)
+OPENAI_PROMPT_LATENCY = histogram(
+    "openai_prompt_latency_seconds",
+    "Hasta el primer token (streaming) o la respuesta completa, según el prefijo saliera de caché",
+    ("client", "prefix_cache")
+)
+
+
+RETRIEVAL_DURATION = histogram(
+    "retrieval_duration_seconds",
+    "Recuperación de documentos por etapa (embed de la consulta, búsqueda en el índice)",
+    ("stage",),
+    (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0)
+)
+
+
+def record_error(where: str, error: BaseException):
+    ERRORS.inc(where, type(error).__name__)
+
+
+def cached_tokens(usage) -> int:
+    """usage.prompt_tokens_details.cached_tokens (0 si la api-version no lo trae)"""
+    details = getattr(usage, "prompt_tokens_details", None)
+    if details is None:
+        return 0
+    if isinstance(details, dict):
+        return details.get("cached_tokens") or 0
+    return getattr(details, "cached_tokens", None) or 0
+
+
+def record_usage(client: str, usage, estimated: bool = False):
+    """Suma la usage de una respuesta de Azure (estimated: calculada en local, sin cached_tokens)"""
+    if usage is None:
+        return
+    prompt = usage.prompt_tokens or 0
+    cached = cached_tokens(usage)
+    OPENAI_TOKENS.inc("prompt", client, amount=prompt)
+    OPENAI_TOKENS.inc("prompt_cached", client, amount=cached)
+    OPENAI_TOKENS.inc("completion", client, amount=usage.completion_tokens or 0)
+    OPENAI_COMPLETION_TOKENS.observe(usage.completion_tokens or 0, client)
+    if prompt and not estimated:
+        OPENAI_PREFIX_CACHE_RATIO.observe(cached / prompt, client)
+
+
+class MetricsMiddleware:
+    """Middleware ASGI puro: latencia por ruta y peticiones en vuelo"""
+
+    def __init__(self, app):
+        self.app = app
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http":
+            await self.app(scope, receive, send)
+            return
+
+        status = 500
+
+        async def send_with_status(message):
+            nonlocal status
+            if message["type"] == "http.response.start":
+                status = message["status"]
+            await send(message)
+
+        HTTP_IN_FLIGHT.inc()
+        started = time.perf_counter()
+        try:
+            await self.app(scope, receive, send_with_status)
+        except asyncio.CancelledError:
+            # Cancelada antes de responder (el cliente se fue): 499, como nginx
+            if status == 500:
+                status = 499
+            raise
+        finally:
+            HTTP_IN_FLIGHT.dec()
+            # Plantilla de la ruta (no el path real) para acotar la cardinalidad
+            route = getattr(scope.get("route"), "path", "unmatched")
+            HTTP_DURATION.observe(time.perf_counter() - started, route, scope["method"], str(status))
+
+
+def instrument(app):
+    """Añade el middleware y el endpoint /metrics a una app FastAPI"""
+    if not METRICS_ENABLED:
+        return
+    from fastapi.responses import Response
+
+    async def metrics_endpoint():
+        return Response(render(), media_type=CONTENT_TYPE)
+
+    app.add_middleware(MetricsMiddleware)
+    app.add_api_route("/metrics", metrics_endpoint, methods=["GET"], include_in_schema=False)
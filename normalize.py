@@ -0,0 +1,24 @@
+"""
+Normalización de texto de usuario compartida por la caché de respuestas,
+la recuperación y el atajo de preguntas frecuentes
+"""
+import re
+import unicodedata
+
+_PUNCTUATION = re.compile(r"[^\w\s]")
+_SPACES = re.compile(r"\s+")
+
+# Palabras vacías: en español dominan el texto y no distinguen una consulta de otra
+STOPWORDS = frozenset(
+    "a al algo como con cual cuando de del desde donde el ella en entre era es esa ese eso esta este "
+    "esto fue ha han hay la las le les lo los mas me mi muy no nos o para pero por que se si sin sobre "
+    "su sus te tu un una uno unos y ya".split()
+)
+
+
+def normalize_message(text: str) -> str:
+    """Minúsculas, sin acentos, sin puntuación y con espacios colapsados"""
+    text = unicodedata.normalize("NFKD", text.lower())
+    text = "".join(c for c in text if not unicodedata.combining(c))
+    text = _PUNCTUATION.sub(" ", text)
+    return _SPACES.sub(" ", text).strip()
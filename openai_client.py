@@ -0,0 +1,152 @@
+"""
+Proveedor compartido del cliente Azure OpenAI con pool de conexiones persistente
+"""
+import logging
+import os
+from typing import Dict, Optional, Tuple
+
+import httpx
+import metrics
+from openai import AsyncAzureOpenAI
+from config import (
+    AZURE_OPENAI_ENDPOINT,
+    AZURE_OPENAI_API_VERSION,
+    AZURE_OPENAI_BACKENDS,
+    OPENAI_MAX_CONNECTIONS,
+    OPENAI_MAX_KEEPALIVE,
+    OPENAI_KEEPALIVE_EXPIRY,
+    OPENAI_HTTP2,
+    OPENAI_WARMUP
+)
+
+logger = logging.getLogger(__name__)
+
+_http_client: Optional[httpx.AsyncClient] = None
+_clients: Dict[Tuple[str, str, str], AsyncAzureOpenAI] = {}
+_http2_enabled = False
+
+# Estadísticas del pool (requests enviados vs conexiones TCP abiertas)
+_stats = {
+    "requests": 0,
+    "connections_opened": 0,
+    "tls_handshakes": 0,
+}
+
+
+def _http2_available() -> bool:
+    """HTTP/2 solo si está habilitado y el paquete h2 está instalado"""
+    if not OPENAI_HTTP2:
+        return False
+    try:
+        import h2  # noqa: F401
+    except ImportError:
+        logger.info("ℹ️ Paquete h2 no instalado, se usa HTTP/1.1 con keep-alive")
+        return False
+    return True
+
+
+async def _trace(event_name: str, info: dict):
+    """Callback de trazas de httpcore para contar conexiones nuevas"""
+    if event_name == "connection.connect_tcp.complete":
+        _stats["connections_opened"] += 1
+    elif event_name == "connection.start_tls.complete":
+        _stats["tls_handshakes"] += 1
+
+
+async def _on_request(request: httpx.Request):
+    """Hook de httpx: cuenta el request y activa la traza de conexión"""
+    _stats["requests"] += 1
+    request.extensions["trace"] = _trace
+
+
+def _build_http_client() -> httpx.AsyncClient:
+    """Crea el cliente HTTP de larga vida compartido por todas las apps"""
+    global _http2_enabled
+    limits = httpx.Limits(
+        max_connections=OPENAI_MAX_CONNECTIONS,
+        max_keepalive_connections=OPENAI_MAX_KEEPALIVE,
+        keepalive_expiry=OPENAI_KEEPALIVE_EXPIRY
+    )
+    _http2_enabled = _http2_available()
+    return httpx.AsyncClient(
+        limits=limits,
+        http2=_http2_enabled,
+        timeout=httpx.Timeout(60.0, connect=10.0),
+        event_hooks={"request": [_on_request]}
+    )
+
+
+def _get_http_client() -> httpx.AsyncClient:
+    global _http_client
+    if _http_client is None:
+        _http_client = _build_http_client()
+    return _http_client
+
+
+def get_client(
+    endpoint: Optional[str] = None,
+    api_key: Optional[str] = None,
+    api_version: Optional[str] = None
+) -> AsyncAzureOpenAI:
+    """Cliente para un endpoint (por defecto el principal); todos comparten el pool"""
+    endpoint = endpoint or AZURE_OPENAI_ENDPOINT
+    api_key = api_key or os.environ.get("AZURE_OPENAI_API_KEY")
+    api_version = api_version or AZURE_OPENAI_API_VERSION
+    key = (endpoint, api_key, api_version)
+    client = _clients.get(key)
+    if client is None:
+        client = AsyncAzureOpenAI(
+            azure_endpoint=endpoint,
+            api_version=api_version,
+            api_key=api_key,
+            http_client=_get_http_client(),
+            # Los reintentos (429 con Retry-After) los gestiona llm junto al gobernador
+            max_retries=0
+        )
+        _clients[key] = client
+        logger.info(f"✅ Cliente Azure OpenAI creado para {endpoint}")
+    return client
+
+
+async def startup():
+    """Abre el pool y precalienta una conexión por endpoint (DNS + TCP + TLS)"""
+    http_client = _get_http_client()
+    if not OPENAI_WARMUP:
+        return
+    endpoints = {backend["endpoint"] for backend in AZURE_OPENAI_BACKENDS if backend.get("endpoint")}
+    for endpoint in endpoints:
+        try:
+            # Cualquier respuesta sirve: solo queremos dejar la conexión abierta
+            await http_client.head(endpoint, timeout=5.0)
+            logger.info(f"🔥 Pool precalentado para {endpoint}")
+        except Exception as e:
+            logger.warning(f"⚠️ No se pudo precalentar {endpoint}: {e}")
+
+
+async def shutdown():
+    """Cierra el pool de conexiones"""
+    global _http_client
+    if _http_client is not None:
+        await _http_client.aclose()
+        logger.info("👋 Pool de Azure OpenAI cerrado")
+    _http_client = None
+    _clients.clear()
+
+
+def pool_stats() -> dict:
+    """Estadísticas de reutilización del pool"""
+    requests = _stats["requests"]
+    opened = _stats["connections_opened"]
+    return {
+        "requests": requests,
+        "connections_opened": opened,
+        "tls_handshakes": _stats["tls_handshakes"],
+        "connections_reused": max(requests - opened, 0),
+        "reuse_ratio": round((requests - opened) / requests, 3) if requests else 0.0,
+        "http2": _http2_enabled,
+        "max_connections": OPENAI_MAX_CONNECTIONS,
+        "max_keepalive": OPENAI_MAX_KEEPALIVE,
+    }
+
+
+metrics.register_stats("openai_pool", pool_stats)
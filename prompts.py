@@ -0,0 +1,98 @@
+"""
+Estructura canónica de los mensajes que se envían a Azure OpenAI
+
+Del más estable al más volátil, para aprovechar la caché de prefijos del
+proveedor (el prefijo idéntico a una petición reciente, desde 1024 tokens y en
+tramos de 128, se cobra y procesa como cached_tokens):
+
+1. Prefijo común del servidor: SYSTEM_PROMPT más las políticas y el contexto
+   compartido de PROMPT_CONTEXT_FILE. Idéntico para el bot y los dos chats.
+2. Instrucciones propias de la superficie (bot, chat web, chat con memoria).
+3. Resumen de la conversación (solo cambia al compactar).
+4. Historial reciente.
+5. Fragmentos recuperados de la documentación (cambian con cada consulta).
+6. Mensaje del usuario.
+"""
+import logging
+from typing import TYPE_CHECKING, Iterable, List, Optional, Sequence
+
+from config import SYSTEM_PROMPT, PROMPT_CONTEXT_FILE
+
+if TYPE_CHECKING:
+    from retrieval import Passage
+
+logger = logging.getLogger(__name__)
+
+# Lo que cada superficie añade tras el prefijo común (vacío = nada)
+SURFACE_INSTRUCTIONS = {
+    "teams": "",
+    "chat": "",
+    "chat_m": (
+        "Evidenze es una empresa CRO especializada en investigación clínica y servicios "
+        "farmacéuticos. Proporciona respuestas útiles, profesionales y precisas."
+    ),
+}
+
+_shared_prefix: Optional[str] = None
+
+
+def shared_prefix() -> str:
+    """System prompt + contexto compartido, leído una sola vez por proceso"""
+    global _shared_prefix
+    if _shared_prefix is None:
+        parts = [SYSTEM_PROMPT.strip()]
+        if PROMPT_CONTEXT_FILE:
+            try:
+                with open(PROMPT_CONTEXT_FILE, encoding="utf-8") as f:
+                    context = f.read().strip()
+            except OSError as e:
+                logger.warning(f"⚠️ No se pudo leer PROMPT_CONTEXT_FILE: {e}")
+                context = ""
+            if context:
+                parts.append(context)
+        _shared_prefix = "\n\n".join(parts)
+    return _shared_prefix
+
+
+def system_messages(surface: str, summary: str = "") -> List[dict]:
+    """Parte fija del prompt: prefijo común, instrucciones de la superficie y resumen"""
+    messages = [{"role": "system", "content": shared_prefix()}]
+    instructions = SURFACE_INSTRUCTIONS.get(surface)
+    if instructions:
+        messages.append({"role": "system", "content": instructions})
+    if summary:
+        messages.append({"role": "system", "content": f"Resumen de la conversación previa:\n{summary}"})
+    return messages
+
+
+def context_messages(passages: Sequence["Passage"]) -> List[dict]:
+    """Fragmentos de documentación para la consulta actual (nada si no hay)"""
+    if not passages:
+        return []
+    blocks = [
+        f"[{n}] {p.source}" + (f" — {p.title}" if p.title else "") + f"\n{p.text}"
+        for n, p in enumerate(passages, 1)
+    ]
+    return [{
+        "role": "system",
+        "content": (
+            "Documentación interna de Evidenze relacionada con la consulta. Úsala solo si "
+            "es pertinente y cita la fuente entre corchetes:\n\n" + "\n\n".join(blocks)
+        )
+    }]
+
+
+def build(
+    surface: str,
+    user_message: str,
+    history: Iterable[dict] = (),
+    summary: str = "",
+    passages: Sequence["Passage"] = ()
+) -> List[dict]:
+    """Mensajes completos de una consulta, con lo volátil al final"""
+    return [
+        *system_messages(surface, summary),
+        *history,
+        *context_messages(passages),
+        {"role": "user", "content": user_message}
+    ]
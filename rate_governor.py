@@ -0,0 +1,271 @@
+"""
+Gobernador de cuota TPM/RPM del lado del cliente
+
+Dos token buckets (requests y tokens estimados), cola de espera acotada con
+deadline por petición, conciliación con response.usage y frenado cuando Azure
+devuelve 429 (Retry-After / x-ratelimit-*). La cola reparte el turno entre
+clientes (bot, chat web, chat con memoria) en proporción a su peso.
+"""
+import asyncio
+import heapq
+import logging
+import time
+from typing import Dict, List, Mapping, Optional, Tuple
+
+logger = logging.getLogger(__name__)
+
+
+class RateLimited(Exception):
+    """La petición no obtuvo cupo a tiempo (cola llena o deadline vencido)"""
+
+    def __init__(self, message: str, retry_after: float = 1.0):
+        super().__init__(message)
+        self.retry_after = retry_after
+
+
+class TokenBucket:
+    """Cubo de fichas con recarga continua; admite saldo negativo (deuda)"""
+
+    def __init__(self, per_minute: float):
+        self.capacity = per_minute
+        self.rate = per_minute / 60.0
+        self.tokens = per_minute
+        self._last = time.monotonic()
+
+    def _refill(self):
+        now = time.monotonic()
+        self.tokens = min(self.capacity, self.tokens + (now - self._last) * self.rate)
+        self._last = now
+
+    def wait_time(self, amount: float) -> float:
+        """Segundos hasta que haya fichas suficientes"""
+        self._refill()
+        # Una petición mayor que la capacidad pasa cuando el cubo está lleno
+        needed = min(amount, self.capacity) - self.tokens
+        return max(needed / self.rate, 0.0) if needed > 0 else 0.0
+
+    def take(self, amount: float):
+        self._refill()
+        self.tokens -= amount
+
+    def give(self, amount: float):
+        self._refill()
+        self.tokens = min(self.capacity, self.tokens + amount)
+
+    def cap(self, remaining: float):
+        """Ajusta el saldo al restante que informa el servidor"""
+        self._refill()
+        self.tokens = min(self.tokens, remaining)
+
+
+class Permit:
+    """Cupo concedido: guarda la estimación para conciliarla después"""
+    __slots__ = ("tokens", "queued")
+
+    def __init__(self, tokens: int, queued: float):
+        self.tokens = tokens
+        self.queued = queued
+
+
+def _header_float(headers: Mapping[str, str], name: str) -> Optional[float]:
+    value = headers.get(name)
+    try:
+        return float(value) if value is not None else None
+    except ValueError:
+        return None
+
+
+def retry_after_seconds(headers: Mapping[str, str], default: float = 1.0) -> float:
+    """Espera indicada por Azure en un 429"""
+    ms = _header_float(headers, "retry-after-ms")
+    if ms is not None:
+        return ms / 1000.0
+    seconds = _header_float(headers, "retry-after")
+    if seconds is not None:
+        return seconds
+    return default
+
+
+class FairQueue:
+    """Cerrojo con orden de paso justo entre clientes (start-time fair queueing)
+
+    Cada espera recibe una etiqueta virtual max(tiempo virtual, fin del anterior
+    del mismo cliente) y pasa la menor: un cliente con la cola llena no retrasa
+    a otro que acaba de llegar, y a igual demanda cada uno recibe tokens en
+    proporción a su peso. Con un solo cliente equivale a una cola FIFO.
+    """
+
+    def __init__(self, weights: Optional[Mapping[str, float]] = None):
+        self.weights = dict(weights or {})
+        self._virtual = 0.0
+        # cliente -> etiqueta virtual en la que termina su último pedido
+        self._finish: Dict[str, float] = {}
+        self._waiters: List[Tuple[float, int, asyncio.Future]] = []
+        self._seq = 0
+        self._locked = False
+
+    async def acquire(self, client: str, cost: float):
+        weight = self.weights.get(client, 1.0)
+        tag = max(self._virtual, self._finish.get(client, 0.0))
+        self._finish[client] = tag + max(cost, 1.0) / weight
+        if not self._locked and not self._waiters:
+            self._locked = True
+            self._virtual = tag
+            return
+        future = asyncio.get_running_loop().create_future()
+        self._seq += 1
+        heapq.heappush(self._waiters, (tag, self._seq, future))
+        try:
+            await future
+        except BaseException:
+            # Cancelada justo después de recibir el turno: se cede al siguiente
+            if future.done() and not future.cancelled():
+                self.release()
+            raise
+
+    def release(self):
+        while self._waiters:
+            tag, _, future = heapq.heappop(self._waiters)
+            # Las esperas canceladas (deadline) se descartan aquí
+            if not future.done():
+                self._virtual = tag
+                future.set_result(None)
+                return
+        self._locked = False
+        # Sin cola: solo importa quién sigue por delante del tiempo virtual
+        self._finish = {client: end for client, end in self._finish.items() if end > self._virtual}
+
+
+class RateGovernor:
+    """Reparte la cuota del deployment entre todas las llamadas del proceso"""
+
+    def __init__(
+        self,
+        rpm: float,
+        tpm: float,
+        max_queue: int,
+        max_wait: float,
+        weights: Optional[Mapping[str, float]] = None
+    ):
+        self.requests = TokenBucket(rpm)
+        self.tokens = TokenBucket(tpm)
+        self.max_queue = max_queue
+        self.max_wait = max_wait
+        self._base_rpm = rpm
+        self._base_tpm = tpm
+        # Quien tiene el cerrojo es la cabeza de la cola
+        self._head = FairQueue(weights)
+        self._waiting = 0
+        self._paused_until = 0.0
+        self.admitted = 0
+        self.rejected = 0
+        self.throttled = 0
+        self.admitted_by_client: Dict[str, int] = {}
+
+    async def acquire(
+        self,
+        estimated_tokens: int,
+        deadline: Optional[float] = None,
+        client: str = "default"
+    ) -> Permit:
+        """Espera turno y cupo; lanza RateLimited si no llega antes del deadline"""
+        started = time.monotonic()
+        deadline = min(deadline or started + self.max_wait, started + self.max_wait)
+        if self._waiting >= self.max_queue:
+            self.rejected += 1
+            raise RateLimited("Cola de cuota llena", retry_after=self._estimated_drain())
+
+        self._waiting += 1
+        try:
+            await asyncio.wait_for(
+                self._head.acquire(client, estimated_tokens),
+                timeout=max(deadline - time.monotonic(), 0)
+            )
+        except asyncio.TimeoutError:
+            self.rejected += 1
+            raise RateLimited("Sin cupo antes del deadline", retry_after=self._estimated_drain())
+        finally:
+            self._waiting -= 1
+
+        try:
+            while True:
+                now = time.monotonic()
+                wait = max(
+                    self._paused_until - now,
+                    self.requests.wait_time(1),
+                    self.tokens.wait_time(estimated_tokens)
+                )
+                if wait <= 0:
+                    break
+                if now + wait > deadline:
+                    self.rejected += 1
+                    raise RateLimited("Sin cupo antes del deadline", retry_after=wait)
+                await asyncio.sleep(wait)
+            self.requests.take(1)
+            self.tokens.take(estimated_tokens)
+        finally:
+            self._head.release()
+
+        self.admitted += 1
+        self.admitted_by_client[client] = self.admitted_by_client.get(client, 0) + 1
+        return Permit(estimated_tokens, time.monotonic() - started)
+
+    def reconcile(self, permit: Permit, actual_tokens: Optional[int], headers: Optional[Mapping[str, str]] = None):
+        """Corrige la estimación con la usage real y los x-ratelimit-* del servidor"""
+        if actual_tokens is not None:
+            diff = permit.tokens - actual_tokens
+            if diff > 0:
+                self.tokens.give(diff)
+            elif diff < 0:
+                self.tokens.take(-diff)
+        if headers:
+            remaining_requests = _header_float(headers, "x-ratelimit-remaining-requests")
+            remaining_tokens = _header_float(headers, "x-ratelimit-remaining-tokens")
+            if remaining_requests is not None:
+                self.requests.cap(remaining_requests)
+            if remaining_tokens is not None:
+                self.tokens.cap(remaining_tokens)
+        self._recover()
+
+    def release(self, permit: Permit):
+        """Devuelve el cupo de una petición que no llegó a consumir tokens"""
+        self.tokens.give(permit.tokens)
+
+    def on_rate_limited(self, headers: Mapping[str, str]) -> float:
+        """429 recibido: pausa hasta Retry-After y baja el ritmo un 20%"""
+        retry_after = retry_after_seconds(headers)
+        self._paused_until = max(self._paused_until, time.monotonic() + retry_after)
+        self.throttled += 1
+        self._scale(0.8)
+        self.requests.tokens = min(self.requests.tokens, 0)
+        logger.warning(f"🚦 429 de Azure OpenAI: pausa de {retry_after:.1f}s")
+        return retry_after
+
+    def paused_for(self) -> float:
+        """Segundos que quedan de pausa por un 429"""
+        return max(self._paused_until - time.monotonic(), 0.0)
+
+    def stats(self) -> dict:
+        return {
+            "admitted": self.admitted,
+            "rejected": self.rejected,
+            "throttled": self.throttled,
+            "waiting": self._waiting,
+            "rpm": round(self.requests.rate * 60, 1),
+            "tpm": round(self.tokens.rate * 60, 1),
+            "tokens_available": round(self.tokens.tokens),
+            "clients": dict(self.admitted_by_client),
+        }
+
+    def _scale(self, factor: float):
+        self.requests.rate = max(self.requests.rate * factor, self._base_rpm / 60.0 * 0.1)
+        self.tokens.rate = max(self.tokens.rate * factor, self._base_tpm / 60.0 * 0.1)
+
+    def _recover(self):
+        """Tras cada éxito el ritmo vuelve poco a poco al configurado"""
+        self.requests.rate = min(self.requests.rate * 1.02, self._base_rpm / 60.0)
+        self.tokens.rate = min(self.tokens.rate * 1.02, self._base_tpm / 60.0)
+
+    def _estimated_drain(self) -> float:
+        return max(self._waiting / max(self.requests.rate, 0.001), 1.0)
+
@@ -0,0 +1,162 @@
+"""
+Caché de respuestas para preguntas repetidas (memoria LRU + TTL y SQLite opcional)
+"""
+import asyncio
+import hashlib
+import logging
+import sqlite3
+import threading
+import time
+from collections import OrderedDict
+from typing import Optional
+
+import metrics
+import prompts
+from normalize import normalize_message
+from config import (
+    RESPONSE_CACHE_ENABLED,
+    RESPONSE_CACHE_TTL,
+    RESPONSE_CACHE_MAX_ENTRIES,
+    RESPONSE_CACHE_DB
+)
+
+logger = logging.getLogger(__name__)
+
+
+def prompt_hash(system_prompt: str) -> str:
+    return hashlib.sha256(system_prompt.encode("utf-8")).hexdigest()[:16]
+
+
+def make_key(deployment: str, system_prompt: str, message: str, params: tuple) -> str:
+    """Clave: deployment + system prompt + mensaje normalizado + parámetros"""
+    raw = "\x1f".join([deployment, prompt_hash(system_prompt), normalize_message(message), repr(params)])
+    return prompt_hash(system_prompt) + ":" + hashlib.sha256(raw.encode("utf-8")).hexdigest()
+
+
+class _SQLiteTier:
+    """Segundo nivel en disco, compartido por los workers de gunicorn"""
+
+    def __init__(self, path: str):
+        self._lock = threading.Lock()
+        self._db = sqlite3.connect(path, check_same_thread=False, isolation_level=None)
+        self._db.execute("PRAGMA journal_mode=WAL")
+        self._db.execute("PRAGMA synchronous=NORMAL")
+        self._db.execute(
+            "CREATE TABLE IF NOT EXISTS response_cache ("
+            "key TEXT PRIMARY KEY, value TEXT NOT NULL, expires_at REAL NOT NULL)"
+        )
+
+    def get(self, key: str) -> Optional[str]:
+        with self._lock:
+            row = self._db.execute(
+                "SELECT value FROM response_cache WHERE key = ? AND expires_at > ?",
+                (key, time.time())
+            ).fetchone()
+        return row[0] if row else None
+
+    def set(self, key: str, value: str, ttl: float):
+        with self._lock:
+            self._db.execute(
+                "INSERT OR REPLACE INTO response_cache (key, value, expires_at) VALUES (?, ?, ?)",
+                (key, value, time.time() + ttl)
+            )
+
+    def retain_prefix(self, prefix: str):
+        """Borra entradas de otros system prompts y las expiradas"""
+        with self._lock:
+            self._db.execute(
+                "DELETE FROM response_cache WHERE substr(key, 1, ?) != ? OR expires_at <= ?",
+                (len(prefix), prefix, time.time())
+            )
+
+    def clear(self):
+        with self._lock:
+            self._db.execute("DELETE FROM response_cache")
+
+
+class ResponseCache:
+    """LRU en memoria con TTL y tope de entradas, con segundo nivel SQLite opcional"""
+
+    def __init__(self, ttl: float, max_entries: int, db_path: str = ""):
+        self.ttl = ttl
+        self.max_entries = max_entries
+        self._memory: "OrderedDict[str, tuple]" = OrderedDict()
+        self._disk = _SQLiteTier(db_path) if db_path else None
+        self._prompt_prefix: Optional[str] = None
+        self.hits = 0
+        self.disk_hits = 0
+        self.misses = 0
+
+    def bind_system_prompt(self, system_prompt: str):
+        """Invalida todo lo generado con un system prompt distinto al actual"""
+        prefix = prompt_hash(system_prompt)
+        if prefix == self._prompt_prefix:
+            return
+        if self._prompt_prefix is not None:
+            logger.info("♻️ System prompt cambiado: caché de respuestas invalidada")
+        self._prompt_prefix = prefix
+        for key in [k for k in self._memory if not k.startswith(prefix)]:
+            del self._memory[key]
+        if self._disk is not None:
+            self._disk.retain_prefix(prefix)
+
+    async def get(self, key: str) -> Optional[str]:
+        entry = self._memory.get(key)
+        if entry is not None:
+            expires_at, value = entry
+            if expires_at > time.monotonic():
+                self._memory.move_to_end(key)
+                self.hits += 1
+                return value
+            del self._memory[key]
+        if self._disk is not None:
+            value = await asyncio.to_thread(self._disk.get, key)
+            if value is not None:
+                self._remember(key, value)
+                self.disk_hits += 1
+                return value
+        self.misses += 1
+        return None
+
+    async def set(self, key: str, value: str):
+        self._remember(key, value)
+        if self._disk is not None:
+            await asyncio.to_thread(self._disk.set, key, value, self.ttl)
+
+    def invalidate(self):
+        """Vacía ambos niveles"""
+        self._memory.clear()
+        if self._disk is not None:
+            self._disk.clear()
+
+    def stats(self) -> dict:
+        lookups = self.hits + self.disk_hits + self.misses
+        return {
+            "entries": len(self._memory),
+            "hits": self.hits,
+            "disk_hits": self.disk_hits,
+            "misses": self.misses,
+            "hit_rate": round((self.hits + self.disk_hits) / lookups, 3) if lookups else 0.0,
+            "disk": self._disk is not None,
+        }
+
+    def _remember(self, key: str, value: str):
+        self._memory[key] = (time.monotonic() + self.ttl, value)
+        self._memory.move_to_end(key)
+        while len(self._memory) > self.max_entries:
+            self._memory.popitem(last=False)
+
+
+_cache: Optional[ResponseCache] = None
+
+
+def get_cache() -> Optional[ResponseCache]:
+    """Caché compartida del proceso (None si está deshabilitada)"""
+    global _cache
+    if RESPONSE_CACHE_ENABLED and _cache is None:
+        _cache = ResponseCache(RESPONSE_CACHE_TTL, RESPONSE_CACHE_MAX_ENTRIES, RESPONSE_CACHE_DB)
+        _cache.bind_system_prompt(prompts.shared_prefix())
+    return _cache
+
+
+metrics.register_stats("response_cache", lambda: _cache.stats() if _cache else None)
@@ -0,0 +1,572 @@
+"""
+Recuperación sobre la documentación interna de Evidenze
+
+- Indexado (offline, `python retrieval.py index`): trocea los .md/.txt de
+  RETRIEVAL_DOCS_DIR y guarda los embeddings en un array float32 plano más un
+  índice JSON con los fragmentos y los ficheros de origen. Solo se vuelven a
+  embeber los ficheros que cambiaron; cada reindexado escribe una generación
+  nueva y el JSON (que la referencia) se reemplaza al final de forma atómica.
+- Consulta: producto escalar vectorizado con NumPy sobre el array abierto con
+  memmap (sin copiar a RAM). Con RETRIEVAL_IVF_MIN_CHUNKS o más fragmentos,
+  los vectores se agrupan por centroides (k-means esférico) y solo se recorren
+  las RETRIEVAL_IVF_NPROBE listas más próximas a la consulta.
+- El embedder es intercambiable: hash de rasgos local (determinista, sin red),
+  un deployment de embeddings de Azure o una fábrica propia ("modulo:fabrica").
+"""
+import argparse
+import asyncio
+import hashlib
+import importlib
+import json
+import logging
+import math
+import os
+import re
+import time
+from collections import OrderedDict
+from functools import lru_cache
+from typing import Dict, List, Optional, Sequence, Tuple
+
+import numpy as np
+
+import metrics
+from normalize import STOPWORDS, normalize_message
+from tokens import count_tokens
+from config import (
+    RETRIEVAL_ENABLED,
+    RETRIEVAL_DOCS_DIR,
+    RETRIEVAL_INDEX_DIR,
+    RETRIEVAL_EMBEDDER,
+    RETRIEVAL_EMBEDDING_DEPLOYMENT,
+    RETRIEVAL_HASH_DIM,
+    RETRIEVAL_CHUNK_TOKENS,
+    RETRIEVAL_TOP_K,
+    RETRIEVAL_MIN_SCORE,
+    RETRIEVAL_MAX_TOKENS,
+    RETRIEVAL_IVF_MIN_CHUNKS,
+    RETRIEVAL_IVF_NPROBE,
+    RETRIEVAL_RELOAD_INTERVAL
+)
+
+logger = logging.getLogger(__name__)
+
+INDEX_FILE = "index.json"
+INDEX_VERSION = 1
+EXTENSIONS = (".md", ".txt")
+EMBED_BATCH = 64
+QUERY_CACHE_SIZE = 1024
+# Los vectores de consultas recientes no se guardan más de esto (segundos)
+QUERY_CACHE_TTL = 300.0
+
+_WORDS = re.compile(r"\w+")
+_PARAGRAPHS = re.compile(r"\n\s*\n")
+
+def _normalize(vectors: np.ndarray) -> np.ndarray:
+    """Filas con norma 1 (el coseno pasa a ser un producto escalar)"""
+    norms = np.linalg.norm(vectors, axis=1, keepdims=True)
+    return (vectors / np.maximum(norms, 1e-12)).astype(np.float32, copy=False)
+
+
+# === EMBEDDERS ===
+
+class HashEmbedder:
+    """Bolsa de rasgos con hashing (palabra, raíz de 5 letras y bigrama)
+
+    Determinista entre procesos y máquinas, sin red ni modelo: sirve para
+    pruebas y como respaldo léxico cuando no hay deployment de embeddings.
+    """
+
+    def __init__(self, dim: int = RETRIEVAL_HASH_DIM):
+        self.dim = dim
+        self.name = f"hash-{dim}"
+
+    @staticmethod
+    @lru_cache(maxsize=65536)
+    def _bucket(feature: str) -> int:
+        return int.from_bytes(hashlib.blake2b(feature.encode("utf-8"), digest_size=8).digest(), "little")
+
+    def _features(self, text: str) -> List[str]:
+        words = [w for w in _WORDS.findall(normalize_message(text)) if w not in STOPWORDS]
+        features = list(words)
+        features.extend(f"~{w[:5]}" for w in words if len(w) > 5)
+        features.extend(f"{a} {b}" for a, b in zip(words, words[1:]))
+        return features
+
+    def embed_sync(self, texts: Sequence[str]) -> np.ndarray:
+        vectors = np.zeros((len(texts), self.dim), dtype=np.float32)
+        for row, text in enumerate(texts):
+            counts: Dict[int, float] = {}
+            for feature in self._features(text):
+                h = self._bucket(feature)
+                # El bit alto da el signo: las colisiones tienden a anularse
+                index = (h % self.dim, -1.0 if h >> 63 else 1.0)
+                counts[index] = counts.get(index, 0) + 1
+            for (column, sign), tf in counts.items():
+                vectors[row, column] += sign * (1.0 + math.log(tf))
+        return _normalize(vectors)
+
+    async def embed(self, texts: Sequence[str]) -> np.ndarray:
+        return self.embed_sync(texts)
+
+
+class AzureEmbedder:
+    """Embeddings de un deployment de Azure OpenAI (comparte el pool HTTP)"""
+
+    def __init__(self, deployment: str = RETRIEVAL_EMBEDDING_DEPLOYMENT):
+        self.deployment = deployment
+        self.name = f"azure:{deployment}"
+        self.dim: Optional[int] = None
+
+    async def embed(self, texts: Sequence[str]) -> np.ndarray:
+        import openai_client
+        # Fuera del gobernador de cuota: la cuota de embeddings es otra y las consultas son cortas
+        response = await openai_client.get_client().embeddings.create(model=self.deployment, input=list(texts))
+        rows = sorted(response.data, key=lambda item: item.index)
+        vectors = _normalize(np.array([item.embedding for item in rows], dtype=np.float32))
+        self.dim = vectors.shape[1]
+        return vectors
+
+
+def make_embedder(spec: str = RETRIEVAL_EMBEDDER):
+    """Embedder según RETRIEVAL_EMBEDDER"""
+    if spec == "hash":
+        return HashEmbedder()
+    if spec == "azure":
+        return AzureEmbedder()
+    module, _, factory = spec.partition(":")
+    return getattr(importlib.import_module(module), factory)()
+
+
+# === TROCEADO ===
+
+def chunk_text(text: str, max_tokens: int = RETRIEVAL_CHUNK_TOKENS) -> List[Tuple[str, str]]:
+    """(título, texto) por fragmento: párrafos agrupados hasta max_tokens
+
+    El título es el último encabezado markdown visto; se embebe junto al
+    fragmento para que un párrafo suelto conserve de qué sección viene.
+    """
+    chunks: List[Tuple[str, str]] = []
+    title = ""
+    current: List[str] = []
+    used = 0
+
+    def flush():
+        nonlocal current, used
+        if current:
+            chunks.append((title, "\n\n".join(current)))
+        current, used = [], 0
+
+    for paragraph in _PARAGRAPHS.split(text):
+        paragraph = paragraph.strip()
+        if not paragraph:
+            continue
+        if paragraph.startswith("#"):
+            flush()
+            heading, _, rest = paragraph.partition("\n")
+            title = heading.lstrip("#").strip()
+            paragraph = rest.strip()
+            if not paragraph:
+                continue
+        size = count_tokens(paragraph)
+        if current and used + size > max_tokens:
+            flush()
+        if size > max_tokens:
+            # Párrafo enorme: cortes por palabras de ~max_tokens
+            words = paragraph.split()
+            step = max(len(words) * max_tokens // size, 1)
+            for start in range(0, len(words), step):
+                current = [" ".join(words[start:start + step])]
+                flush()
+            continue
+        current.append(paragraph)
+        used += size
+    flush()
+    return chunks
+
+
+# === ÍNDICE EN DISCO ===
+
+def _kmeans(vectors: np.ndarray, k: int, iterations: int = 10, seed: int = 0) -> Tuple[np.ndarray, np.ndarray]:
+    """k-means esférico: (centroides normalizados, lista asignada a cada fila)"""
+    rng = np.random.default_rng(seed)
+    centroids = np.array(vectors[rng.choice(len(vectors), size=k, replace=False)])
+    assign = np.zeros(len(vectors), dtype=np.int64)
+    for _ in range(iterations):
+        for start in range(0, len(vectors), 65536):
+            block = vectors[start:start + 65536]
+            assign[start:start + 65536] = np.argmax(block @ centroids.T, axis=1)
+        order = np.argsort(assign, kind="stable")
+        counts = np.bincount(assign, minlength=k)
+        filled = np.flatnonzero(counts)
+        offsets = np.concatenate(([0], np.cumsum(counts)[:-1]))
+        sums = np.add.reduceat(vectors[order], offsets[filled], axis=0)
+        # Las listas vacías conservan su centroide
+        centroids[filled] = _normalize(sums)
+    return centroids, assign
+
+
+class VectorIndex:
+    """Generación del índice abierta en solo lectura"""
+
+    def __init__(self, index_dir: str, meta: dict):
+        self.meta = meta
+        self.chunks: List[dict] = meta["chunks"]
+        self.dim: int = meta["dim"]
+        self.embedder: str = meta["embedder"]
+        count = len(self.chunks)
+        self.vectors = np.memmap(
+            os.path.join(index_dir, meta["vectors"]), dtype=np.float32, mode="r", shape=(count, self.dim)
+        ) if count else np.zeros((0, self.dim), dtype=np.float32)
+        self.centroids = None
+        self.lists = None
+        if meta.get("centroids"):
+            self.centroids = np.fromfile(os.path.join(index_dir, meta["centroids"]), dtype=np.float32).reshape(-1, self.dim)
+            self.lists = np.array(meta["lists"], dtype=np.int64)
+
+    @classmethod
+    def load(cls, index_dir: str) -> Optional["VectorIndex"]:
+        meta = read_meta(index_dir)
+        return cls(index_dir, meta) if meta else None
+
+    def __len__(self) -> int:
+        return len(self.chunks)
+
+    def search(self, query: np.ndarray, k: int, nprobe: int = RETRIEVAL_IVF_NPROBE) -> List[Tuple[int, float]]:
+        """(fila, coseno) de los k fragmentos más parecidos, de mayor a menor"""
+        if not len(self):
+            return []
+        if self.centroids is None or nprobe >= len(self.centroids):
+            rows = None
+            scores = self.vectors @ query
+        else:
+            probe = np.argpartition(-(self.centroids @ query), nprobe - 1)[:nprobe]
+            # Cada lista es un tramo contiguo del array: lecturas secuenciales del memmap
+            spans = [self.lists[p] for p in probe if self.lists[p][1] > self.lists[p][0]]
+            if not spans:
+                return []
+            rows = np.concatenate([np.arange(start, end) for start, end in spans])
+            scores = np.concatenate([self.vectors[start:end] @ query for start, end in spans])
+        k = min(k, len(scores))
+        top = np.argpartition(-scores, k - 1)[:k]
+        top = top[np.argsort(-scores[top])]
+        ids = top if rows is None else rows[top]
+        return [(int(i), float(scores[t])) for i, t in zip(ids, top)]
+
+
+def read_meta(index_dir: str) -> Optional[dict]:
+    try:
+        with open(os.path.join(index_dir, INDEX_FILE), encoding="utf-8") as f:
+            meta = json.load(f)
+    except FileNotFoundError:
+        return None
+    if meta.get("version") != INDEX_VERSION:
+        logger.warning(f"⚠️ Índice de recuperación con versión {meta.get('version')}, se ignora")
+        return None
+    return meta
+
+
+def _scan(docs_dir: str) -> List[str]:
+    paths = []
+    for root, _, files in os.walk(docs_dir):
+        for name in files:
+            if name.lower().endswith(EXTENSIONS):
+                paths.append(os.path.relpath(os.path.join(root, name), docs_dir))
+    return sorted(paths)
+
+
+async def build_index(
+    docs_dir: str = RETRIEVAL_DOCS_DIR,
+    index_dir: str = RETRIEVAL_INDEX_DIR,
+    embedder=None,
+    full: bool = False,
+    ivf_min_chunks: int = RETRIEVAL_IVF_MIN_CHUNKS,
+    chunk_tokens: int = RETRIEVAL_CHUNK_TOKENS
+) -> dict:
+    """(Re)indexa docs_dir; reutiliza los vectores de los ficheros sin cambios"""
+    embedder = embedder or make_embedder()
+    os.makedirs(index_dir, exist_ok=True)
+    previous = None if full else VectorIndex.load(index_dir)
+    if previous is not None and previous.embedder != embedder.name:
+        logger.info(f"♻️ Embedder cambiado ({previous.embedder} -> {embedder.name}): reindexado completo")
+        previous = None
+    old_files = previous.meta["files"] if previous else {}
+
+    chunks: List[dict] = []
+    parts: List[np.ndarray] = []
+    files: Dict[str, dict] = {}
+    pending: List[Tuple[str, List[Tuple[str, str]]]] = []
+    summary = {"files": 0, "reused": 0, "embedded": 0, "removed": 0, "chunks": 0}
+
+    for rel in _scan(docs_dir):
+        path = os.path.join(docs_dir, rel)
+        stat = os.stat(path)
+        entry = {"size": stat.st_size, "mtime_ns": stat.st_mtime_ns}
+        old = old_files.get(rel)
+        same = old is not None and old["size"] == entry["size"] and old["mtime_ns"] == entry["mtime_ns"]
+        if not same:
+            with open(path, encoding="utf-8", errors="replace") as f:
+                text = f.read()
+            entry["sha1"] = hashlib.sha1(text.encode("utf-8")).hexdigest()
+            # Tocado pero con el mismo contenido (checkout, copia): no se reembebe
+            same = old is not None and old.get("sha1") == entry["sha1"]
+        else:
+            entry["sha1"] = old["sha1"]
+        summary["files"] += 1
+        if same:
+            rows = old["rows"]
+            entry["rows"] = list(range(len(chunks), len(chunks) + len(rows)))
+            chunks.extend(previous.chunks[r] for r in rows)
+            parts.append(np.asarray(previous.vectors[rows]))
+            files[rel] = entry
+            summary["reused"] += 1
+        else:
+            pending.append((rel, chunk_text(text, chunk_tokens)))
+            files[rel] = entry
+    summary["removed"] = len(set(old_files) - set(files))
+
+    for rel, pieces in pending:
+        start = len(chunks)
+        texts = [f"{title}\n{text}" if title else text for title, text in pieces]
+        for batch in range(0, len(texts), EMBED_BATCH):
+            parts.append(await embedder.embed(texts[batch:batch + EMBED_BATCH]))
+        chunks.extend({"source": rel, "title": title, "text": text} for title, text in pieces)
+        files[rel]["rows"] = list(range(start, len(chunks)))
+        summary["embedded"] += 1
+
+    if not pending and not summary["removed"] and previous is not None and len(files) == len(old_files):
+        logger.info("✅ Índice de recuperación sin cambios")
+        summary["chunks"] = len(chunks)
+        return summary
+
+    dim = parts[0].shape[1] if parts else getattr(embedder, "dim", None) or 0
+    vectors = np.concatenate(parts).astype(np.float32, copy=False) if parts else np.zeros((0, dim), np.float32)
+    centroids = lists = None
+    if len(vectors) >= max(ivf_min_chunks, 1):
+        centroids, assign = _kmeans(vectors, int(math.sqrt(len(vectors))))
+        order = np.argsort(assign, kind="stable")
+        vectors = vectors[order]
+        chunks = [chunks[i] for i in order]
+        position = np.empty_like(order)
+        position[order] = np.arange(len(order))
+        for entry in files.values():
+            entry["rows"] = sorted(int(position[r]) for r in entry["rows"])
+        ends = np.cumsum(np.bincount(assign, minlength=len(centroids)))
+        lists = [[int(start), int(end)] for start, end in zip(np.concatenate(([0], ends[:-1])), ends)]
+
+    # Nunca se reescribe una generación existente: otro proceso puede tenerla mapeada
+    last = read_meta(index_dir)
+    generation = max(last["generation"] + 1 if last else 0, int(time.time()))
+    meta = {
+        "version": INDEX_VERSION,
+        "generation": generation,
+        "embedder": embedder.name,
+        "dim": int(dim),
+        "vectors": f"vectors-{generation}.f32",
+        "centroids": f"centroids-{generation}.f32" if centroids is not None else None,
+        "lists": lists,
+        "chunks": chunks,
+        "files": files,
+    }
+    vectors.tofile(os.path.join(index_dir, meta["vectors"]))
+    if centroids is not None:
+        centroids.astype(np.float32).tofile(os.path.join(index_dir, meta["centroids"]))
+    tmp = os.path.join(index_dir, INDEX_FILE + ".tmp")
+    with open(tmp, "w", encoding="utf-8") as f:
+        json.dump(meta, f, ensure_ascii=False)
+    # Los procesos que tengan abierta la generación anterior la siguen leyendo hasta recargar
+    os.replace(tmp, os.path.join(index_dir, INDEX_FILE))
+    keep = {meta["vectors"], meta["centroids"]}
+    for name in os.listdir(index_dir):
+        if name.endswith(".f32") and name not in keep:
+            os.remove(os.path.join(index_dir, name))
+
+    summary["chunks"] = len(chunks)
+    logger.info(
+        f"✅ Índice de recuperación: {summary['chunks']} fragmentos de {summary['files']} ficheros "
+        f"({summary['embedded']} reindexados, {summary['reused']} sin cambios, {summary['removed']} eliminados)"
+    )
+    return summary
+
+
+# === CONSULTA ===
+
+class Passage:
+    """Fragmento recuperado para el prompt"""
+    __slots__ = ("source", "title", "text", "score")
+
+    def __init__(self, source: str, title: str, text: str, score: float):
+        self.source = source
+        self.title = title
+        self.text = text
+        self.score = score
+
+
+class Retriever:
+    """Índice abierto del proceso; recarga solo la generación nueva cuando aparece"""
+
+    def __init__(self, index_dir: str, embedder):
+        self.index_dir = index_dir
+        self.embedder = embedder
+        self.index: Optional[VectorIndex] = None
+        self._loaded_mtime = None
+        self._checked = 0.0
+        # Huella de la consulta normalizada -> (vector, caducidad), en orden de llegada
+        self._queries: "OrderedDict[bytes, Tuple[np.ndarray, float]]" = OrderedDict()
+        self.searches = 0
+        self.empty = 0
+        self.reloads = 0
+
+    def _index_mtime(self):
+        try:
+            return os.stat(os.path.join(self.index_dir, INDEX_FILE)).st_mtime_ns
+        except FileNotFoundError:
+            return None
+
+    def load(self):
+        """Abre la generación actual del índice si no es la ya cargada"""
+        mtime = self._index_mtime()
+        self._checked = time.monotonic()
+        if mtime == self._loaded_mtime:
+            return
+        index = VectorIndex.load(self.index_dir) if mtime is not None else None
+        if index is not None and index.embedder != self.embedder.name:
+            logger.warning(f"⚠️ Índice creado con {index.embedder}, no con {self.embedder.name}: se ignora")
+            index = None
+        self.index = index
+        self._loaded_mtime = mtime
+        self._queries.clear()
+        self.reloads += 1
+        if index is not None:
+            mode = f"IVF con {len(index.centroids)} listas" if index.centroids is not None else "plano"
+            logger.info(f"📚 Índice de recuperación cargado: {len(index)} fragmentos ({mode})")
+
+    async def _embed_query(self, text: str) -> np.ndarray:
+        """Vector de la consulta; el texto del usuario no se guarda, solo su huella"""
+        now = time.monotonic()
+        while self._queries and next(iter(self._queries.values()))[1] <= now:
+            self._queries.popitem(last=False)
+        key = hashlib.blake2b(normalize_message(text).encode("utf-8"), digest_size=16).digest()
+        cached = self._queries.get(key)
+        if cached is not None and cached[1] > now:
+            return cached[0]
+        vector = (await self.embedder.embed([text]))[0]
+        self._queries.pop(key, None)
+        self._queries[key] = (vector, now + QUERY_CACHE_TTL)
+        if len(self._queries) > QUERY_CACHE_SIZE:
+            self._queries.popitem(last=False)
+        return vector
+
+    async def search(
+        self,
+        text: str,
+        k: int = RETRIEVAL_TOP_K,
+        min_score: float = RETRIEVAL_MIN_SCORE
+    ) -> List[Passage]:
+        if time.monotonic() - self._checked >= RETRIEVAL_RELOAD_INTERVAL:
+            # Leer el JSON de una generación grande no debe parar el event loop
+            await asyncio.to_thread(self.load)
+        index = self.index
+        if index is None or not len(index):
+            return []
+        started = time.perf_counter()
+        query = await self._embed_query(text)
+        embedded = time.perf_counter()
+        hits = index.search(query, k)
+        finished = time.perf_counter()
+        metrics.RETRIEVAL_DURATION.observe(embedded - started, "embed")
+        metrics.RETRIEVAL_DURATION.observe(finished - embedded, "search")
+        self.searches += 1
+        passages = [
+            Passage(index.chunks[row]["source"], index.chunks[row]["title"], index.chunks[row]["text"], score)
+            for row, score in hits if score >= min_score
+        ]
+        if not passages:
+            self.empty += 1
+        return passages
+
+    def stats(self) -> dict:
+        index = self.index
+        return {
+            "chunks": len(index) if index else 0,
+            "lists": len(index.centroids) if index is not None and index.centroids is not None else 0,
+            "searches": self.searches,
+            "empty": self.empty,
+            "reloads": self.reloads,
+        }
+
+
+_retriever: Optional[Retriever] = None
+
+
+def get_retriever() -> Optional[Retriever]:
+    """Retriever del proceso (None si la recuperación está deshabilitada)"""
+    global _retriever
+    if RETRIEVAL_ENABLED and _retriever is None:
+        _retriever = Retriever(RETRIEVAL_INDEX_DIR, make_embedder())
+    return _retriever
+
+
+def set_embedder(embedder):
+    """Sustituye el embedder (pruebas); el índice se vuelve a abrir con él"""
+    global _retriever
+    _retriever = Retriever(RETRIEVAL_INDEX_DIR, embedder)
+
+
+def preload():
+    """Abre el índice antes del fork: el memmap y los metadatos quedan compartidos"""
+    retriever = get_retriever()
+    if retriever is not None:
+        retriever.load()
+
+
+async def context(query: str) -> List[Passage]:
+    """Fragmentos para el prompt, dentro de RETRIEVAL_MAX_TOKENS (vacío si no hay o falla)"""
+    retriever = get_retriever()
+    if retriever is None:
+        return []
+    try:
+        passages = await retriever.search(query)
+    except Exception as e:
+        # Sin documentación se responde igual: la recuperación nunca tumba la consulta
+        logger.warning(f"⚠️ Recuperación fallida: {e}")
+        metrics.record_error("retrieval", e)
+        return []
+    selected, used = [], 0
+    for passage in passages:
+        used += count_tokens(passage.text)
+        if selected and used > RETRIEVAL_MAX_TOKENS:
+            break
+        selected.append(passage)
+    return selected
+
+
+metrics.register_stats("retrieval", lambda: _retriever.stats() if _retriever else None)
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Índice de recuperación sobre la documentación interna")
+    sub = parser.add_subparsers(dest="command", required=True)
+    index_cmd = sub.add_parser("index", help="Indexa (incrementalmente) la carpeta de documentos")
+    index_cmd.add_argument("--docs", default=RETRIEVAL_DOCS_DIR)
+    index_cmd.add_argument("--index", default=RETRIEVAL_INDEX_DIR)
+    index_cmd.add_argument("--full", action="store_true", help="Reembebe todos los ficheros")
+    search_cmd = sub.add_parser("search", help="Consulta el índice")
+    search_cmd.add_argument("query")
+    search_cmd.add_argument("--index", default=RETRIEVAL_INDEX_DIR)
+    search_cmd.add_argument("-k", type=int, default=RETRIEVAL_TOP_K)
+    args = parser.parse_args()
+    logging.basicConfig(level=logging.INFO)
+
+    embedder = make_embedder()
+    if args.command == "index":
+        summary = asyncio.run(build_index(args.docs, args.index, embedder, full=args.full))
+        print(json.dumps(summary))
+        return
+    retriever = Retriever(args.index, embedder)
+    retriever.load()
+    for passage in asyncio.run(retriever.search(args.query, k=args.k, min_score=-1.0)):
+        print(f"{passage.score:.3f}  {passage.source}  {passage.title}\n    {passage.text[:160]!r}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,318 @@
+"""
+Router multi-deployment / multi-región para Azure OpenAI
+
+Elige backend por latencia EWMA, tasa de error y cuota restante; expulsa
+temporalmente los backends que fallan (circuit breaker) y, opcionalmente,
+lanza una petición de cobertura (hedging) a otro backend si la primera
+supera el p95 de latencia.
+"""
+import asyncio
+import logging
+import os
+import time
+from collections import deque
+from typing import List, Optional
+
+import deadline
+import metrics
+import openai
+import openai_client
+from rate_governor import Permit, RateGovernor, RateLimited, retry_after_seconds
+from config import (
+    AZURE_OPENAI_BACKENDS,
+    AZURE_OPENAI_API_VERSION,
+    AZURE_OPENAI_RPM,
+    AZURE_OPENAI_TPM,
+    RATE_GOVERNOR_ENABLED,
+    RATE_MAX_QUEUE,
+    RATE_MAX_WAIT,
+    RATE_CLIENT_WEIGHTS,
+    ROUTER_FAILURE_THRESHOLD,
+    ROUTER_EJECT_SECONDS,
+    ROUTER_HEDGING,
+    ROUTER_HEDGE_MIN_DELAY
+)
+
+logger = logging.getLogger(__name__)
+
+# Errores que indican un backend con problemas (no un prompt inválido)
+BACKEND_ERRORS = (openai.APIConnectionError, openai.InternalServerError)
+
+EWMA_ALPHA = 0.2
+
+
+class Backend:
+    """Un endpoint + deployment con su cuota y su salud"""
+
+    def __init__(self, spec: dict):
+        self.name = spec.get("name") or spec["endpoint"]
+        self.endpoint = spec["endpoint"]
+        self.deployment = spec["deployment"]
+        self.weight = float(spec.get("weight", 1.0))
+        self.api_key = spec.get("api_key") or os.environ.get(spec.get("api_key_env", "AZURE_OPENAI_API_KEY"))
+        self.api_version = spec.get("api_version", AZURE_OPENAI_API_VERSION)
+        self.governor = RateGovernor(
+            float(spec.get("rpm", AZURE_OPENAI_RPM)),
+            float(spec.get("tpm", AZURE_OPENAI_TPM)),
+            RATE_MAX_QUEUE,
+            RATE_MAX_WAIT,
+            RATE_CLIENT_WEIGHTS
+        ) if RATE_GOVERNOR_ENABLED else None
+        self.latency = 1.0
+        self.error_rate = 0.0
+        self.latencies = deque(maxlen=200)
+        self.failures = 0
+        self.ejected_until = 0.0
+        self.requests = 0
+        self.errors = 0
+
+    @property
+    def client(self):
+        # Resuelto en cada uso: el pool puede haberse reabierto (lifespan)
+        return openai_client.get_client(self.endpoint, self.api_key, self.api_version)
+
+    def available(self, now: float) -> bool:
+        return now >= self.ejected_until
+
+    def score(self, estimated_tokens: int) -> float:
+        """Menor es mejor: latencia esperada + espera por cuota, penalizada por errores"""
+        wait = 0.0
+        if self.governor is not None:
+            wait = max(
+                self.governor.paused_for(),
+                self.governor.requests.wait_time(1),
+                self.governor.tokens.wait_time(estimated_tokens)
+            )
+        return (self.latency + wait) * (1 + 5 * self.error_rate) / self.weight
+
+    def p95(self) -> Optional[float]:
+        if len(self.latencies) < 20:
+            return None
+        ordered = sorted(self.latencies)
+        return ordered[int(len(ordered) * 0.95) - 1]
+
+    def record_success(self, latency: float):
+        self.requests += 1
+        self.latency += EWMA_ALPHA * (latency - self.latency)
+        self.error_rate *= 1 - EWMA_ALPHA
+        self.latencies.append(latency)
+        self.failures = 0
+
+    def record_failure(self):
+        self.requests += 1
+        self.errors += 1
+        self.error_rate += EWMA_ALPHA * (1 - self.error_rate)
+        self.failures += 1
+        if self.failures >= ROUTER_FAILURE_THRESHOLD:
+            # Circuit breaker: fuera de rotación; tras el plazo, una petición de prueba
+            self.ejected_until = time.monotonic() + ROUTER_EJECT_SECONDS
+            self.failures = ROUTER_FAILURE_THRESHOLD - 1
+            logger.warning(f"⛔ Backend {self.name} expulsado {ROUTER_EJECT_SECONDS:.0f}s")
+
+    def stats(self) -> dict:
+        return {
+            "name": self.name,
+            "deployment": self.deployment,
+            "latency_ewma": round(self.latency, 3),
+            "latency_p95": self.p95(),
+            "error_rate": round(self.error_rate, 3),
+            "requests": self.requests,
+            "errors": self.errors,
+            "ejected": not self.available(time.monotonic()),
+            "governor": self.governor.stats() if self.governor else None,
+        }
+
+
+class Ticket:
+    """Petición enviada: backend que respondió y cupo a conciliar"""
+    __slots__ = ("backend", "permit")
+
+    def __init__(self, backend: Backend, permit: Optional[Permit]):
+        self.backend = backend
+        self.permit = permit
+
+
+class Router:
+    """Reparte las llamadas entre los backends configurados"""
+
+    def __init__(self, specs: List[dict]):
+        self.backends = [Backend(spec) for spec in specs]
+        self.hedges = 0
+        self.hedge_wins = 0
+
+    def pick(self, estimated_tokens: int, exclude=()) -> Optional[Backend]:
+        now = time.monotonic()
+        candidates = [b for b in self.backends if b not in exclude and b.available(now)]
+        if candidates:
+            return min(candidates, key=lambda b: b.score(estimated_tokens))
+        if any(b.available(now) for b in self.backends):
+            return None
+        # Todos expulsados: se prueba el que antes vuelva
+        candidates = [b for b in self.backends if b not in exclude]
+        return min(candidates, key=lambda b: b.ejected_until) if candidates else None
+
+    async def send(self, create_kwargs: dict, estimated_tokens: int, retries: int, client: str = "default"):
+        """Envía con reintentos en otro backend; devuelve (respuesta cruda, ticket)
+
+        client identifica a quien llama (bot, chat web...) para el reparto justo de la cuota.
+        Los reintentos y sus pausas solo se hacen si caben en el plazo de la petición.
+        """
+        tried = []
+        broken = []
+        last_error: Optional[Exception] = None
+        for attempt in range(retries + 1):
+            deadline.check()
+            backend = self.pick(estimated_tokens, exclude=tried)
+            if backend is None:
+                # Ya se probaron todos: se vuelve a empezar, primero por los que no fallaron
+                tried = list(broken)
+                backend = self.pick(estimated_tokens, exclude=tried) or self.pick(estimated_tokens)
+            try:
+                if ROUTER_HEDGING and len(self.backends) > 1:
+                    return await self._hedged(backend, create_kwargs, estimated_tokens, client)
+                return await self._attempt(backend, create_kwargs, estimated_tokens, client)
+            except openai.RateLimitError as e:
+                last_error = e
+                tried.append(backend)
+                # Sin gobernador ni alternativa: respetar el Retry-After
+                if backend.governor is None and len(tried) >= len(self.backends):
+                    await deadline.sleep(retry_after_seconds(e.response.headers))
+            except deadline.DeadlineExceeded:
+                raise
+            except RateLimited as e:
+                last_error = e
+                tried.append(backend)
+                if len(tried) >= len(self.backends):
+                    raise
+            except BACKEND_ERRORS as e:
+                last_error = e
+                tried.append(backend)
+                broken.append(backend)
+                if len(tried) >= len(self.backends):
+                    await deadline.sleep(0.5 * 2 ** attempt)
+        raise last_error
+
+    async def _attempt(self, backend: Backend, create_kwargs: dict, estimated_tokens: int, client: str = "default"):
+        permit = None
+        if backend.governor:
+            permit = await backend.governor.acquire(estimated_tokens, deadline=deadline.at(), client=client)
+            metrics.OPENAI_QUEUE.observe(permit.queued, backend.name, client)
+        remaining = deadline.remaining()
+        if remaining is not None:
+            # Lo que le queda a la petición, no el timeout por defecto del cliente
+            create_kwargs = {**create_kwargs, "timeout": remaining}
+        metrics.OPENAI_IN_FLIGHT.inc(backend.name)
+        started = time.perf_counter()
+        try:
+            raw = await backend.client.chat.completions.with_raw_response.create(
+                model=backend.deployment,
+                **create_kwargs
+            )
+        except openai.RateLimitError as e:
+            if backend.governor:
+                backend.governor.release(permit)
+                backend.governor.on_rate_limited(e.response.headers)
+            self._observe(backend, started, e)
+            raise
+        except BACKEND_ERRORS as e:
+            if backend.governor:
+                backend.governor.release(permit)
+            self._observe(backend, started, e)
+            if isinstance(e, openai.APITimeoutError) and deadline.expired():
+                # Se acabó el plazo de la petición: no cuenta contra el backend
+                raise deadline.DeadlineExceeded() from e
+            backend.record_failure()
+            raise
+        except BaseException as e:
+            # Cancelada (p. ej. perdió la carrera del hedging)
+            if backend.governor:
+                backend.governor.release(permit)
+            self._observe(backend, started, e)
+            raise
+        backend.record_success(time.perf_counter() - started)
+        self._observe(backend, started)
+        return raw, Ticket(backend, permit)
+
+    def _observe(self, backend: Backend, started: float, error: Optional[BaseException] = None):
+        metrics.OPENAI_IN_FLIGHT.dec(backend.name)
+        outcome = type(error).__name__ if error is not None else "ok"
+        metrics.OPENAI_DURATION.observe(time.perf_counter() - started, backend.name, outcome)
+
+    async def _hedged(self, primary: Backend, create_kwargs: dict, estimated_tokens: int, client: str):
+        """Si la primaria supera su p95, lanza otra a un segundo backend; gana la primera"""
+        first = asyncio.ensure_future(self._attempt(primary, create_kwargs, estimated_tokens, client))
+        # Lo que siga en marcha al salir (error, victoria de la otra o cancelación) se cancela
+        pending = {first}
+        error: Optional[BaseException] = None
+        try:
+            delay = max(primary.p95() or ROUTER_HEDGE_MIN_DELAY, ROUTER_HEDGE_MIN_DELAY)
+            done, _ = await asyncio.wait(pending, timeout=delay)
+            if done:
+                return first.result()
+
+            secondary = self.pick(estimated_tokens, exclude=[primary])
+            if secondary is None or not secondary.available(time.monotonic()):
+                return await first
+            self.hedges += 1
+            logger.info(f"🪂 Hedging: {primary.name} supera {delay:.2f}s, se lanza {secondary.name}")
+            second = asyncio.ensure_future(self._attempt(secondary, create_kwargs, estimated_tokens, client))
+            pending = {first, second}
+            while pending:
+                done, pending = await asyncio.wait(pending, return_when=asyncio.FIRST_COMPLETED)
+                winners = [task for task in done if task.exception() is None]
+                if winners:
+                    winner = second if second in winners else winners[0]
+                    if winner is second:
+                        self.hedge_wins += 1
+                    for task in winners:
+                        if task is not winner:
+                            await self._discard(*task.result())
+                    return winner.result()
+                error = next(iter(done)).exception()
+            raise error
+        finally:
+            for task in pending:
+                task.cancel()
+
+    async def _discard(self, raw, ticket: Ticket):
+        """Cierra una respuesta que perdió la carrera del hedging"""
+        await raw.http_response.aclose()
+        self.reconcile(ticket, 0)
+
+    def reconcile(self, ticket: Ticket, total_tokens: Optional[int], headers=None):
+        if ticket.backend.governor and ticket.permit:
+            ticket.backend.governor.reconcile(ticket.permit, total_tokens, headers)
+
+    def stats(self) -> dict:
+        return {
+            "backends": [b.stats() for b in self.backends],
+            "hedges": self.hedges,
+            "hedge_wins": self.hedge_wins,
+        }
+
+
+_router: Optional[Router] = None
+
+
+def get_router() -> Router:
+    """Router compartido del proceso"""
+    global _router
+    if _router is None:
+        _router = Router(AZURE_OPENAI_BACKENDS)
+    return _router
+
+
+def _backend_rows() -> List[dict]:
+    """Stats por backend con las del gobernador aplanadas (para /metrics)"""
+    rows = []
+    for backend in get_router().backends:
+        row = backend.stats()
+        for key, value in (row.pop("governor") or {}).items():
+            row[f"quota_{key}"] = value
+        rows.append(row)
+    return rows
+
+
+metrics.register_stats("router", lambda: get_router().stats())
+metrics.register_stats("router_backend", _backend_rows, label="name")
+
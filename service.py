@@ -0,0 +1,113 @@
+"""
+Servicio único: bot de Teams, chat web y chat con memoria en un mismo proceso
+
+Cada superficie es el APIRouter (routes) de su módulo, montado bajo su prefijo
+y habilitable por separado. Todas comparten el pool de Azure OpenAI, el router
+con sus gobernadores de cuota (que reparten el turno entre superficies según
+RATE_CLIENT_WEIGHTS), la caché de respuestas y el registro de métricas.
+
+    gunicorn service:app
+"""
+import importlib
+import logging
+from contextlib import asynccontextmanager
+from types import ModuleType
+from typing import List, Tuple
+from fastapi import FastAPI, Request
+from fastapi.responses import ORJSONResponse
+import admission
+import config
+import deadline
+import logging_setup
+import metrics
+import openai_client
+import usage_ledger
+from config import (
+    SERVICE_TEAMS_ENABLED,
+    SERVICE_CHAT_ENABLED,
+    SERVICE_CHAT_M_ENABLED,
+    SERVICE_TEAMS_PREFIX,
+    SERVICE_CHAT_PREFIX,
+    SERVICE_CHAT_M_PREFIX
+)
+
+# Configurar logging
+logging_setup.setup()
+logger = logging.getLogger(__name__)
+
+# (superficie, módulo, habilitada, prefijo)
+SURFACES = [
+    ("teams", "app", SERVICE_TEAMS_ENABLED, SERVICE_TEAMS_PREFIX),
+    ("chat", "chat", SERVICE_CHAT_ENABLED, SERVICE_CHAT_PREFIX),
+    ("chat_m", "chat_m", SERVICE_CHAT_M_ENABLED, SERVICE_CHAT_M_PREFIX),
+]
+
+# Solo se importan las habilitadas
+surfaces: List[Tuple[str, ModuleType, str]] = [
+    (name, importlib.import_module(module), prefix)
+    for name, module, enabled, prefix in SURFACES
+    if enabled
+]
+
+def preload():
+    """Lo que cada superficie pueda cargar antes del fork (gunicorn --preload)"""
+    for _, module, _ in surfaces:
+        if hasattr(module, "preload"):
+            module.preload()
+
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+    """Un único pool de Azure OpenAI; cada superficie arranca y para lo suyo"""
+    config.validate(*(name for name, _, _ in surfaces))
+    await openai_client.startup()
+    await usage_ledger.start()
+    for _, module, _ in surfaces:
+        if hasattr(module, "startup"):
+            await module.startup()
+    mounted = ", ".join(f"{name} en {prefix or '/'}" for name, _, prefix in surfaces)
+    logger.info(f"✅ Servicio con {mounted}")
+    yield
+    deadline.begin_drain()
+    for _, module, _ in reversed(surfaces):
+        if hasattr(module, "shutdown"):
+            await module.shutdown()
+    # Cuando ya no quedan turnos ni resúmenes en curso
+    await usage_ledger.stop()
+    await openai_client.shutdown()
+
+# Crear app FastAPI
+app = FastAPI(
+    lifespan=lifespan,
+    title="Evidenze AI",
+    description="Bot de Teams y chats web con Azure OpenAI",
+    version="2.0.0",
+    default_response_class=ORJSONResponse
+)
+metrics.instrument(app)
+logging_setup.instrument(app)
+admission.instrument(app)
+deadline.instrument(app)
+
+@app.get("/health")
+async def health():
+    """Health check de todas las superficies (va antes que el /health del bot en la raíz)"""
+    return {
+        "status": "healthy",
+        "surfaces": {
+            name: {"prefix": prefix or "/", **(await module.health())}
+            for name, module, prefix in surfaces
+        }
+    }
+
+for _, module, prefix in surfaces:
+    app.include_router(module.routes, prefix=prefix)
+
+@app.exception_handler(Exception)
+async def global_exception_handler(request: Request, exc: Exception):
+    """Manejador global de excepciones"""
+    logger.error(f"❌ Error global: {exc}")
+    metrics.record_error("global", exc)
+    return ORJSONResponse(
+        status_code=500,
+        content={"error": "Error interno del servidor"}
+    )
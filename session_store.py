@@ -0,0 +1,173 @@
+"""
+Almacén de sesiones en memoria para el chat con memoria (chat_m.py)
+
+Las sesiones solo viven en la RAM del proceso: nunca se persisten, expiran por
+inactividad y se pueden borrar explícitamente (promesa GDPR de memoria temporal).
+Por eso cada sesión existe en un único worker (ver CHAT_SESSIONS_STICKY), y un
+id que este proceso no conoce es un error explícito, no una sesión nueva.
+"""
+import logging
+import secrets
+import time
+from collections import OrderedDict, deque
+from typing import List, Optional, Tuple
+
+logger = logging.getLogger(__name__)
+
+
+class SessionNotFound(Exception):
+    """El cliente envió un id de sesión que este proceso no tiene (expiró, se borró u otro worker)"""
+
+
+class Session:
+    """Turnos de una sesión como tuplas (role, content) más el resumen rodante"""
+    __slots__ = ("turns", "size", "last_seen", "summary", "summarizing")
+
+    def __init__(self):
+        self.turns = deque()
+        self.size = 0
+        self.last_seen = time.monotonic()
+        self.summary = ""
+        self.summarizing = False
+
+
+def _turn_size(content: str) -> int:
+    return len(content.encode("utf-8"))
+
+
+class SessionStore:
+    """Sesiones acotadas: tope de turnos y bytes por sesión, tope global, LRU + TTL"""
+
+    def __init__(
+        self,
+        max_sessions: int,
+        max_turns: int,
+        max_session_bytes: int,
+        max_total_bytes: int,
+        idle_ttl: float
+    ):
+        self.max_sessions = max_sessions
+        self.max_turns = max_turns
+        self.max_session_bytes = max_session_bytes
+        self.max_total_bytes = max_total_bytes
+        self.idle_ttl = idle_ttl
+        # Orden LRU = orden de inactividad: la primera es la más antigua
+        self._sessions: "OrderedDict[str, Session]" = OrderedDict()
+        self._total_bytes = 0
+        self.evicted = 0
+        self.expired = 0
+        self.not_found = 0
+
+    def get(self, session_id: Optional[str]) -> Optional[Session]:
+        """Devuelve la sesión si existe y no ha expirado"""
+        self._purge_expired()
+        session = self._sessions.get(session_id) if session_id else None
+        if session is None:
+            return None
+        session.last_seen = time.monotonic()
+        self._sessions.move_to_end(session_id)
+        return session
+
+    def get_or_create(self, session_id: Optional[str]) -> Tuple[str, Session]:
+        """Recupera la sesión o, sin id, crea una nueva con un id opaco
+
+        Un id desconocido lanza SessionNotFound: el cliente decide si empieza
+        otra sesión sabiendo que pierde el historial.
+        """
+        if session_id:
+            session = self.get(session_id)
+            if session is None:
+                self.not_found += 1
+                raise SessionNotFound(session_id)
+            return session_id, session
+        self._purge_expired()
+        session_id = secrets.token_urlsafe(24)
+        session = Session()
+        self._sessions[session_id] = session
+        while len(self._sessions) > self.max_sessions:
+            self._evict_oldest()
+        return session_id, session
+
+    def append(self, session_id: str, role: str, content: str):
+        """Agrega un turno respetando los topes de la sesión y el global"""
+        session = self._sessions.get(session_id)
+        if session is None:
+            return
+        size = _turn_size(content)
+        session.turns.append((role, content))
+        session.size += size
+        self._total_bytes += size
+
+        # Topes por sesión: se descartan los turnos más antiguos
+        while len(session.turns) > 1 and (
+            len(session.turns) > self.max_turns or session.size > self.max_session_bytes
+        ):
+            self._drop_oldest_turn(session)
+
+        # Tope global: se expulsan las sesiones menos usadas (nunca la actual)
+        while self._total_bytes > self.max_total_bytes and len(self._sessions) > 1:
+            oldest_id = next(iter(self._sessions))
+            if oldest_id == session_id:
+                self._sessions.move_to_end(session_id)
+                continue
+            self._evict_oldest()
+
+    def history(self, session: Session) -> List[dict]:
+        """Turnos de la sesión en formato de mensajes de chat"""
+        return [{"role": role, "content": content} for role, content in session.turns]
+
+    def fold(self, session_id: str, folded: List[tuple], summary: str) -> bool:
+        """Reemplaza los turnos más antiguos por el resumen que los contiene"""
+        session = self._sessions.get(session_id)
+        if session is None or len(session.turns) < len(folded):
+            return False
+        # Si los topes ya descartaron alguno de esos turnos, el resumen no aplica
+        if any(a is not b for a, b in zip(session.turns, folded)):
+            return False
+        for _ in folded:
+            self._drop_oldest_turn(session)
+        delta = _turn_size(summary) - _turn_size(session.summary)
+        session.summary = summary
+        session.size += delta
+        self._total_bytes += delta
+        return True
+
+    def clear(self, session_id: Optional[str]) -> bool:
+        """Borra la sesión y todo su contenido"""
+        session = self._sessions.pop(session_id, None) if session_id else None
+        if session is None:
+            return False
+        self._total_bytes -= session.size
+        return True
+
+    def stats(self) -> dict:
+        return {
+            "sessions": len(self._sessions),
+            "bytes": self._total_bytes,
+            "max_bytes": self.max_total_bytes,
+            "evicted": self.evicted,
+            "expired": self.expired,
+            "not_found": self.not_found,
+        }
+
+    def _drop_oldest_turn(self, session: Session):
+        _, content = session.turns.popleft()
+        size = _turn_size(content)
+        session.size -= size
+        self._total_bytes -= size
+
+    def _evict_oldest(self):
+        _, session = self._sessions.popitem(last=False)
+        self._total_bytes -= session.size
+        self.evicted += 1
+
+    def _purge_expired(self):
+        """Elimina las sesiones inactivas (están al principio del orden LRU)"""
+        deadline = time.monotonic() - self.idle_ttl
+        while self._sessions:
+            session = next(iter(self._sessions.values()))
+            if session.last_seen > deadline:
+                break
+            _, session = self._sessions.popitem(last=False)
+            self._total_bytes -= session.size
+            self.expired += 1
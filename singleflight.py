@@ -0,0 +1,94 @@
+"""
+Coalescencia de llamadas idénticas en vuelo (single-flight)
+
+Las peticiones concurrentes con la misma clave comparten una única llamada a
+Azure OpenAI. Cancelar a uno de los que esperan no cancela la llamada compartida
+mientras quede alguien esperándola; si se van todos, se cancela.
+"""
+import asyncio
+import logging
+from typing import Awaitable, Callable, Dict, Optional
+
+logger = logging.getLogger(__name__)
+
+
+class LeaderAbandoned(Exception):
+    """El líder abandonó la llamada (p. ej. su cliente cerró el stream)"""
+
+
+class SingleFlight:
+    """Registro de llamadas en vuelo por clave"""
+
+    def __init__(self):
+        self._inflight: Dict[str, asyncio.Future] = {}
+        # Llamada lanzada por do() -> callers que esperan su resultado
+        self._waiters: Dict[asyncio.Future, int] = {}
+        self.calls = 0
+        self.coalesced = 0
+        self.abandoned = 0
+
+    async def do(self, key: str, fn: Callable[[], Awaitable]):
+        """Ejecuta fn una sola vez por clave; los demás reciben su resultado o su error"""
+        future = self._inflight.get(key)
+        if future is not None:
+            self.coalesced += 1
+            return await self._join(future)
+        task = asyncio.ensure_future(fn())
+        self._track(key, task)
+        self._waiters[task] = 0
+        self.calls += 1
+        return await self._join(task)
+
+    def joinable(self, key: str) -> Optional[asyncio.Future]:
+        """Llamada en vuelo para la clave, si la hay"""
+        return self._inflight.get(key)
+
+    async def wait(self, future: asyncio.Future):
+        """Se une a una llamada en vuelo ya existente"""
+        self.coalesced += 1
+        return await self._join(future)
+
+    def lead(self, key: str) -> asyncio.Future:
+        """Registra al caller como líder; él resuelve el future al terminar"""
+        future = asyncio.get_running_loop().create_future()
+        self._track(key, future)
+        self.calls += 1
+        return future
+
+    def stats(self) -> dict:
+        return {
+            "calls": self.calls,
+            "coalesced": self.coalesced,
+            "abandoned": self.abandoned,
+            "inflight": len(self._inflight),
+        }
+
+    async def _join(self, future: asyncio.Future):
+        # shield: si este caller se cancela, la llamada sigue para los demás
+        if future not in self._waiters:
+            # Future de un líder (lead()): lo resuelve él, no se cancela desde aquí
+            return await asyncio.shield(future)
+        self._waiters[future] += 1
+        try:
+            return await asyncio.shield(future)
+        finally:
+            # Al terminar, done() ya puede haberla quitado
+            if future in self._waiters:
+                self._waiters[future] -= 1
+            if not self._waiters.get(future, 1) and not future.done():
+                # Ya nadie espera el resultado: no tiene sentido seguir pagándolo
+                self.abandoned += 1
+                future.cancel()
+
+    def _track(self, key: str, future: asyncio.Future):
+        self._inflight[key] = future
+
+        def done(f: asyncio.Future):
+            if self._inflight.get(key) is f:
+                del self._inflight[key]
+            self._waiters.pop(f, None)
+            # Evita "exception was never retrieved" si nadie quedó esperando
+            if not f.cancelled():
+                f.exception()
+
+        future.add_done_callback(done)
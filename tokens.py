@@ -0,0 +1,63 @@
+"""
+Conteo local de tokens con tokenizador cacheado
+
+Los conteos se recuerdan por huella del texto, nunca por el texto: el historial
+y las respuestas se cuentan en cada turno, pero lo que escribió un usuario no
+debe seguir en memoria cuando su sesión ya se borró o expiró.
+"""
+import hashlib
+import logging
+from collections import OrderedDict
+from functools import lru_cache
+from typing import List
+
+from config import TOKENIZER_ENCODING
+
+logger = logging.getLogger(__name__)
+
+# Sobrecoste aproximado de cada mensaje en el formato de chat
+MESSAGE_OVERHEAD = 4
+
+COUNT_CACHE_SIZE = 8192
+
+# huella (blake2b) -> tokens, en orden LRU
+_counts: "OrderedDict[bytes, int]" = OrderedDict()
+
+
+@lru_cache(maxsize=1)
+def _encoder():
+    """Tokenizador local (tiktoken); None si no está disponible"""
+    try:
+        import tiktoken
+        return tiktoken.get_encoding(TOKENIZER_ENCODING)
+    except Exception as e:
+        # tiktoken descarga el vocabulario la primera vez (TIKTOKEN_CACHE_DIR)
+        logger.warning(f"⚠️ Tokenizador no disponible, se estima por caracteres: {e}")
+        return None
+
+
+def count_tokens(text: str) -> int:
+    """Cuenta tokens de un texto (resultado cacheado por huella del contenido)"""
+    encoder = _encoder()
+    if encoder is None:
+        return len(text) // 4 + 1
+    digest = hashlib.blake2b(text.encode("utf-8"), digest_size=16).digest()
+    count = _counts.get(digest)
+    if count is not None:
+        _counts.move_to_end(digest)
+        return count
+    count = len(encoder.encode(text, disallowed_special=()))
+    _counts[digest] = count
+    if len(_counts) > COUNT_CACHE_SIZE:
+        _counts.popitem(last=False)
+    return count
+
+
+def messages_tokens(messages: List[dict]) -> int:
+    """Tokens de prompt aproximados de una lista de mensajes"""
+    return sum(count_tokens(m["content"]) + MESSAGE_OVERHEAD for m in messages)
+
+
+def warmup():
+    """Carga el tokenizador fuera del camino crítico (arranque)"""
+    _encoder()
@@ -0,0 +1,118 @@
+"""
+Cola de turnos del bot con pool de workers acotado
+
+El webhook encola el turno y responde 200 al momento; los workers lo procesan
+después. Los turnos de una misma conversación se ejecutan en orden, de uno en
+uno; conversaciones distintas avanzan en paralelo hasta el límite de workers.
+Cada turno corre con el contexto (contextvars) de la petición que lo encoló.
+"""
+import asyncio
+import contextvars
+import logging
+import time
+from collections import deque
+from typing import Awaitable, Callable, Deque, Dict, List, Optional, Tuple
+
+import metrics
+
+logger = logging.getLogger(__name__)
+
+Job = Callable[[], Awaitable[None]]
+
+QUEUE_WAIT = metrics.histogram("bot_turn_queue_wait_seconds", "Espera de un turno en la cola hasta que un worker lo toma")
+TURN_DURATION = metrics.histogram("bot_turn_duration_seconds", "Duración del procesamiento de un turno en segundo plano")
+
+
+class TurnQueue:
+    """Turnos pendientes por conversación y workers que los consumen"""
+
+    def __init__(self, workers: int, max_pending: int, drain_timeout: float = 20.0):
+        self.workers = workers
+        self.max_pending = max_pending
+        self.drain_timeout = drain_timeout
+        # Conversación -> turnos pendientes; si está aquí, ya está en _ready o en un worker
+        self._conversations: Dict[str, Deque[Tuple[Job, float, contextvars.Context]]] = {}
+        self._ready: Optional[asyncio.Queue] = None
+        self._tasks: List[asyncio.Task] = []
+        self._pending = 0
+        self._running = 0
+        self._accepting = False
+        self.processed = 0
+        self.failed = 0
+        self.rejected = 0
+        self.max_wait = 0.0
+
+    async def start(self):
+        self._ready = asyncio.Queue()
+        self._accepting = True
+        self._tasks = [asyncio.create_task(self._worker()) for _ in range(self.workers)]
+        logger.info(f"🧵 Cola de turnos iniciada con {self.workers} workers")
+
+    async def stop(self):
+        """Deja de aceptar turnos y espera a los pendientes (con límite)"""
+        self._accepting = False
+        deadline = time.monotonic() + self.drain_timeout
+        while (self._pending or self._running) and time.monotonic() < deadline:
+            await asyncio.sleep(0.1)
+        if self._pending or self._running:
+            logger.warning(f"⚠️ Apagado con {self._pending + self._running} turnos sin terminar")
+        for task in self._tasks:
+            task.cancel()
+        await asyncio.gather(*self._tasks, return_exceptions=True)
+        self._tasks = []
+
+    def submit(self, conversation_id: str, job: Job) -> bool:
+        """Encola un turno; False si la cola está llena o apagándose"""
+        if not self._accepting or self._pending >= self.max_pending:
+            self.rejected += 1
+            return False
+        self._pending += 1
+        entry = (job, time.monotonic(), contextvars.copy_context())
+        turns = self._conversations.get(conversation_id)
+        if turns is not None:
+            turns.append(entry)
+            return True
+        self._conversations[conversation_id] = deque([entry])
+        self._ready.put_nowait(conversation_id)
+        return True
+
+    def stats(self) -> dict:
+        return {
+            "depth": self._pending,
+            "running": self._running,
+            "conversations": len(self._conversations),
+            "workers": self.workers,
+            "processed": self.processed,
+            "failed": self.failed,
+            "rejected": self.rejected,
+            "max_wait_s": round(self.max_wait, 3),
+        }
+
+    async def _worker(self):
+        while True:
+            conversation_id = await self._ready.get()
+            turns = self._conversations[conversation_id]
+            job, enqueued_at, context = turns.popleft()
+            self._pending -= 1
+            self._running += 1
+            wait = time.monotonic() - enqueued_at
+            self.max_wait = max(self.max_wait, wait)
+            QUEUE_WAIT.observe(wait)
+            started = time.perf_counter()
+            try:
+                await asyncio.create_task(job(), context=context)
+                self.processed += 1
+            except asyncio.CancelledError:
+                raise
+            except Exception as e:
+                self.failed += 1
+                logger.error(f"❌ Error procesando turno en segundo plano: {e}")
+                metrics.record_error("turn_queue", e)
+            finally:
+                self._running -= 1
+                TURN_DURATION.observe(time.perf_counter() - started)
+                # Siguiente turno de la conversación al final de la fila (reparto justo)
+                if turns:
+                    self._ready.put_nowait(conversation_id)
+                else:
+                    del self._conversations[conversation_id]
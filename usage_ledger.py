@@ -0,0 +1,369 @@
+"""
+Libro de consumo por usuario y equipo (imputación de costes de Azure OpenAI)
+
+Cada llamada al modelo (o respuesta servida desde caché) deja un registro en
+un buffer circular en memoria: usuario, equipo, cliente, deployment, tokens de
+prompt / completion / prefijo cacheado, latencia y resultado. Anotarlo es un
+append a un deque; una tarea en segundo plano vuelca el buffer por lotes a
+SQLite (WAL) desde un hilo, así que la contabilidad no añade latencia al turno.
+
+En disco hay dos tablas: usage_events (solo inserciones, con retención de
+USAGE_LEDGER_RETENTION_DAYS) y usage_daily, el acumulado por día, usuario,
+equipo, cliente y deployment que se actualiza en la misma transacción. Los
+informes leen el acumulado, así que no dependen de cuántos eventos haya:
+
+    python usage_ledger.py report --by user --since 2026-10-01
+    python usage_ledger.py report --by day,team --json
+
+El usuario y el equipo los fija cada superficie al entrar (set_account) en un
+contextvar; los resúmenes en segundo plano lo heredan de la petición que los
+lanzó.
+"""
+import argparse
+import asyncio
+import contextvars
+import json
+import logging
+import sqlite3
+import threading
+import time
+from collections import deque
+from typing import Dict, List, Mapping, Optional, Sequence, Tuple
+
+import metrics
+from config import (
+    USAGE_LEDGER_DB,
+    USAGE_LEDGER_BUFFER,
+    USAGE_LEDGER_FLUSH_INTERVAL,
+    USAGE_LEDGER_RETENTION_DAYS
+)
+
+logger = logging.getLogger(__name__)
+
+PURGE_INTERVAL = 3600.0
+
+# Columnas por las que se puede agrupar un informe
+GROUPS = ("day", "user_id", "team_id", "client", "deployment")
+GROUP_ALIASES = {"user": "user_id", "team": "team_id"}
+
+# (usuario, equipo) de quien origina las llamadas al modelo en este contexto
+_account: contextvars.ContextVar[Tuple[str, str]] = contextvars.ContextVar("usage_account", default=("", ""))
+
+
+def set_account(user: str, team: str = "") -> contextvars.Token:
+    """Atribuye al usuario (y equipo) las llamadas que se hagan en este contexto"""
+    return _account.set((user or "", team or ""))
+
+
+def reset_account(token: contextvars.Token):
+    _account.reset(token)
+
+
+def web_user(headers: Mapping[str, str], fallback: str) -> str:
+    """Usuario de un chat web: el de App Service Authentication si lo hay"""
+    return headers.get("x-ms-client-principal-name") or fallback
+
+
+def _day(at: float) -> str:
+    return time.strftime("%Y-%m-%d", time.gmtime(at))
+
+
+class _SQLiteLedger:
+    """Eventos y acumulado diario en SQLite; lo escribe un único hilo cada vez"""
+
+    def __init__(self, path: str):
+        self._lock = threading.Lock()
+        self._db = sqlite3.connect(path, check_same_thread=False, isolation_level=None)
+        self._db.execute("PRAGMA journal_mode=WAL")
+        self._db.execute("PRAGMA synchronous=NORMAL")
+        self._db.execute(
+            "CREATE TABLE IF NOT EXISTS usage_events ("
+            "id INTEGER PRIMARY KEY, at REAL NOT NULL, day TEXT NOT NULL, "
+            "user_id TEXT NOT NULL, team_id TEXT NOT NULL, client TEXT NOT NULL, deployment TEXT NOT NULL, "
+            "prompt_tokens INTEGER NOT NULL, completion_tokens INTEGER NOT NULL, cached_tokens INTEGER NOT NULL, "
+            "latency_ms REAL NOT NULL, outcome TEXT NOT NULL)"
+        )
+        self._db.execute("CREATE INDEX IF NOT EXISTS usage_events_by_day ON usage_events (day)")
+        self._db.execute(
+            "CREATE TABLE IF NOT EXISTS usage_daily ("
+            "day TEXT NOT NULL, user_id TEXT NOT NULL, team_id TEXT NOT NULL, client TEXT NOT NULL, "
+            "deployment TEXT NOT NULL, requests INTEGER NOT NULL, errors INTEGER NOT NULL, "
+            "cache_hits INTEGER NOT NULL, prompt_tokens INTEGER NOT NULL, completion_tokens INTEGER NOT NULL, "
+            "cached_tokens INTEGER NOT NULL, latency_ms REAL NOT NULL, "
+            "PRIMARY KEY (day, user_id, team_id, client, deployment))"
+        )
+
+    def append_many(self, events: Sequence[tuple]):
+        """Inserta un lote de eventos y suma su acumulado en una transacción"""
+        rows = []
+        daily: Dict[tuple, List[float]] = {}
+        for at, user, team, client, deployment, prompt, completion, cached, latency_ms, outcome in events:
+            day = _day(at)
+            rows.append((at, day, user, team, client, deployment, prompt, completion, cached, latency_ms, outcome))
+            totals = daily.setdefault((day, user, team, client, deployment), [0, 0, 0, 0, 0, 0, 0.0])
+            totals[0] += 1
+            totals[1] += outcome not in ("ok", "cache", "coalesced")
+            totals[2] += outcome in ("cache", "coalesced")
+            totals[3] += prompt
+            totals[4] += completion
+            totals[5] += cached
+            totals[6] += latency_ms
+        with self._lock:
+            self._db.execute("BEGIN")
+            try:
+                self._db.executemany(
+                    "INSERT INTO usage_events (at, day, user_id, team_id, client, deployment, prompt_tokens, "
+                    "completion_tokens, cached_tokens, latency_ms, outcome) VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)",
+                    rows
+                )
+                self._db.executemany(
+                    "INSERT INTO usage_daily VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?) "
+                    "ON CONFLICT (day, user_id, team_id, client, deployment) DO UPDATE SET "
+                    "requests = requests + excluded.requests, errors = errors + excluded.errors, "
+                    "cache_hits = cache_hits + excluded.cache_hits, "
+                    "prompt_tokens = prompt_tokens + excluded.prompt_tokens, "
+                    "completion_tokens = completion_tokens + excluded.completion_tokens, "
+                    "cached_tokens = cached_tokens + excluded.cached_tokens, "
+                    "latency_ms = latency_ms + excluded.latency_ms",
+                    [key + tuple(totals) for key, totals in daily.items()]
+                )
+                self._db.execute("COMMIT")
+            except BaseException:
+                self._db.execute("ROLLBACK")
+                raise
+
+    def purge(self, before_day: str):
+        """Borra los eventos sueltos antiguos (el acumulado diario se conserva)"""
+        with self._lock:
+            self._db.execute("DELETE FROM usage_events WHERE day < ?", (before_day,))
+
+
+class UsageLedger:
+    """Buffer circular de consumos con volcado por lotes en segundo plano"""
+
+    def __init__(self, db_path: str, buffer_size: int = 10000, flush_interval: float = 1.0, retention_days: float = 90):
+        self.flush_interval = flush_interval
+        self.retention_days = retention_days
+        self._disk = _SQLiteLedger(db_path)
+        self._buffer: deque = deque(maxlen=buffer_size)
+        self._flush_lock = asyncio.Lock()
+        self._flusher: Optional[asyncio.Task] = None
+        self._purged_at = 0.0
+        self.recorded = 0
+        self.dropped = 0
+        self.flushes = 0
+        self.flushed = 0
+        self.flush_errors = 0
+
+    async def start(self):
+        if self._flusher is None:
+            self._flusher = asyncio.create_task(self._flush_loop())
+
+    async def stop(self):
+        """Vuelca lo pendiente antes de apagar"""
+        if self._flusher is not None:
+            self._flusher.cancel()
+            await asyncio.gather(self._flusher, return_exceptions=True)
+            self._flusher = None
+        await self.flush()
+
+    def record(
+        self,
+        client: str,
+        deployment: str,
+        prompt_tokens: int,
+        completion_tokens: int,
+        cached_tokens: int,
+        latency: float,
+        outcome: str
+    ):
+        """Anota un consumo (sin E/S: solo un append al buffer)"""
+        user, team = _account.get()
+        if len(self._buffer) == self._buffer.maxlen:
+            # Buffer lleno (disco caído o lento): se pierde el más antiguo
+            self.dropped += 1
+        self._buffer.append((
+            time.time(), user, team, client, deployment or "",
+            prompt_tokens, completion_tokens, cached_tokens, round(latency * 1000, 1), outcome
+        ))
+        self.recorded += 1
+
+    async def flush(self):
+        """Escribe en una transacción todo lo acumulado en el buffer"""
+        if not self._buffer:
+            return
+        async with self._flush_lock:
+            batch = list(self._buffer)
+            self._buffer.clear()
+            if not batch:
+                return
+            try:
+                await asyncio.to_thread(self._disk.append_many, batch)
+            except Exception as e:
+                # Vuelve al buffer para el próximo volcado (si no cabe, se pierde lo más antiguo)
+                pending = batch + list(self._buffer)
+                self.dropped += max(len(pending) - self._buffer.maxlen, 0)
+                self._buffer = deque(pending, maxlen=self._buffer.maxlen)
+                self.flush_errors += 1
+                logger.warning(f"⚠️ No se pudo guardar el consumo: {e}")
+                return
+            self.flushes += 1
+            self.flushed += len(batch)
+
+    def stats(self) -> dict:
+        return {
+            "buffered": len(self._buffer),
+            "recorded": self.recorded,
+            "dropped": self.dropped,
+            "flushes": self.flushes,
+            "flushed": self.flushed,
+            "flush_errors": self.flush_errors,
+        }
+
+    async def _flush_loop(self):
+        while True:
+            await asyncio.sleep(self.flush_interval)
+            await self.flush()
+            if time.monotonic() - self._purged_at >= PURGE_INTERVAL:
+                self._purged_at = time.monotonic()
+                try:
+                    await asyncio.to_thread(self._disk.purge, _day(time.time() - self.retention_days * 86400))
+                except Exception as e:
+                    logger.warning(f"⚠️ No se pudieron purgar consumos antiguos: {e}")
+
+
+_ledger: Optional[UsageLedger] = None
+
+
+def get_ledger() -> Optional[UsageLedger]:
+    """Libro de consumo del proceso (None sin USAGE_LEDGER_DB)"""
+    global _ledger
+    if USAGE_LEDGER_DB and _ledger is None:
+        _ledger = UsageLedger(
+            USAGE_LEDGER_DB,
+            USAGE_LEDGER_BUFFER,
+            USAGE_LEDGER_FLUSH_INTERVAL,
+            USAGE_LEDGER_RETENTION_DAYS
+        )
+    return _ledger
+
+
+async def start():
+    ledger = get_ledger()
+    if ledger is not None:
+        await ledger.start()
+
+
+async def stop():
+    if _ledger is not None:
+        await _ledger.stop()
+
+
+def record(client: str, deployment: str, usage, latency: float, outcome: str):
+    """Anota una llamada con su usage de Azure (None si no llegó a consumir)"""
+    ledger = get_ledger()
+    if ledger is None:
+        return
+    if usage is None:
+        ledger.record(client, deployment, 0, 0, 0, latency, outcome)
+        return
+    ledger.record(
+        client,
+        deployment,
+        usage.prompt_tokens or 0,
+        usage.completion_tokens or 0,
+        metrics.cached_tokens(usage),
+        latency,
+        outcome
+    )
+
+
+metrics.register_stats("usage_ledger", lambda: _ledger.stats() if _ledger else None)
+
+
+# === INFORMES ===
+
+def aggregate(
+    db_path: str,
+    by: Sequence[str] = ("user_id",),
+    since: Optional[str] = None,
+    until: Optional[str] = None,
+    user: Optional[str] = None,
+    team: Optional[str] = None,
+    limit: Optional[int] = None
+) -> List[dict]:
+    """Totales por las columnas de by (day, user, team, client, deployment) entre dos días incluidos"""
+    columns = [GROUP_ALIASES.get(column, column) for column in by]
+    unknown = set(columns) - set(GROUPS)
+    if unknown:
+        raise ValueError(f"No se puede agrupar por {', '.join(sorted(unknown))}")
+    where, params = [], []
+    for column, value, op in (("day", since, ">="), ("day", until, "<="), ("user_id", user, "="), ("team_id", team, "=")):
+        if value:
+            where.append(f"{column} {op} ?")
+            params.append(value)
+    group = ", ".join(columns)
+    sql = (
+        f"SELECT {group + ', ' if group else ''}SUM(requests), SUM(errors), SUM(cache_hits), "
+        "SUM(prompt_tokens), SUM(completion_tokens), SUM(cached_tokens), SUM(latency_ms) FROM usage_daily"
+        + (f" WHERE {' AND '.join(where)}" if where else "")
+        + (f" GROUP BY {group}" if group else "")
+        + " ORDER BY SUM(prompt_tokens) + SUM(completion_tokens) DESC"
+        + (f" LIMIT {int(limit)}" if limit else "")
+    )
+    db = sqlite3.connect(f"file:{db_path}?mode=ro", uri=True)
+    try:
+        rows = db.execute(sql, params).fetchall()
+    finally:
+        db.close()
+    report = []
+    for row in rows:
+        keys, values = row[:len(columns)], row[len(columns):]
+        requests, errors, cache_hits, prompt, completion, cached, latency = (v or 0 for v in values)
+        if not requests:
+            continue
+        report.append({
+            **dict(zip(columns, keys)),
+            "requests": requests,
+            "errors": errors,
+            "cache_hits": cache_hits,
+            "prompt_tokens": prompt,
+            "completion_tokens": completion,
+            "cached_tokens": cached,
+            "total_tokens": prompt + completion,
+            "avg_latency_ms": round(latency / requests, 1),
+        })
+    return report
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Informes del libro de consumo de Azure OpenAI")
+    sub = parser.add_subparsers(dest="command", required=True)
+    report_cmd = sub.add_parser("report", help="Totales agrupados a partir del acumulado diario")
+    report_cmd.add_argument("--db", default=USAGE_LEDGER_DB, required=not USAGE_LEDGER_DB)
+    report_cmd.add_argument("--by", default="user", help="Columnas separadas por comas: day, user, team, client, deployment")
+    report_cmd.add_argument("--since", help="Primer día (YYYY-MM-DD, UTC)")
+    report_cmd.add_argument("--until", help="Último día (YYYY-MM-DD, UTC)")
+    report_cmd.add_argument("--user")
+    report_cmd.add_argument("--team")
+    report_cmd.add_argument("--limit", type=int)
+    report_cmd.add_argument("--json", action="store_true", help="Salida JSON en lugar de tabla")
+    args = parser.parse_args()
+
+    by = [column.strip() for column in args.by.split(",") if column.strip()]
+    report = aggregate(args.db, by, args.since, args.until, args.user, args.team, args.limit)
+    if args.json:
+        print(json.dumps(report, ensure_ascii=False, indent=2))
+        return
+    if not report:
+        print("Sin consumos en el periodo")
+        return
+    headers = list(report[0])
+    widths = [max(len(h), *(len(str(row[h])) for row in report)) for h in headers]
+    print("  ".join(h.ljust(w) for h, w in zip(headers, widths)))
+    for row in report:
+        print("  ".join(str(row[h]).ljust(w) for h, w in zip(headers, widths)))
+
+
+if __name__ == "__main__":
+    main()